@@ -9,15 +9,75 @@
 
 
 import tkinter as tk
-from tkinter import ttk, messagebox
+from tkinter import ttk, messagebox, filedialog
 import json
+import operator
+import os
+import re
+import sys
+import time
+import random
+import argparse
+import functools
+import threading
+import shutil
 from pathlib import Path
+from collections import deque
 from datetime import datetime
-from typing import List, Dict, Any, Optional
+from dataclasses import dataclass, field, replace
+from typing import List, Dict, Any, Optional, Set, Tuple, Callable
 import csv
+import sqlite3
+import hashlib
+import hmac
+import secrets
+import zlib
+import html
+from array import array
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
 
 APP_VERSION = "GaiLab v15.2"
 APP_BUILD_DATE = "2025-11-14"
+SCHEMA_VERSION = 6
+# Снимок состояния журнала делается каждые N событий
+SNAPSHOT_INTERVAL = 1000
+# Хранятся последние снимки и последний снимок каждого дня за N дней - для запросов на дату
+SNAPSHOT_KEEP_LAST = 3
+SNAPSHOT_KEEP_DAILY = 30
+# Резервные копии: блоки режутся по границам строк, в среднем ~8 КБ
+BACKUP_CHUNK_MIN = 2 * 1024
+BACKUP_CHUNK_MAX = 64 * 1024
+BACKUP_CHUNK_MASK = (1 << 13) - 1
+BACKUP_KEEP_LAST = 10
+BACKUP_KEEP_DAILY = 30
+DIAGNOSTICS_RECENT_OPS = 200
+UNDO_LIMIT = 100
+PASSWORD_ITERATIONS = 200_000
+SESSION_TTL = 30 * 60
+# Репликация: после клонирования узел k выдаёт id вида k + n * шаг, id разных узлов не пересекаются
+REPLICATION_ID_STEP = 16
+SYNC_BUNDLE_FORMAT = "gailab-sync-1"
+
+COMMAND_LABELS = {
+    'add_category': "добавление категории",
+    'batch': "начисление по категории",
+    'update_category': "изменение категории",
+    'delete_category': "удаление категории",
+    'add_transaction': "добавление платежа",
+    'update_transaction': "изменение платежа",
+    'delete_transaction': "удаление платежа",
+    'update_apartment': "изменение данных квартиры"
+}
+
+# Корзины просрочки: (максимальный возраст долга в днях, подпись)
+AGING_BUCKETS = ((30, "0–30"), (60, "31–60"), (90, "61–90"), (None, "90+"))
 
 MONTHS_RU = {
     1: "январь", 2: "февраль", 3: "март", 4: "апрель",
@@ -26,186 +86,2962 @@ MONTHS_RU = {
 }
 
 
+# Суммы хранятся в копейках (int), рубли - только при вводе и выводе
+def parse_money(value: Any) -> int:
+    try:
+        amount = Decimal(str(value).strip().replace(',', '.'))
+    except InvalidOperation:
+        raise ValueError(f"Некорректная сумма: {value!r}")
+    if not amount.is_finite():
+        raise ValueError(f"Некорректная сумма: {value!r}")
+    return int((amount * 100).quantize(Decimal('1'), rounding=ROUND_HALF_UP))
+
+
+def format_money(kopecks: int, signed: bool = False) -> str:
+    sign = '-' if kopecks < 0 else ('+' if signed and kopecks > 0 else '')
+    rubles, kop = divmod(abs(kopecks), 100)
+    return f"{sign}{rubles}.{kop:02d}"
+
+
+def parse_reading(value: Any) -> int:
+    # Показание счётчика в тысячных долях единицы, как деньги в копейках - без ошибок float
+    try:
+        amount = Decimal(str(value).strip().replace(' ', '').replace(',', '.'))
+    except InvalidOperation:
+        raise ValueError(f"Некорректное показание: {value!r}")
+    if not amount.is_finite() or amount < 0:
+        raise ValueError(f"Некорректное показание: {value!r}")
+    return int((amount * 1000).quantize(Decimal('1'), rounding=ROUND_HALF_UP))
+
+
+def format_reading(milli: int) -> str:
+    return f"{Decimal(milli) / 1000:f}".rstrip('0').rstrip('.') or "0"
+
+
+def split_amount(total: int, parts: int) -> List[int]:
+    # Остаток копеек достаётся первым квартирам, сумма долей всегда равна total
+    share, remainder = divmod(total, parts)
+    return [share + 1 if i < remainder else share for i in range(parts)]
+
+
+class Record:
+    # Общая сериализация для записей со __slots__: поля со значением None в JSON не пишутся
+    __slots__ = ()
+
+    def to_dict(self) -> Dict:
+        return {name: value for name in self.__slots__ if (value := getattr(self, name)) is not None}
+
+    @classmethod
+    def from_dict(cls, data: Dict):
+        return cls(**{name: data[name] for name in cls.__slots__ if name in data})
+
+    def copy(self):
+        return replace(self)
+
+
+@dataclass(slots=True)
+class Transaction(Record):
+    id: int
+    apartment_id: int
+    category_id: int
+    amount: int
+    type: str
+    user_id: int
+    notes: str = ""
+    created_at: str = ""
+    updated_at: Optional[str] = None
+    # "время|узел" последней записи - по нему сливаются параллельные правки с разных узлов
+    version: Optional[str] = field(default=None, compare=False)
+
+    def __post_init__(self):
+        # 'payment' / 'debt' и типовые примечания начислений - одна строка на весь журнал
+        self.type = sys.intern(self.type)
+        self.notes = sys.intern(self.notes)
+
+
+@dataclass(slots=True)
+class Category(Record):
+    id: int
+    name: str
+    amount: int
+    created_at: str = ""
+    template_id: Optional[int] = None
+    period: Optional[str] = None
+    version: Optional[str] = field(default=None, compare=False)
+
+
+@dataclass(slots=True)
+class Apartment(Record):
+    id: int
+    number: int
+    full_name: str = ""
+    phone: str = ""
+    version: Optional[str] = field(default=None, compare=False)
+
+
+@dataclass(slots=True)
+class User(Record):
+    id: int
+    username: str
+    password_hash: str
+    role: str = 'user'
+    created_at: str = ""
+
+    def __post_init__(self):
+        self.role = sys.intern(self.role)
+
+
+def hash_password(password: str, salt: Optional[bytes] = None, iterations: int = PASSWORD_ITERATIONS) -> str:
+    # pbkdf2_sha256$итерации$соль$ключ - параметры хранятся вместе с ключом, их можно менять
+    salt = salt or secrets.token_bytes(16)
+    key = hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), salt, iterations)
+    return f"pbkdf2_sha256${iterations}${salt.hex()}${key.hex()}"
+
+
+def verify_password(password: str, stored: str) -> bool:
+    try:
+        algorithm, iterations, salt, key = stored.split('$')
+        if algorithm != 'pbkdf2_sha256':
+            return False
+        candidate = hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), bytes.fromhex(salt), int(iterations))
+    except ValueError:
+        return False
+    return hmac.compare_digest(candidate.hex(), key)
+
+
+def empty_ledger() -> Dict[str, Dict[int, Record]]:
+    return {'categories': {}, 'transactions': {}, 'apartments': {}}
+
+
+def _is_newer(record: Record, stamp: Optional[str]) -> bool:
+    # Последний пишущий выигрывает по (время, узел); события без метки узла - старый журнал
+    return stamp is None or record.version is None or stamp > record.version
+
+
+def apply_ledger_event(ledger: Dict[str, Dict[int, Record]], event: Dict, changes: Optional[List[Tuple]] = None, stamp: Optional[str] = None) -> List[Tuple]:
+    # Единственное место, где меняется состояние журнала: и при записи, и при воспроизведении.
+    # Возвращает изменения (коллекция, id, было, стало) для инкрементальных индексов.
+    # Результат не зависит от порядка событий разных узлов: правки сливаются по версии,
+    # удаление побеждает, платёж в удалённую категорию не применяется
+    if changes is None:
+        changes = []
+    if stamp is None and 'node' in event:
+        stamp = f"{event['ts']}|{event['node']}"
+    op = event['op']
+    categories = ledger['categories']
+    transactions = ledger['transactions']
+    apartments = ledger['apartments']
+    if op == 'batch':
+        for sub_event in event['events']:
+            apply_ledger_event(ledger, sub_event, changes, stamp)
+    elif op == 'import':
+        for data in event.get('categories', ()):
+            record = Category.from_dict(data)
+            changes.append(('categories', record.id, categories.get(record.id), record))
+            categories[record.id] = record
+        for data in event.get('transactions', ()):
+            record = Transaction.from_dict(data)
+            changes.append(('transactions', record.id, transactions.get(record.id), record))
+            transactions[record.id] = record
+        for data in event.get('apartments', ()):
+            record = Apartment.from_dict(data)
+            changes.append(('apartments', record.id, apartments.get(record.id), record))
+            apartments[record.id] = record
+    elif op == 'add_category':
+        record = Category.from_dict(event['record'])
+        record.version = stamp or record.version
+        changes.append(('categories', record.id, categories.get(record.id), record))
+        categories[record.id] = record
+    elif op == 'update_category':
+        cat = categories.get(event['id'])
+        if cat and _is_newer(cat, stamp):
+            old = cat.copy()
+            cat.amount = event['amount']
+            cat.version = stamp or cat.version
+            changes.append(('categories', cat.id, old, cat))
+    elif op == 'delete_category':
+        for trans_id in [t.id for t in transactions.values() if t.category_id == event['id']]:
+            changes.append(('transactions', trans_id, transactions.pop(trans_id), None))
+        if event['id'] in categories:
+            changes.append(('categories', event['id'], categories.pop(event['id']), None))
+    elif op == 'add_transaction':
+        record = Transaction.from_dict(event['record'])
+        if record.category_id in categories:
+            record.version = stamp or record.version
+            changes.append(('transactions', record.id, transactions.get(record.id), record))
+            transactions[record.id] = record
+    elif op == 'update_transaction':
+        trans = transactions.get(event['id'])
+        if trans and _is_newer(trans, stamp):
+            old = trans.copy()
+            trans.amount = event['amount']
+            trans.notes = event['notes']
+            trans.updated_at = event['updated_at']
+            trans.version = stamp or trans.version
+            changes.append(('transactions', trans.id, old, trans))
+    elif op == 'delete_transaction':
+        if event['id'] in transactions:
+            changes.append(('transactions', event['id'], transactions.pop(event['id']), None))
+    elif op == 'update_apartment':
+        apt = apartments.get(event['id'])
+        if apt and _is_newer(apt, stamp):
+            old = apt.copy()
+            apt.full_name = event['full_name']
+            apt.phone = event['phone']
+            apt.version = stamp or apt.version
+            changes.append(('apartments', apt.id, old, apt))
+    return changes
+
+
+def event_as_of(event: Dict, when_iso: str, ts: Optional[str] = None) -> Optional[Dict]:
+    # Часть события, существовавшая на момент when_iso: добавленные записи - по их created_at
+    # (импорт и начисления задним числом), правки и удаления - по времени события
+    ts = ts or event['ts']
+    op = event['op']
+    if op == 'batch':
+        events = [e for e in (event_as_of(sub_event, when_iso, ts) for sub_event in event['events']) if e is not None]
+        return dict(event, events=events) if events else None
+    if op == 'import':
+        return dict(event, **{key: [r for r in event[key] if (r.get('created_at') or ts) <= when_iso]
+                              for key in ('categories', 'transactions') if key in event})
+    if op in ('add_category', 'add_transaction'):
+        return event if (event['record'].get('created_at') or ts) <= when_iso else None
+    return event if ts <= when_iso else None
+
+
+LEDGER_RECORD_TYPES = {'categories': Category, 'transactions': Transaction, 'apartments': Apartment}
+
+
+def change_to_event(collection: str, record_id: int, before: Optional[Record], after: Optional[Record]) -> Dict:
+    # Событие, переводящее запись из состояния before в after: для отмены - наоборот.
+    # Квартиры не добавляются и не удаляются - только правятся
+    if collection == 'apartments':
+        return {'op': 'update_apartment', 'id': record_id, 'full_name': after.full_name, 'phone': after.phone}
+    kind = 'category' if collection == 'categories' else 'transaction'
+    if before is None:
+        return {'op': f'add_{kind}', 'record': after.to_dict()}
+    if after is None:
+        return {'op': f'delete_{kind}', 'id': record_id}
+    if kind == 'category':
+        return {'op': 'update_category', 'id': record_id, 'amount': after.amount}
+    return {'op': 'update_transaction', 'id': record_id, 'amount': after.amount, 'notes': after.notes, 'updated_at': after.updated_at}
+
+
+def affected_apartments(changes: List[Tuple]) -> Optional[Set[int]]:
+    # Квартиры, строки которых надо перерисовать; None - затронуты категории, перерисовывается всё
+    apartments = set()
+    for collection, _, old, new in changes:
+        if collection != 'transactions':
+            return None
+        apartments.update(record.apartment_id for record in (old, new) if record is not None)
+    return apartments
+
+
+class SearchIndex:
+    # Инвертированный индекс слово -> документы и префиксный индекс префикс -> слова.
+    # Ключ документа - ('apartment', id) или ('transaction', id)
+    def __init__(self):
+        self._postings = {}
+        self._prefixes = {}
+        self._doc_tokens = {}
+
+    @staticmethod
+    def terms(text: str) -> Set[str]:
+        return set(re.findall(r'\w+', text.lower()))
+
+    def tokenize(self, text: str) -> Set[str]:
+        tokens = self.terms(text)
+        # Телефон ищется и по цифрам без пробелов и скобок
+        digits = re.sub(r'\D', '', text)
+        if digits:
+            tokens.add(digits)
+        return tokens
+
+    def __len__(self) -> int:
+        return len(self._doc_tokens)
+
+    def add(self, key: Tuple[str, int], text: str):
+        self.remove(key)
+        tokens = self.tokenize(text)
+        if not tokens:
+            return
+        self._doc_tokens[key] = tokens
+        for token in tokens:
+            postings = self._postings.get(token)
+            if postings is None:
+                postings = self._postings[token] = set()
+                for i in range(1, len(token) + 1):
+                    self._prefixes.setdefault(token[:i], set()).add(token)
+            postings.add(key)
+
+    def remove(self, key: Tuple[str, int]):
+        tokens = self._doc_tokens.pop(key, None)
+        if not tokens:
+            return
+        for token in tokens:
+            postings = self._postings[token]
+            postings.discard(key)
+            if not postings:
+                del self._postings[token]
+                for i in range(1, len(token) + 1):
+                    words = self._prefixes[token[:i]]
+                    words.discard(token)
+                    if not words:
+                        del self._prefixes[token[:i]]
+
+    def search(self, query: str) -> Set[Tuple[str, int]]:
+        # Каждое слово запроса - префикс. Начинаем с самого редкого слова,
+        # остальные проверяем только по уже найденным документам
+        candidates = []
+        for term in self.terms(query):
+            tokens = self._prefixes.get(term)
+            if not tokens:
+                return set()
+            candidates.append((sum(len(self._postings[t]) for t in tokens), term, tokens))
+        if not candidates:
+            return set()
+        candidates.sort(key=lambda c: c[0])
+        result = set().union(*(self._postings[t] for t in candidates[0][2]))
+        for size, term, tokens in candidates[1:]:
+            if size <= len(result) * 4:
+                result &= set().union(*(self._postings[t] for t in tokens))
+            else:
+                result = {key for key in result if any(token.startswith(term) for token in self._doc_tokens[key])}
+            if not result:
+                break
+        return result
+
+
+class AgingIndex:
+    # Платежи гасят долги квартиры по FIFO (по created_at). Для каждой квартиры хранятся
+    # долги по возрастанию даты и курсор: первый непогашенный долг и сколько в нём уже погашено.
+    # Новый платёж или новый последний по дате долг лишь сдвигают курсор
+    def __init__(self):
+        self._debts = {}
+        self._cursor = {}
+        self._credit = {}
+
+    def rebuild(self, apartment_id: int, transactions: List[Transaction]):
+        self._debts[apartment_id] = sorted([t.created_at, t.id, t.amount] for t in transactions if t.type == 'debt')
+        self._cursor[apartment_id] = (0, 0)
+        self._credit[apartment_id] = 0
+        self._apply_payment(apartment_id, sum(t.amount for t in transactions if t.type == 'payment'))
+
+    def _apply_payment(self, apartment_id: int, amount: int):
+        debts = self._debts.setdefault(apartment_id, [])
+        index, covered = self._cursor.get(apartment_id, (0, 0))
+        amount += self._credit.get(apartment_id, 0)
+        while amount > 0 and index < len(debts):
+            need = debts[index][2] - covered
+            if amount >= need:
+                amount -= need
+                index += 1
+                covered = 0
+            else:
+                covered += amount
+                amount = 0
+        self._cursor[apartment_id] = (index, covered)
+        self._credit[apartment_id] = amount
+
+    def add(self, trans: Transaction) -> bool:
+        # False - долг задним числом, квартиру нужно пересобрать через rebuild
+        if trans.type == 'payment':
+            self._apply_payment(trans.apartment_id, trans.amount)
+            return True
+        debts = self._debts.setdefault(trans.apartment_id, [])
+        if debts and [trans.created_at, trans.id] < debts[-1][:2]:
+            return False
+        debts.append([trans.created_at, trans.id, trans.amount])
+        self._apply_payment(trans.apartment_id, 0)
+        return True
+
+    def buckets(self, apartment_id: int, today: datetime) -> Dict[str, int]:
+        result = {label: 0 for _, label in AGING_BUCKETS}
+        debts = self._debts.get(apartment_id, [])
+        index, covered = self._cursor.get(apartment_id, (0, 0))
+        for i in range(index, len(debts)):
+            created_at, _, amount = debts[i]
+            outstanding = amount - covered if i == index else amount
+            age = (today.date() - datetime.fromisoformat(created_at).date()).days
+            for limit, label in AGING_BUCKETS:
+                if limit is None or age <= limit:
+                    result[label] += outstanding
+                    break
+        return result
+
+
+class PaymentAllocations:
+    # Таблица распределения платежей: платёж сначала гасит долг своей категории, излишек -
+    # долги других категорий начиная с последней, остаток ждёт следующих начислений.
+    # Распределение записывается при добавлении платежа и пересчитывается только для квартиры,
+    # история которой изменилась задним числом
+    def __init__(self):
+        # квартира -> id платежа -> [своя категория, [[категория, сумма], ...]]
+        self.rows: Dict[int, Dict[int, List]] = {}
+        self.due: Dict[int, Dict[int, int]] = {}
+        # Нераспределённые остатки платежей, в порядке поступления
+        self.credit: Dict[int, Dict[int, int]] = {}
+        # Сколько категория получила из платежей других категорий за вычетом отданного им
+        self.received: Dict[int, Dict[int, int]] = {}
+        self.last: Dict[int, Tuple[str, int]] = {}
+
+    def rebuild(self, apartment_id: int, transactions: List[Transaction]):
+        for table in (self.rows, self.due, self.credit, self.received, self.last):
+            table.pop(apartment_id, None)
+        for trans in sorted(transactions, key=lambda t: (t.created_at, t.id)):
+            self._apply(trans)
+
+    def add(self, trans: Transaction) -> bool:
+        # False - запись старше уже распределённых, квартиру нужно пересобрать
+        if (trans.created_at, trans.id) < self.last.get(trans.apartment_id, ("", 0)):
+            return False
+        self._apply(trans)
+        return True
+
+    def _apply(self, trans: Transaction):
+        apartment_id = trans.apartment_id
+        due = self.due.setdefault(apartment_id, {})
+        credit = self.credit.setdefault(apartment_id, {})
+        self.last[apartment_id] = (trans.created_at, trans.id)
+        if trans.type == 'debt':
+            due[trans.category_id] = due.get(trans.category_id, 0) + trans.amount
+            for payment_id in list(credit):
+                if not due[trans.category_id]:
+                    break
+                self._allocate(apartment_id, payment_id, trans.category_id)
+        else:
+            self.rows.setdefault(apartment_id, {})[trans.id] = [trans.category_id, []]
+            credit[trans.id] = trans.amount
+            self._allocate(apartment_id, trans.id, trans.category_id)
+            for category_id in sorted((c for c, amount in due.items() if amount > 0), reverse=True):
+                if trans.id not in credit:
+                    break
+                self._allocate(apartment_id, trans.id, category_id)
+
+    def _allocate(self, apartment_id: int, payment_id: int, category_id: int):
+        due, credit = self.due[apartment_id], self.credit[apartment_id]
+        amount = min(due.get(category_id, 0), credit[payment_id])
+        if amount > 0:
+            due[category_id] -= amount
+            credit[payment_id] -= amount
+            own_category, allocations = self.rows[apartment_id][payment_id]
+            allocations.append([category_id, amount])
+            if category_id != own_category:
+                received = self.received.setdefault(apartment_id, {})
+                received[category_id] = received.get(category_id, 0) + amount
+                received[own_category] = received.get(own_category, 0) - amount
+        if credit[payment_id] == 0:
+            del credit[payment_id]
+
+    def apartments_with(self, category_ids: Set[int]) -> Set[int]:
+        # Квартиры, в распределении которых есть эти категории: начисления (due) или
+        # собственная категория платежа - у платежа в категорию без долгов ключа в due нет
+        return ({apartment_id for apartment_id, due in self.due.items() if category_ids & due.keys()}
+                | {apartment_id for apartment_id, rows in self.rows.items() if any(own in category_ids for own, _ in rows.values())})
+
+    def payment_apartment(self, payment_id: int) -> Optional[int]:
+        return next((apartment_id for apartment_id, rows in self.rows.items() if payment_id in rows), None)
+
+    def to_dict(self) -> Dict[str, Dict]:
+        return {str(apartment_id): {
+            'rows': [[payment_id, own, allocations] for payment_id, (own, allocations) in self.rows.get(apartment_id, {}).items()],
+            'due': list(due.items()),
+            'credit': list(self.credit.get(apartment_id, {}).items()),
+            'received': list(self.received.get(apartment_id, {}).items()),
+            'last': list(self.last[apartment_id])
+        } for apartment_id, due in self.due.items()}
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Dict]) -> 'PaymentAllocations':
+        table = cls()
+        for key, entry in data.items():
+            apartment_id = int(key)
+            table.rows[apartment_id] = {payment_id: [own, allocations] for payment_id, own, allocations in entry['rows']}
+            table.due[apartment_id] = dict(entry['due'])
+            table.credit[apartment_id] = dict(entry['credit'])
+            table.received[apartment_id] = dict(entry['received'])
+            table.last[apartment_id] = tuple(entry['last'])
+        return table
+
+
+class RollupCube:
+    # Суммы по ячейкам (месяц, категория, тип) и (месяц, квартира, тип): каждая запись
+    # журнала меняет только свои ячейки, поэтому графики не зависят от длины истории
+    def __init__(self):
+        self.cells: Dict[Tuple[str, int, str], List[int]] = {}
+        self.apartment_cells: Dict[Tuple[str, int, str], int] = {}
+
+    def apply(self, trans: Transaction, sign: int = 1):
+        month = trans.created_at[:7]
+        cell = self.cells.setdefault((month, trans.category_id, trans.type), [0, 0])
+        cell[0] += sign * trans.amount
+        cell[1] += sign
+        if cell[1] == 0:
+            del self.cells[(month, trans.category_id, trans.type)]
+        key = (month, trans.apartment_id, trans.type)
+        total = self.apartment_cells.get(key, 0) + sign * trans.amount
+        if total or sign > 0:
+            self.apartment_cells[key] = total
+        else:
+            self.apartment_cells.pop(key, None)
+
+    def month_totals(self) -> List[Tuple[str, int, int]]:
+        # [(месяц, платежи, начисления)] по возрастанию месяца
+        totals = {}
+        for (month, _, trans_type), (amount, _) in self.cells.items():
+            row = totals.setdefault(month, [0, 0])
+            row[0 if trans_type == 'payment' else 1] += amount
+        return [(month, paid, debts) for month, (paid, debts) in sorted(totals.items())]
+
+    def category_totals(self, month: str) -> Dict[int, Dict[str, int]]:
+        result = {}
+        for (cell_month, category_id, trans_type), (amount, _) in self.cells.items():
+            if cell_month == month:
+                result.setdefault(category_id, {'payment': 0, 'debt': 0})[trans_type] = amount
+        return result
+
+    def apartment_totals(self, apartment_id: int) -> List[Tuple[str, int, int]]:
+        totals = {}
+        for (month, cell_apartment, trans_type), amount in self.apartment_cells.items():
+            if cell_apartment == apartment_id:
+                row = totals.setdefault(month, [0, 0])
+                row[0 if trans_type == 'payment' else 1] += amount
+        return [(month, paid, debts) for month, (paid, debts) in sorted(totals.items())]
+
+
+class BackupStore:
+    # Хранилище с адресацией по содержимому: chunks/ab/<sha256> - сжатые блоки,
+    # snapshots/<id>.json - манифест: файл -> размер, mtime, sha256 и список блоков.
+    # Блоки режутся по строкам (граница - строка, чей crc32 попал в маску), поэтому
+    # правка в середине файла меняет только соседние блоки
+    def __init__(self, root: Path):
+        self.root = Path(root)
+        self._chunks_dir = self.root / "chunks"
+        self._snapshots_dir = self.root / "snapshots"
+
+    @staticmethod
+    def iter_chunks(data: bytes, start: int = 0):
+        chunk_start = pos = start
+        size = len(data)
+        while pos < size:
+            end = data.find(b'\n', pos)
+            end = size if end < 0 else end + 1
+            if end - chunk_start > BACKUP_CHUNK_MAX:
+                end = max(pos + 1, chunk_start + BACKUP_CHUNK_MAX)
+                pos = end
+                yield chunk_start, end
+                chunk_start = pos
+                continue
+            boundary = end - chunk_start >= BACKUP_CHUNK_MIN and (zlib.crc32(data[pos:end]) & BACKUP_CHUNK_MASK) == 0
+            pos = end
+            if boundary:
+                yield chunk_start, pos
+                chunk_start = pos
+        if chunk_start < size:
+            yield chunk_start, size
+
+    def _chunk_path(self, digest: str) -> Path:
+        return self._chunks_dir / digest[:2] / digest
+
+    def _store_chunk(self, chunk: bytes) -> str:
+        digest = hashlib.sha256(chunk).hexdigest()
+        path = self._chunk_path(digest)
+        if not path.exists():
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = path.with_suffix('.tmp')
+            with open(tmp_path, 'wb') as f:
+                f.write(zlib.compress(chunk, 6))
+            os.replace(tmp_path, path)
+        return digest
+
+    def list_snapshots(self) -> List[str]:
+        if not self._snapshots_dir.exists():
+            return []
+        return sorted(p.stem for p in self._snapshots_dir.glob("*.json"))
+
+    def load_manifest(self, snapshot_id: str) -> Dict:
+        with open(self._snapshots_dir / f"{snapshot_id}.json", 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def snapshot(self, data_dir: Path, exclude: Tuple[str, ...] = ()) -> Tuple[str, Dict[str, int]]:
+        # Неизменённые файлы (размер и mtime) не читаются; у дописанных в конец
+        # (журнал) переиспользуются все блоки, кроме последнего
+        data_dir = Path(data_dir)
+        snapshots = self.list_snapshots()
+        previous = self.load_manifest(snapshots[-1])['files'] if snapshots else {}
+        files = {}
+        stats = {'files': 0, 'read_bytes': 0, 'new_chunks': 0, 'reused_chunks': 0}
+        for path in sorted(p for p in data_dir.rglob('*') if p.is_file()):
+            name = path.relative_to(data_dir).as_posix()
+            if name in exclude or path.suffix == '.tmp':
+                continue
+            stat = path.stat()
+            prev = previous.get(name)
+            stats['files'] += 1
+            if prev and prev['size'] == stat.st_size and prev['mtime_ns'] == stat.st_mtime_ns:
+                files[name] = prev
+                stats['reused_chunks'] += len(prev['chunks'])
+                continue
+            data = path.read_bytes()
+            stats['read_bytes'] += len(data)
+            chunks = []
+            start = 0
+            if prev and prev['chunks'] and len(data) >= prev['size'] and hashlib.sha256(data[:prev['size']]).hexdigest() == prev['sha256']:
+                chunks = prev['chunks'][:-1]
+                start = prev['size'] - prev['chunks'][-1][1]
+                stats['reused_chunks'] += len(chunks)
+            for chunk_start, chunk_end in self.iter_chunks(data, start):
+                chunk = data[chunk_start:chunk_end]
+                existed = self._chunk_path(hashlib.sha256(chunk).hexdigest()).exists()
+                chunks.append([self._store_chunk(chunk), len(chunk)])
+                stats['reused_chunks' if existed else 'new_chunks'] += 1
+            files[name] = {'size': len(data), 'mtime_ns': stat.st_mtime_ns, 'sha256': hashlib.sha256(data).hexdigest(), 'chunks': chunks}
+        created_at = datetime.now()
+        snapshot_id = created_at.strftime('%Y%m%d_%H%M%S_%f')
+        self._snapshots_dir.mkdir(parents=True, exist_ok=True)
+        tmp_path = self._snapshots_dir / f"{snapshot_id}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'created_at': created_at.isoformat(), 'files': files}, f, ensure_ascii=False)
+        os.replace(tmp_path, self._snapshots_dir / f"{snapshot_id}.json")
+        return snapshot_id, stats
+
+    def restore(self, snapshot_id: str, target_dir: Path, keep: Tuple[str, ...] = ()):
+        # Файлы пишутся через временный файл; лишние файлы в target_dir удаляются,
+        # иначе снимки журнала новее восстановленного журнала сломали бы его чтение
+        target_dir = Path(target_dir)
+        files = self.load_manifest(snapshot_id)['files']
+        for name, entry in files.items():
+            path = target_dir / name
+            path.parent.mkdir(parents=True, exist_ok=True)
+            digest = hashlib.sha256()
+            tmp_path = path.with_name(path.name + '.restore')
+            with open(tmp_path, 'wb') as f:
+                for chunk_digest, _ in entry['chunks']:
+                    with open(self._chunk_path(chunk_digest), 'rb') as chunk_file:
+                        chunk = zlib.decompress(chunk_file.read())
+                    digest.update(chunk)
+                    f.write(chunk)
+            if digest.hexdigest() != entry['sha256']:
+                tmp_path.unlink()
+                raise ValueError(f"Повреждена резервная копия: {name}")
+            os.replace(tmp_path, path)
+        for path in list(target_dir.rglob('*')):
+            name = path.relative_to(target_dir).as_posix()
+            if path.is_file() and name not in files and name not in keep:
+                path.unlink()
+
+    def prune(self, keep_last: int = BACKUP_KEEP_LAST, keep_daily: int = BACKUP_KEEP_DAILY) -> int:
+        # Хранятся последние keep_last копий и последняя копия каждого дня за keep_daily дней;
+        # затем удаляются блоки, на которые больше не ссылается ни один манифест
+        snapshots = self.list_snapshots()
+        keep = set(snapshots[-keep_last:]) if keep_last else set()
+        days = {}
+        for snapshot_id in snapshots:
+            days[snapshot_id[:8]] = snapshot_id
+        keep.update(sorted(days.values())[-keep_daily:] if keep_daily else [])
+        removed = [snapshot_id for snapshot_id in snapshots if snapshot_id not in keep]
+        for snapshot_id in removed:
+            (self._snapshots_dir / f"{snapshot_id}.json").unlink()
+        if removed:
+            referenced = set()
+            for snapshot_id in keep:
+                for entry in self.load_manifest(snapshot_id)['files'].values():
+                    referenced.update(digest for digest, _ in entry['chunks'])
+            for path in self._chunks_dir.glob('*/*'):
+                if path.name not in referenced:
+                    path.unlink()
+        return len(removed)
+
+
+class IntegrityScanner:
+    # Потоковая проверка записей по одной: в памяти только id категорий и квартир
+    # и битовая карта встреченных id (бит на запись), сами записи не накапливаются
+    def __init__(self, category_ids: Set[int], apartment_ids: Set[int]):
+        self.category_ids = category_ids
+        self.apartment_ids = apartment_ids
+        self._seen = bytearray()
+
+    def seen_before(self, record_id: int) -> bool:
+        byte, bit = divmod(record_id, 8)
+        if byte >= len(self._seen):
+            self._seen.extend(bytes(byte - len(self._seen) + 4096))
+        if self._seen[byte] >> bit & 1:
+            return True
+        self._seen[byte] |= 1 << bit
+        return False
+
+    def is_seen(self, record_id: int) -> bool:
+        byte, bit = divmod(record_id, 8)
+        return byte < len(self._seen) and bool(self._seen[byte] >> bit & 1)
+
+    def forget(self, record_id: int):
+        byte, bit = divmod(record_id, 8)
+        if byte < len(self._seen):
+            self._seen[byte] &= ~(1 << bit) & 0xFF
+
+    def check(self, trans: Transaction):
+        # Свойства текущей записи; повторы id ищет JournalIdScanner по журналу
+        if not isinstance(trans.id, int) or trans.id < 0:
+            yield {'kind': 'bad_id', 'id': trans.id, 'message': f"Транзакция с некорректным id {trans.id!r}"}
+            return
+        if trans.category_id not in self.category_ids:
+            yield {'kind': 'orphan', 'id': trans.id, 'message': f"Транзакция {trans.id}: нет категории {trans.category_id}"}
+        if trans.apartment_id not in self.apartment_ids:
+            yield {'kind': 'unknown_apartment', 'id': trans.id, 'message': f"Транзакция {trans.id}: нет квартиры {trans.apartment_id}"}
+        if not isinstance(trans.amount, int) or trans.amount < 0:
+            yield {'kind': 'bad_amount', 'id': trans.id, 'message': f"Транзакция {trans.id}: некорректная сумма {trans.amount!r}"}
+        if trans.type not in ('payment', 'debt'):
+            yield {'kind': 'bad_type', 'id': trans.id, 'message': f"Транзакция {trans.id}: неизвестный тип {trans.type!r}"}
+
+
+class JournalIdScanner:
+    # Потоковая проверка добавлений в журнале: запись не должна добавляться с id живой записи
+    # (повторное добавление молча затирает её в состоянии). Живые id - битовые карты;
+    # для каскадного удаления категории - категория каждой транзакции в массиве по id
+    def __init__(self):
+        self.categories = IntegrityScanner(set(), set())
+        self.transactions = IntegrityScanner(set(), set())
+        self._category_of = array('q')
+
+    def apply(self, event: Dict):
+        # Выдаёт (коллекция, id) для каждого повторного добавления
+        op = event['op']
+        if op == 'batch':
+            for sub_event in event['events']:
+                yield from self.apply(sub_event)
+        elif op == 'import':
+            for data in event.get('categories', ()):
+                yield from self._add('categories', data['id'])
+            for data in event.get('transactions', ()):
+                yield from self._add('transactions', data['id'], data['category_id'])
+        elif op == 'add_category':
+            yield from self._add('categories', event['record']['id'])
+        elif op == 'add_transaction':
+            record = event['record']
+            # Платёж в удалённую категорию не применяется - и повтором не считается
+            if isinstance(record['category_id'], int) and self.categories.is_seen(record['category_id']):
+                yield from self._add('transactions', record['id'], record['category_id'])
+        elif op == 'delete_transaction':
+            self.transactions.forget(event['id'])
+        elif op == 'delete_category':
+            self.categories.forget(event['id'])
+            for trans_id, category_id in enumerate(self._category_of):
+                if category_id == event['id']:
+                    self.transactions.forget(trans_id)
+
+    def _add(self, collection: str, record_id: Any, category_id: int = -1):
+        if not isinstance(record_id, int) or record_id < 0:
+            return
+        if getattr(self, collection).seen_before(record_id):
+            yield collection, record_id
+        if collection == 'transactions':
+            if record_id >= len(self._category_of):
+                self._category_of.extend([-1] * (record_id - len(self._category_of) + 4096))
+            self._category_of[record_id] = category_id
+
+
+class FileLock:
+    # Межпроцессная блокировка на файле. Повторный вход из того же потока не блокирует,
+    # другие потоки этого процесса ждут на обычной блокировке
+    def __init__(self, path: Path):
+        self.path = path
+        self._thread_lock = threading.RLock()
+        self._depth = 0
+        self._file = None
+
+    def __enter__(self):
+        self._thread_lock.acquire()
+        if self._depth == 0:
+            try:
+                self._file = open(self.path, 'a+b')
+                if fcntl:
+                    fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+                else:
+                    self._file.seek(0)
+                    while True:
+                        try:
+                            msvcrt.locking(self._file.fileno(), msvcrt.LK_LOCK, 1)
+                            break
+                        except OSError:
+                            pass
+            except BaseException:
+                if self._file:
+                    self._file.close()
+                    self._file = None
+                self._thread_lock.release()
+                raise
+        self._depth += 1
+        return self
+
+    def __exit__(self, *exc):
+        self._depth -= 1
+        if self._depth == 0:
+            if fcntl:
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+            else:
+                self._file.seek(0)
+                msvcrt.locking(self._file.fileno(), msvcrt.LK_UNLCK, 1)
+            self._file.close()
+            self._file = None
+        self._thread_lock.release()
+        return False
+
+
+def locked(method):
+    # Проверка состояния и запись выполняются под блокировкой каталога данных,
+    # чтобы параллельные процессы не выдали одинаковые id и не затёрли файлы друг друга
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
 class Database:
     def __init__(self, data_dir: str = "data"):
         self.data_dir = Path(data_dir)
         self.data_dir.mkdir(exist_ok=True)
+        self._lock = FileLock(self.data_dir / "data.lock")
         self._files = {
             'users': self.data_dir / "users.json",
             'categories': self.data_dir / "categories.json",
             'transactions': self.data_dir / "transactions.json",
-            'apartments': self.data_dir / "apartments.json"
+            'apartments': self.data_dir / "apartments.json",
+            'recurring': self.data_dir / "recurring.json",
+            'readings': self.data_dir / "readings.json",
+            'tariffs': self.data_dir / "tariffs.json",
+            'meta': self.data_dir / "meta.json",
+            'replication': self.data_dir / "replication.json",
+            'allocations': self.data_dir / "allocations.json",
+            'summary': self.data_dir / "summary.json"
         }
+        # categories.json и transactions.json - только источник для миграции в журнал,
+        # apartments.json - тоже (v6), но создаётся для новой базы как начальный список квартир
+        self._legacy_files = {'categories', 'transactions'}
+        self._journal_path = self.data_dir / "journal.jsonl"
+        # Журнал команд для отмены/повтора: дозапись действий do / undo / redo
+        self._commands_path = self.data_dir / "commands.jsonl"
+        self._commands_position = (None, 0)
+        self._undo_stack: List[Dict] = []
+        self._redo_stack: List[Dict] = []
+        self._snapshot_dir = self.data_dir / "snapshots"
+        # Миграции по порядку: i-я миграция переводит схему с версии i на i + 1
+        self._migrations = [self._migrate_category_months, self._migrate_amounts_to_kopecks, self._migrate_to_journal, self._migrate_referential_integrity, self._migrate_password_hashes, self._migrate_apartments_to_journal]
+        self._summary_signature = None
+        # Подписчики на изменения журнала: получают список (коллекция, id, было, стало)
+        self._ledger_listeners = [self._track_issued_ids, self._index_apartment_transactions, self._index_ledger_changes, self._age_ledger_changes, self._cube_ledger_changes, self._allocate_ledger_changes]
+        self._search_index = None
+        self._aging = None
+        self._cube = None
+        self._allocations = None
+        self._allocations_saved = None
+        self.last_write_error: Optional[str] = None
+        # Каталог пользователей: индексы по имени и id, перечитываются только при изменении файла
+        self._users_signature = None
+        self._users_by_name: Dict[str, User] = {}
+        self._users_by_id: Dict[int, User] = {}
+        # Настройки узла репликации, перечитываются при изменении файла
+        self._replication_signature = None
+        self._replication_state: Dict = {}
+        # Сессии: токен -> (id пользователя, срок действия); хранятся только в памяти процесса
+        self._sessions: Dict[str, Tuple[int, float]] = {}
+        # Диагностика: последняя длительность каждой операции, недавние операции, попадания в кэши
+        self._timings: Dict[str, float] = {}
+        self._recent_ops = deque(maxlen=DIAGNOSTICS_RECENT_OPS)
+        self._cache_stats = {'summary': [0, 0], 'search_index': [0, 0], 'aging_index': [0, 0], 'rollup_cube': [0, 0], 'allocations': [0, 0]}
         self._init_files()
+        self._open_ledger()
+        self.run_migrations()
 
     def _init_files(self):
         for key, filepath in self._files.items():
-            if not filepath.exists():
+            if not filepath.exists() and key not in self._legacy_files:
                 if key == 'apartments':
                     data = [{"id": i, "number": i + 1, "full_name": "", "phone": ""} for i in range(10)]
                 elif key == 'users':
                     #  Создаём администратора с правильной ролью
-                    data = [{'id': 1, 'username': 'admin', 'password': 'admin', 'role': 'admin', 'created_at': datetime.now().isoformat()}]
+                    data = [{'id': 1, 'username': 'admin', 'password_hash': hash_password('admin'), 'role': 'admin', 'created_at': datetime.now().isoformat()}]
+                elif key in ('meta', 'summary', 'tariffs', 'allocations'):
+                    data = {}
+                elif key == 'replication':
+                    # Узел 0 - основной; клоны получают следующие номера
+                    data = {'cluster': secrets.token_hex(8), 'node': secrets.token_hex(4), 'number': 0, 'step': 1, 'next_number': 1, 'peers': {}}
                 else:
                     data = []
                 self._save(key, data)
 
     def _load(self, key: str) -> Any:
+        started = time.perf_counter()
         try:
             with open(self._files[key], 'r', encoding='utf-8') as f:
                 return json.load(f)
         except:
             return []
+        finally:
+            self._record_timing(f"load:{key}", started)
 
     def _save(self, key: str, data: Any) -> bool:
+        # Запись во временный файл и замена: читатель никогда не видит недописанный JSON
+        started = time.perf_counter()
+        path = self._files[key]
+        tmp_path = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
         try:
-            with open(self._files[key], 'w', encoding='utf-8') as f:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
                 json.dump(data, f, indent=2, ensure_ascii=False)
+            os.replace(tmp_path, path)
             return True
         except:
             return False
+        finally:
+            self._record_timing(f"save:{key}", started)
+
+    # --- Диагностика ---
+
+    def _record_timing(self, name: str, started: float):
+        elapsed = (time.perf_counter() - started) * 1000
+        self._timings[name] = elapsed
+        self._recent_ops.append((elapsed, name, datetime.now().strftime('%H:%M:%S')))
+
+    def _count_cache(self, name: str, hit: bool):
+        self._cache_stats[name][0 if hit else 1] += 1
+
+    @staticmethod
+    def _file_size(path: Path) -> int:
+        try:
+            return path.stat().st_size
+        except OSError:
+            return 0
+
+    def get_diagnostics(self, slowest: int = 10) -> Dict:
+        self._catch_up()
+        collections = []
+        for key in ('users', 'recurring', 'readings'):
+            collections.append({'name': key, 'rows': len(self._load(key)), 'size': self._file_size(self._files[key]),
+                                'load_ms': self._timings.get(f"load:{key}"), 'save_ms': self._timings.get(f"save:{key}")})
+        # Категории, транзакции и квартиры живут в журнале: загрузка - восстановление из снимка, запись - дозапись событий
+        for key in ('categories', 'transactions', 'apartments'):
+            collections.append({'name': key, 'rows': len(self._ledger[key]), 'size': None,
+                                'load_ms': self._timings.get('open_ledger'), 'save_ms': self._timings.get('append_events')})
+        collections.append({'name': 'journal', 'rows': self._seq, 'size': self._file_size(self._journal_path),
+                            'load_ms': self._timings.get('catch_up'), 'save_ms': self._timings.get('append_events')})
+        snapshots = self._snapshot_paths()
+        collections.append({'name': 'snapshots', 'rows': len(snapshots), 'size': sum(self._file_size(p) for p in snapshots),
+                            'load_ms': self._timings.get('load_snapshot'), 'save_ms': self._timings.get('write_snapshot')})
+        return {
+            'collections': collections,
+            'caches': {name: tuple(stats) for name, stats in self._cache_stats.items()},
+            'slowest': sorted(self._recent_ops, reverse=True)[:slowest],
+            'events_since_snapshot': self._seq - self._snapshot_seq
+        }
+
+    def prune_snapshots(self) -> Dict[str, int]:
+        # Свежий снимок, чтобы запуск не переигрывал хвост журнала, и прореживание старых снимков.
+        # Сам журнал не обрезается - по нему работают запросы на дату и другие процессы,
+        # читающие его по смещению
+        self._catch_up()
+        started = time.perf_counter()
+        if self._seq > self._snapshot_seq or not self._snapshot_paths():
+            self._write_snapshot()
+        removed, freed = self._remove_old_snapshots()
+        self._record_timing('prune_snapshots', started)
+        return {'removed_snapshots': removed, 'freed_bytes': freed}
+
+    def _remove_old_snapshots(self) -> Tuple[int, int]:
+        # Остаются последние SNAPSHOT_KEEP_LAST снимков и последний снимок каждого дня
+        # за SNAPSHOT_KEEP_DAILY дней; (удалено, освобождено байт)
+        paths = self._snapshot_paths()
+        keep = set(paths[-SNAPSHOT_KEEP_LAST:])
+        by_day = {}
+        for path in paths:
+            try:
+                by_day[datetime.fromtimestamp(path.stat().st_mtime).date()] = path
+            except OSError:
+                continue
+        keep.update(path for _, path in sorted(by_day.items())[-SNAPSHOT_KEEP_DAILY:])
+        removed = freed = 0
+        for path in paths:
+            if path not in keep:
+                freed += self._file_size(path)
+                path.unlink(missing_ok=True)
+                removed += 1
+        return removed, freed
+
+    def rebuild_indexes(self) -> float:
+        # Полная пересборка состояния журнала, индексов и сохранённых итогов
+        started = time.perf_counter()
+        self._search_index = None
+        self._aging = None
+        self._cube = None
+        self._allocations = None
+        self._summary_signature = None
+        self._open_ledger()
+        self._get_search_index()
+        self._get_aging_index()
+        self._allocations = self._build_allocations()
+        self._allocations_saved = None
+        self._save_summary(self.get_all_distributions())
+        self._record_timing('rebuild_indexes', started)
+        return time.perf_counter() - started
+
+    def scan_integrity(self):
+        # Генератор проблем {'kind', 'id', 'message'}; журнал и снимки читаются построчно
+        started = time.perf_counter()
+        last_seq = 0
+        journal_ids = JournalIdScanner()
+        try:
+            with open(self._journal_path, 'rb') as f:
+                for line_no, line in enumerate(f, 1):
+                    if not line.endswith(b'\n'):
+                        yield {'kind': 'journal_torn', 'id': line_no, 'message': f"Журнал: недописанная строка {line_no}"}
+                        break
+                    try:
+                        event = json.loads(line)
+                        seq = event['seq']
+                        duplicates = list(journal_ids.apply(event))
+                    except (ValueError, KeyError, TypeError):
+                        yield {'kind': 'journal_corrupt', 'id': line_no, 'message': f"Журнал: повреждённая строка {line_no} (нужна ручная правка или восстановление из копии)"}
+                        continue
+                    if seq != last_seq + 1:
+                        yield {'kind': 'journal_seq', 'id': line_no, 'message': f"Журнал: строка {line_no} имеет seq {seq}, ожидался {last_seq + 1}"}
+                    last_seq = seq
+                    for collection, record_id in duplicates:
+                        what = "категория" if collection == 'categories' else "транзакция"
+                        yield {'kind': 'duplicate', 'id': record_id, 'message': f"Журнал, строка {line_no}: повторно добавлена {what} {record_id} поверх существующей"}
+        except OSError as e:
+            yield {'kind': 'journal_unreadable', 'id': None, 'message': f"Журнал не читается: {e}"}
+        for path in self._snapshot_paths():
+            yield from self._scan_snapshot(path)
+        try:
+            self._catch_up()
+        except ValueError:
+            # Повреждённая строка уже в списке; проверяется состояние до неё
+            pass
+        scanner = IntegrityScanner(set(self._ledger['categories']), {apt.id for apt in self._apartments()})
+        for trans in self._ledger['transactions'].values():
+            yield from scanner.check(trans)
+        usernames = [user.get('username') for user in self._load('users')]
+        for username in {u for u in usernames if usernames.count(u) > 1}:
+            yield {'kind': 'duplicate_user', 'id': username, 'message': f"Пользователь {username} встречается несколько раз"}
+        self._record_timing('scan_integrity', started)
+
+    def _scan_snapshot(self, path: Path):
+        # Снимок пишется по записи на строку - повторы id ищутся без загрузки файла целиком
+        scanners = {}
+        collection = None
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                first = f.readline()
+                if first.rstrip().endswith('}'):
+                    # Снимок старого формата одной строкой
+                    json.loads(first)
+                    return
+                json.loads(first[:first.index(', "categories": [')] + '}')
+                stripped = ''
+                for line in f:
+                    stripped = line.strip()
+                    if stripped.endswith('['):
+                        collection = stripped.split('"')[1]
+                        scanners[collection] = IntegrityScanner(set(), set())
+                    elif stripped.startswith('{') and collection:
+                        record_id = json.loads(stripped.rstrip(','))['id']
+                        if scanners[collection].seen_before(record_id):
+                            yield {'kind': 'snapshot_duplicate', 'id': path.name, 'message': f"Снимок {path.name}: повтор id {record_id} в {collection}"}
+                if stripped != ']}':
+                    # Оборван на середине: записи после обрыва потеряны
+                    raise ValueError(path.name)
+        except (OSError, ValueError, KeyError, IndexError):
+            yield {'kind': 'snapshot_corrupt', 'id': path.name, 'message': f"Снимок {path.name} повреждён"}
+
+    def check_integrity(self) -> List[str]:
+        return [problem['message'] for problem in self.scan_integrity()]
+
+    @locked
+    def repair_integrity(self, kinds: Optional[Set[str]] = None) -> Dict[str, int]:
+        # Исправимое исправляется: недописанный хвост журнала обрезается, плохие снимки удаляются
+        # (состояние пересобирается по журналу), транзакции-сироты удаляются одним пакетом.
+        # Некорректные суммы только показываются: деньги по догадке не переписываются.
+        # kinds - какие виды проблем исправлять (None - все исправимые)
+        repaired = {}
+        bad_snapshots = set()
+        trans_events = {}
+        for problem in self.scan_integrity():
+            kind = problem['kind']
+            if kinds is not None and kind not in kinds:
+                continue
+            if kind == 'journal_torn':
+                with open(self._journal_path, 'rb+') as f:
+                    data = f.read()
+                    f.truncate(data.rfind(b'\n') + 1)
+            elif kind in ('snapshot_corrupt', 'snapshot_duplicate'):
+                bad_snapshots.add(problem['id'])
+            elif kind in ('orphan', 'unknown_apartment', 'bad_type'):
+                trans_events[problem['id']] = {'op': 'delete_transaction', 'id': problem['id']}
+            else:
+                continue
+            repaired[kind] = repaired.get(kind, 0) + 1
+        if bad_snapshots:
+            for name in bad_snapshots:
+                (self._snapshot_dir / name).unlink(missing_ok=True)
+            self._open_ledger()
+            self._search_index = None
+            self._aging = None
+            self._cube = None
+            self._allocations = None
+        if trans_events:
+            self._append_events([{'op': 'batch', 'events': list(trans_events.values())}], undoable=False, checked=False)
+        return repaired
+
+    def get_schema_version(self) -> int:
+        meta = self._load('meta')
+        return meta.get('schema_version', 0) if isinstance(meta, dict) else 0
+
+    @locked
+    def run_migrations(self) -> int:
+        meta = self._load('meta')
+        if not isinstance(meta, dict):
+            meta = {}
+        version = meta.get('schema_version', 0)
+        for target, migration in enumerate(self._migrations, start=1):
+            if version < target:
+                migration()
+                version = target
+                meta['schema_version'] = version
+                meta['migrated_at'] = datetime.now().isoformat()
+                self._save('meta', meta)
+        return version
+
+    def _migrate_category_months(self):
+        # v1: у всех категорий в названии есть месяц и год
+        categories = self._load('categories')
+        now = datetime.now()
+        month_name = MONTHS_RU[now.month]
+        year = now.year
+        needs_update = False
+        for cat in categories:
+            if not any(month in cat['name'] for month in MONTHS_RU.values()):
+                cat['name'] = f"{cat['name']} {month_name} {year}"
+                needs_update = True
+        if needs_update:
+            self._save('categories', categories)
+
+    def _migrate_amounts_to_kopecks(self):
+        # v2: суммы в копейках вместо float-рублей
+        for key in ('categories', 'transactions'):
+            if not self._files[key].exists():
+                continue
+            records = self._load(key)
+            for record in records:
+                record['amount'] = parse_money(record['amount'])
+            self._save(key, records)
+
+    def _migrate_to_journal(self):
+        # v3: категории и транзакции переезжают в журнал событий, старые файлы остаются как есть
+        categories = self._load('categories') if self._files['categories'].exists() else []
+        transactions = self._load('transactions') if self._files['transactions'].exists() else []
+        if categories or transactions:
+            self._append_events([{'op': 'import', 'categories': categories, 'transactions': transactions}])
+            self._write_snapshot()
+
+    def _migrate_referential_integrity(self):
+        # v4: ссылки проверяются при записи; транзакции без категории, накопленные раньше,
+        # удаляются один раз. Остальное (например, отрицательные суммы) - на усмотрение оператора
+        self.repair_integrity({'orphan'})
+
+    def _migrate_password_hashes(self):
+        # v5: открытые пароли заменяются солёными хешами
+        users = self._load('users')
+        for user in users:
+            if 'password' in user:
+                user['password_hash'] = hash_password(user.pop('password'))
+        self._save('users', users)
+
+    def _migrate_apartments_to_journal(self):
+        # v6: квартиры переезжают в журнал, чтобы их правки реплицировались вместе с платежами
+        apartments = self._load('apartments')
+        if apartments:
+            self._append_events([{'op': 'import', 'apartments': apartments}])
+
+    # --- Резервные копии ---
+
+    def get_backup_store(self) -> BackupStore:
+        return BackupStore(self.data_dir.parent / "backups")
+
+    def create_backup(self) -> Tuple[str, Dict[str, int]]:
+        store = self.get_backup_store()
+        result = store.snapshot(self.data_dir, exclude=(self._files['summary'].name, self._lock.path.name))
+        store.prune()
+        return result
+
+    @locked
+    def restore_backup(self, snapshot_id: str):
+        # Настройки репликации остаются текущими, но узел продолжает под новым именем:
+        # номера его прежних событий уже могли уйти на другие узлы, повторно выдавать их нельзя
+        replication = dict(self._get_replication(), node=secrets.token_hex(4))
+        self.get_backup_store().restore(snapshot_id, self.data_dir, keep=(self._files['summary'].name, self._lock.path.name))
+        self._save_replication(replication)
+        self._open_ledger()
+        self._search_index = None
+        self._aging = None
+        self._cube = None
+        self._allocations = None
+
+    # --- Репликация ---
+
+    def _get_replication(self) -> Dict:
+        try:
+            stat = self._files['replication'].stat()
+            signature = (stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            signature = None
+        if signature != self._replication_signature:
+            self._replication_state = self._load('replication')
+            self._replication_signature = signature
+        return self._replication_state
+
+    def _save_replication(self, state: Dict) -> bool:
+        if not self._save('replication', state):
+            return False
+        self._replication_signature = None
+        return True
+
+    def get_replication_info(self) -> Dict:
+        self._catch_up()
+        state = self._get_replication()
+        return {'node': state['node'], 'number': state['number'], 'clock': dict(self._clock), 'peers': state['peers']}
+
+    @locked
+    def clone_replica(self, target_dir: str) -> str:
+        # Копия базы для другого рабочего места: общий журнал, новый узел со своим остатком id.
+        # Журнал команд отмены и кэши не копируются
+        state = self._get_replication()
+        if state['number'] != 0:
+            raise ValueError("Клонировать можно только основной узел")
+        if state['next_number'] >= REPLICATION_ID_STEP:
+            raise ValueError(f"Не больше {REPLICATION_ID_STEP} узлов")
+        target = Path(target_dir)
+        if target.exists() and any(target.iterdir()):
+            raise ValueError(f"Папка {target} не пуста")
+        self._catch_up()
+        self._write_snapshot()
+        skip = {self._lock.path.name, self._files['summary'].name, self._files['replication'].name, self._commands_path.name}
+        target.mkdir(parents=True, exist_ok=True)
+        for path in self.data_dir.iterdir():
+            if path.name in skip or path.suffix == '.tmp':
+                continue
+            if path.is_dir():
+                shutil.copytree(path, target / path.name)
+            else:
+                shutil.copy2(path, target / path.name)
+        node = secrets.token_hex(4)
+        now = datetime.now().isoformat()
+        replica = {'cluster': state['cluster'], 'node': node, 'number': state['next_number'], 'step': REPLICATION_ID_STEP, 'next_number': None,
+                   'peers': {state['node']: {'clock': dict(self._clock), 'synced_at': now}}}
+        with open(target / self._files['replication'].name, 'w', encoding='utf-8') as f:
+            json.dump(replica, f, indent=2, ensure_ascii=False)
+        state = dict(state, step=REPLICATION_ID_STEP, next_number=state['next_number'] + 1,
+                     peers=dict(state['peers'], **{node: {'clock': dict(self._clock), 'synced_at': now}}))
+        self._save_replication(state)
+        return node
+
+    def _snapshot_header(self, path: Path) -> Optional[Dict]:
+        # Первая строка снимка - заголовок без закрывающей скобки, дальше по записи на строку
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                first = f.readline()
+            if first.rstrip().endswith('}'):
+                return json.loads(first)
+            return json.loads(first[:first.index(', "categories": [')] + '}')
+        except (OSError, ValueError):
+            return None
+
+    def _sync_start_offset(self, known: Dict[str, int]) -> int:
+        # Точка синхронизации - последний снимок, все события которого узлу уже известны:
+        # журнал читается только после неё
+        for path in reversed(self._snapshot_paths()):
+            header = self._snapshot_header(path)
+            if header and all(nseq <= known.get(node, 0) for node, nseq in header.get('clock', {}).items()):
+                return header['journal_offset']
+        return 0
+
+    def export_sync_bundle(self, path: str) -> int:
+        # Пакет для всех известных узлов: события, которых нет хотя бы у одного из них
+        self._catch_up()
+        state = self._get_replication()
+        peers = [peer['clock'] for peer in state['peers'].values()]
+        known = {node: min(clock.get(node, 0) for clock in peers) for node in self._clock} if peers else {}
+        started = time.perf_counter()
+        header = {'format': SYNC_BUNDLE_FORMAT, 'cluster': state['cluster'], 'node': state['node'], 'clock': self._clock, 'created_at': datetime.now().isoformat()}
+        count = 0
+        tmp_path = Path(f"{path}.tmp")
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(json.dumps(header, ensure_ascii=False) + '\n')
+            for offset, event in self._read_journal(self._sync_start_offset(known)):
+                if offset > self._journal_offset:
+                    break
+                if 'node' in event and event['nseq'] > known.get(event['node'], 0):
+                    f.write(json.dumps(event, ensure_ascii=False) + '\n')
+                    count += 1
+        os.replace(tmp_path, path)
+        self._record_timing('export_sync_bundle', started)
+        return count
+
+    @locked
+    def import_sync_bundle(self, path: str) -> Dict[str, Any]:
+        # События каждого узла применяются строго по порядку номеров; уже известные пропускаются
+        state = self._get_replication()
+        with open(path, 'r', encoding='utf-8') as f:
+            header = json.loads(f.readline())
+            if header.get('format') != SYNC_BUNDLE_FORMAT:
+                raise ValueError("Это не пакет синхронизации")
+            if header['cluster'] != state['cluster']:
+                raise ValueError("Пакет от базы, не связанной с этой (не клон)")
+            if header['node'] == state['node']:
+                raise ValueError("Пакет выгружен с этого же узла")
+            started = time.perf_counter()
+            self._catch_up()
+            clock = dict(self._clock)
+            accepted = []
+            skipped = 0
+            for line in f:
+                event = json.loads(line)
+                node, nseq = event['node'], event['nseq']
+                if nseq == clock.get(node, 0) + 1:
+                    accepted.append(event)
+                    clock[node] = nseq
+                else:
+                    skipped += 1
+        if accepted and not self._append_events(accepted, undoable=False, checked=False, remote=True):
+            raise OSError("Не удалось дописать журнал")
+        peers = dict(state['peers'])
+        peers[header['node']] = {'clock': header['clock'], 'synced_at': datetime.now().isoformat()}
+        self._save_replication(dict(state, peers=peers))
+        self._record_timing('import_sync_bundle', started)
+        return {'from': header['node'], 'applied': len(accepted), 'skipped': skipped}
+
+    # --- Журнал событий и снимки ---
+
+    def _open_ledger(self):
+        # Последний снимок + хвост журнала после него
+        started = time.perf_counter()
+        self._ledger = empty_ledger()
+        self._seq = 0
+        self._journal_offset = 0
+        self._snapshot_seq = 0
+        # Векторные часы: номер последнего применённого события каждого узла
+        self._clock: Dict[str, int] = {}
+        snapshot = self._load_snapshot(self._latest_snapshot_path())
+        if snapshot:
+            self._ledger = snapshot['ledger']
+            self._seq = self._snapshot_seq = snapshot['seq']
+            self._journal_offset = snapshot['journal_offset']
+            self._clock = dict(snapshot['clock'])
+        # Наибольший id, когда-либо появлявшийся в каждой коллекции, - с удалёнными записями.
+        # Снимки старого формата его не хранят: тогда берётся по существующим записям
+        self._issued_ids = {key: max(records, default=0) for key, records in self._ledger.items()}
+        if snapshot and snapshot['issued']:
+            self._issued_ids.update(snapshot['issued'])
+        # Индекс квартира -> id транзакций, поддерживается по изменениям журнала
+        self._by_apartment = {}
+        for trans in self._ledger['transactions'].values():
+            self._by_apartment.setdefault(trans.apartment_id, set()).add(trans.id)
+        self._catch_up()
+        self._record_timing('open_ledger', started)
+
+    def _snapshot_paths(self) -> List[Path]:
+        if not self._snapshot_dir.exists():
+            return []
+        return sorted(self._snapshot_dir.glob("ledger_*.json"))
+
+    def _latest_snapshot_path(self) -> Optional[Path]:
+        paths = self._snapshot_paths()
+        return paths[-1] if paths else None
+
+    def _load_snapshot(self, path: Optional[Path]) -> Optional[Dict]:
+        if path is None:
+            return None
+        started = time.perf_counter()
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        ledger = {
+            'categories': {r['id']: Category.from_dict(r) for r in data['categories']},
+            'transactions': {r['id']: Transaction.from_dict(r) for r in data['transactions']},
+            'apartments': {r['id']: Apartment.from_dict(r) for r in data.get('apartments', ())}
+        }
+        self._record_timing('load_snapshot', started)
+        return {'seq': data['seq'], 'ts': data['ts'], 'journal_offset': data['journal_offset'], 'clock': data.get('clock', {}),
+                'issued': data.get('issued', {}), 'ledger': ledger}
+
+    def _write_snapshot(self) -> Optional[Path]:
+        started = time.perf_counter()
+        self._snapshot_dir.mkdir(exist_ok=True)
+        path = self._snapshot_dir / f"ledger_{self._seq:010d}.json"
+        header = {'seq': self._seq, 'ts': datetime.now().isoformat(), 'journal_offset': self._journal_offset, 'clock': self._clock, 'issued': self._issued_ids}
+        tmp_path = path.with_suffix('.tmp')
+        try:
+            # Валидный JSON, но по записи на строку: соседние снимки почти целиком
+            # совпадают построчно и дедуплицируются в резервных копиях
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(json.dumps(header, ensure_ascii=False)[:-1])
+                for key, records in self._ledger.items():
+                    f.write(f', "{key}": [\n')
+                    f.write(',\n'.join(json.dumps(r.to_dict(), ensure_ascii=False) for r in records.values()))
+                    f.write('\n]')
+                f.write('}\n')
+            os.replace(tmp_path, path)
+        except OSError:
+            return None
+        self._snapshot_seq = self._seq
+        self._record_timing('write_snapshot', started)
+        self._save_allocations()
+        return path
+
+    def _read_journal(self, offset: int):
+        # (смещение после строки, событие); недописанная последняя строка пропускается
+        try:
+            f = open(self._journal_path, 'rb')
+        except OSError:
+            return
+        with f:
+            f.seek(offset)
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                offset += len(line)
+                yield offset, json.loads(line)
+
+    def _catch_up(self):
+        # Подхватывает события, дописанные в журнал другими процессами
+        try:
+            size = self._journal_path.stat().st_size
+        except OSError:
+            return
+        if size == self._journal_offset:
+            return
+        started = time.perf_counter()
+        changes = []
+        for offset, event in self._read_journal(self._journal_offset):
+            apply_ledger_event(self._ledger, event, changes)
+            self._seq = event['seq']
+            self._journal_offset = offset
+            if 'node' in event:
+                self._clock[event['node']] = event['nseq']
+        self._notify_ledger_changes(changes)
+        self._record_timing('catch_up', started)
+
+    @locked
+    def _check_references(self, events: List[Dict]) -> Optional[str]:
+        # Внешние ключи: транзакция ссылается на существующие категорию и квартиру,
+        # суммы неотрицательны, добавляемый id не занят живой записью (иначе она была бы затёрта).
+        # Удаление категории каскадно удаляет её транзакции в apply_ledger_event
+        categories = set(self._ledger['categories'])
+        transactions = self._ledger['transactions']
+        live = set(transactions)
+        apartments = {apt.id for apt in self.get_all_apartments()}
+
+        def check(event):
+            op = event['op']
+            if op == 'batch':
+                return next((error for error in map(check, event['events']) if error), None)
+            if op == 'add_category':
+                if event['record']['id'] in categories:
+                    return f"категория {event['record']['id']} уже существует"
+                categories.add(event['record']['id'])
+            elif op == 'delete_category':
+                categories.discard(event['id'])
+            elif op == 'add_transaction':
+                record = event['record']
+                if record['id'] in live:
+                    return f"транзакция {record['id']} уже существует"
+                live.add(record['id'])
+                if record['category_id'] not in categories:
+                    return f"нет категории {record['category_id']}"
+                if record['apartment_id'] not in apartments:
+                    return f"нет квартиры {record['apartment_id']}"
+                if record['amount'] < 0:
+                    return "отрицательная сумма"
+            elif op == 'delete_transaction':
+                live.discard(event['id'])
+            elif op == 'update_transaction' and event['amount'] < 0:
+                return "отрицательная сумма"
+            elif op == 'update_transaction' and transactions.get(event['id']) and transactions[event['id']].category_id not in categories:
+                return f"нет категории {transactions[event['id']].category_id}"
+            return None
+
+        return next((error for error in map(check, events) if error), None)
+
+    def _append_events(self, events: List[Dict], undoable: bool = True, checked: bool = True, remote: bool = False, label: Optional[str] = None) -> bool:
+        # Свои события получают метку узла и его порядковый номер; пришедшие с другого
+        # узла (remote) сохраняют исходные время, узел и номер - меняется только seq журнала
+        self._catch_up()
+        # Причина последнего отказа в записи - для сообщения пользователю
+        self.last_write_error = self._check_references(events) if checked else None
+        if self.last_write_error:
+            return False
+        started = time.perf_counter()
+        now = datetime.now().isoformat()
+        node = self._get_replication()['node']
+        nseq = self._clock.get(node, 0)
+        stamped = []
+        for event in events:
+            self._seq += 1
+            if remote:
+                stamped.append({**event, 'seq': self._seq})
+            else:
+                nseq += 1
+                stamped.append({'seq': self._seq, 'ts': now, 'node': node, 'nseq': nseq, **event})
+        payload = ''.join(json.dumps(e, ensure_ascii=False) + '\n' for e in stamped).encode('utf-8')
+        try:
+            with open(self._journal_path, 'ab') as f:
+                f.write(payload)
+                f.flush()
+                os.fsync(f.fileno())
+        except OSError as e:
+            self._seq -= len(stamped)
+            self.last_write_error = str(e)
+            return False
+        self._journal_offset += len(payload)
+        changes = []
+        for event in stamped:
+            apply_ledger_event(self._ledger, event, changes)
+            self._clock[event['node']] = event['nseq']
+        self._notify_ledger_changes(changes)
+        if undoable and changes and events[0]['op'] != 'import':
+            self._record_command(label or COMMAND_LABELS.get(events[0]['op'], events[0]['op']), changes)
+        self._record_timing('append_events', started)
+        if self._seq - self._snapshot_seq >= SNAPSHOT_INTERVAL and self._write_snapshot():
+            self._remove_old_snapshots()
+        return True
+
+    def _notify_ledger_changes(self, changes: List[Tuple]):
+        if changes:
+            for listener in self._ledger_listeners:
+                listener(changes)
+
+    # --- Отмена и повтор ---
+
+    def _sync_commands(self):
+        # Стеки восстанавливаются из журнала команд; дочитывается только новый хвост,
+        # после сжатия файла другим процессом (другой inode) - с начала
+        try:
+            stat = self._commands_path.stat()
+        except OSError:
+            self._commands_position = (None, 0)
+            self._undo_stack, self._redo_stack = [], []
+            return
+        inode, offset = self._commands_position
+        if inode != stat.st_ino or stat.st_size < offset:
+            inode, offset = stat.st_ino, 0
+            self._undo_stack, self._redo_stack = [], []
+        if stat.st_size == offset:
+            self._commands_position = (inode, offset)
+            return
+        with open(self._commands_path, 'rb') as f:
+            f.seek(offset)
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                offset += len(line)
+                entry = json.loads(line)
+                action = entry['action']
+                if action == 'do':
+                    self._undo_stack.append({'label': entry['label'], 'changes': [
+                        (c, i, LEDGER_RECORD_TYPES[c].from_dict(old) if old else None, LEDGER_RECORD_TYPES[c].from_dict(new) if new else None)
+                        for c, i, old, new in entry['changes']]})
+                    self._redo_stack.clear()
+                    del self._undo_stack[:-UNDO_LIMIT]
+                elif action == 'undo' and self._undo_stack:
+                    self._redo_stack.append(self._undo_stack.pop())
+                elif action == 'redo' and self._redo_stack:
+                    self._undo_stack.append(self._redo_stack.pop())
+        self._commands_position = (inode, offset)
+
+    @staticmethod
+    def _command_entry(command: Dict) -> Dict:
+        return {'action': 'do', 'label': command['label'], 'changes': [
+            [c, i, old.to_dict() if old else None, new.to_dict() if new else None] for c, i, old, new in command['changes']]}
+
+    def _append_command_log(self, entries: List[Dict]):
+        payload = ''.join(json.dumps(e, ensure_ascii=False) + '\n' for e in entries).encode('utf-8')
+        try:
+            with open(self._commands_path, 'ab') as f:
+                f.write(payload)
+            inode, offset = self._commands_position
+            self._commands_position = (self._commands_path.stat().st_ino, offset + len(payload))
+        except OSError:
+            pass
+
+    def _compact_commands(self):
+        # do для стека отмены, затем стек повтора сверху вниз и столько же undo
+        entries = [self._command_entry(c) for c in self._undo_stack]
+        entries += [self._command_entry(c) for c in reversed(self._redo_stack)]
+        entries += [{'action': 'undo'}] * len(self._redo_stack)
+        tmp_path = self._commands_path.with_suffix('.tmp')
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.writelines(json.dumps(e, ensure_ascii=False) + '\n' for e in entries)
+            os.replace(tmp_path, self._commands_path)
+            stat = self._commands_path.stat()
+            self._commands_position = (stat.st_ino, stat.st_size)
+        except OSError:
+            pass
+
+    def _record_command(self, label: str, changes: List[Tuple]):
+        self._sync_commands()
+        # "стало" - живая запись журнала, её меняют следующие правки; храним копию
+        command = {'label': label, 'changes': [(c, i, old, new.copy() if new is not None else None) for c, i, old, new in changes]}
+        self._undo_stack.append(command)
+        self._redo_stack.clear()
+        del self._undo_stack[:-UNDO_LIMIT]
+        self._append_command_log([self._command_entry(command)])
+        if self._commands_position[1] > 256 * 1024:
+            self._compact_commands()
+
+    def get_undo_label(self) -> Optional[str]:
+        self._sync_commands()
+        return self._undo_stack[-1]['label'] if self._undo_stack else None
+
+    def get_redo_label(self) -> Optional[str]:
+        self._sync_commands()
+        return self._redo_stack[-1]['label'] if self._redo_stack else None
+
+    def _replay_command(self, command: Dict, undo: bool) -> bool:
+        # Записи должны быть в том состоянии, в котором их оставила команда (или отмена),
+        # иначе чужая правка после неё была бы молча затёрта
+        ledger = self._ledger
+        for collection, record_id, old, new in command['changes']:
+            if ledger[collection].get(record_id) != (new if undo else old):
+                return False
+        if undo:
+            events = [change_to_event(c, i, new, old) for c, i, old, new in reversed(command['changes'])]
+        else:
+            events = [change_to_event(c, i, old, new) for c, i, old, new in command['changes']]
+        return self._append_events(events, undoable=False)
+
+    @locked
+    def undo(self) -> Optional[Dict]:
+        self._catch_up()
+        self._sync_commands()
+        if not self._undo_stack or not self._replay_command(self._undo_stack[-1], undo=True):
+            return None
+        command = self._undo_stack.pop()
+        self._redo_stack.append(command)
+        self._append_command_log([{'action': 'undo'}])
+        return command
+
+    @locked
+    def redo(self) -> Optional[Dict]:
+        self._catch_up()
+        self._sync_commands()
+        if not self._redo_stack or not self._replay_command(self._redo_stack[-1], undo=False):
+            return None
+        command = self._redo_stack.pop()
+        self._undo_stack.append(command)
+        self._append_command_log([{'action': 'redo'}])
+        return command
+
+    def get_journal_position(self) -> Tuple[int, int]:
+        self._catch_up()
+        return self._seq, self._journal_offset
+
+    def changed_ids_since(self, seq: int, offset: int) -> Optional[Dict[str, Set[int]]]:
+        # id категорий, транзакций и квартир, затронутых событиями после seq (до текущего состояния).
+        # None - если по журналу этого не восстановить и нужна полная выгрузка
+        self._catch_up()
+        if seq > self._seq or offset > self._journal_offset:
+            return None
+        changed = {'categories': set(), 'transactions': set(), 'deleted_categories': set(), 'apartments': set()}
+
+        def collect(event):
+            op = event['op']
+            if op == 'batch':
+                return all(collect(sub_event) for sub_event in event['events'])
+            if op == 'import':
+                return False
+            if op == 'update_apartment':
+                changed['apartments'].add(event['id'])
+            elif op in ('add_category', 'add_transaction'):
+                changed['categories' if op == 'add_category' else 'transactions'].add(event['record']['id'])
+            elif op in ('update_category', 'delete_category'):
+                changed['categories'].add(event['id'])
+                if op == 'delete_category':
+                    changed['deleted_categories'].add(event['id'])
+            else:
+                changed['transactions'].add(event['id'])
+            return True
+
+        expected_seq = seq + 1
+        for event_offset, event in self._read_journal(offset):
+            if event_offset > self._journal_offset:
+                break
+            if event['seq'] != expected_seq or not collect(event):
+                return None
+            expected_seq += 1
+        return changed
+
+    def get_ledger_as_of(self, when: datetime) -> Dict[str, Dict[int, Dict]]:
+        # Ближайший снимок не позже даты (по заголовку, без загрузки остальных) + хвост журнала
+        # после него. Хвост читается целиком: начисления задним числом и события с других
+        # узлов дописываются позже даты своих записей
+        when_iso = when.isoformat()
+        path = next((p for p in reversed(self._snapshot_paths()) if (header := self._snapshot_header(p)) and header['ts'] <= when_iso), None)
+        snapshot = self._load_snapshot(path)
+        ledger = snapshot['ledger'] if snapshot else empty_ledger()
+        offset = snapshot['journal_offset'] if snapshot else 0
+        for _, event in self._read_journal(offset):
+            event = event_as_of(event, when_iso)
+            if event is not None:
+                apply_ledger_event(ledger, event)
+        return ledger
+
+    def _data_signature(self) -> List[List[int]]:
+        # Все данные итогов, включая квартиры, - в журнале
+        try:
+            stat = self._journal_path.stat()
+            return [[stat.st_mtime_ns, stat.st_size]]
+        except OSError:
+            return [[0, 0]]
+
+    def get_data_version(self) -> Tuple:
+        # Меняется при любом изменении журнала, в том числе из другого процесса
+        self._catch_up()
+        return (self._seq, self._journal_offset)
+
+    def get_cached_summary(self) -> Optional[List[Dict]]:
+        # Итоги по квартирам из прошлого запуска, если файлы данных с тех пор не менялись
+        summary = self._load('summary')
+        hit = isinstance(summary, dict) and summary.get('signature') == self._data_signature()
+        self._count_cache('summary', hit)
+        if not hit:
+            return None
+        return summary.get('apartments')
+
+    def _save_summary(self, distributions: Dict[int, Dict]):
+        signature = self._data_signature()
+        if signature == self._summary_signature:
+            return
+        rows = [dict(d['apartment'].to_dict(), **d['balance']) for d in distributions.values()]
+        if self._save('summary', {'signature': signature, 'apartments': rows}):
+            self._summary_signature = signature
+
+    def _track_issued_ids(self, changes: List[Tuple]):
+        for collection, record_id, old, new in changes:
+            if new is not None and record_id > self._issued_ids[collection]:
+                self._issued_ids[collection] = record_id
+
+    def _index_apartment_transactions(self, changes: List[Tuple]):
+        for collection, record_id, old, new in changes:
+            if collection != 'transactions':
+                continue
+            if old is not None:
+                self._by_apartment.get(old.apartment_id, set()).discard(record_id)
+            if new is not None:
+                self._by_apartment.setdefault(new.apartment_id, set()).add(record_id)
+
+    def _apartment_transactions(self, apartment_id: int) -> List[Transaction]:
+        transactions = self._ledger['transactions']
+        return sorted((transactions[i] for i in self._by_apartment.get(apartment_id, ())), key=lambda t: t.id)
+
+    # --- Просрочка ---
+
+    def _get_aging_index(self) -> AgingIndex:
+        self._count_cache('aging_index', self._aging is not None)
+        if self._aging is None:
+            started = time.perf_counter()
+            self._catch_up()
+            aging = AgingIndex()
+            for apt in self.get_all_apartments():
+                aging.rebuild(apt.id, self._apartment_transactions(apt.id))
+            self._aging = aging
+            self._record_timing('build_aging_index', started)
+        return self._aging
+
+    def _age_ledger_changes(self, changes: List[Tuple]):
+        if self._aging is None:
+            return
+        dirty = set()
+        for collection, record_id, old, new in changes:
+            if collection != 'transactions':
+                continue
+            if old is None and new is not None:
+                if not self._aging.add(new):
+                    dirty.add(new.apartment_id)
+            else:
+                # Правка или удаление: пересобирается только эта квартира
+                for record in (old, new):
+                    if record is not None:
+                        dirty.add(record.apartment_id)
+        for apartment_id in dirty:
+            self._aging.rebuild(apartment_id, self._apartment_transactions(apartment_id))
+
+    def _get_rollup_cube(self) -> RollupCube:
+        self._count_cache('rollup_cube', self._cube is not None)
+        if self._cube is None:
+            started = time.perf_counter()
+            self._catch_up()
+            cube = RollupCube()
+            for trans in self._ledger['transactions'].values():
+                cube.apply(trans)
+            self._cube = cube
+            self._record_timing('build_rollup_cube', started)
+        return self._cube
+
+    def _cube_ledger_changes(self, changes: List[Tuple]):
+        if self._cube is None:
+            return
+        for collection, record_id, old, new in changes:
+            if collection != 'transactions':
+                continue
+            if old is not None:
+                self._cube.apply(old, -1)
+            if new is not None:
+                self._cube.apply(new)
+
+    # --- Распределение платежей ---
+
+    def _get_allocations(self) -> PaymentAllocations:
+        self._count_cache('allocations', self._allocations is not None)
+        if self._allocations is None:
+            started = time.perf_counter()
+            self._catch_up()
+            self._allocations = self._load_allocations() or self._build_allocations()
+            self._record_timing('build_allocations', started)
+        return self._allocations
+
+    def _build_allocations(self) -> PaymentAllocations:
+        table = PaymentAllocations()
+        for apartment_id in list(self._by_apartment):
+            table.rebuild(apartment_id, self._apartment_transactions(apartment_id))
+        return table
+
+    def _load_allocations(self) -> Optional[PaymentAllocations]:
+        # Сохранённая таблица + перераспределение квартир, затронутых журналом после неё.
+        # None - если затронутые квартиры по журналу не определить
+        data = self._load('allocations')
+        if not isinstance(data, dict) or 'seq' not in data:
+            return None
+        changed = self.changed_ids_since(data['seq'], data['offset'])
+        if changed is None:
+            return None
+        table = PaymentAllocations.from_dict(data['apartments'])
+        transactions = self._ledger['transactions']
+        dirty = table.apartments_with(changed['deleted_categories'])
+        for trans_id in changed['transactions']:
+            apartment_id = transactions[trans_id].apartment_id if trans_id in transactions else table.payment_apartment(trans_id)
+            if apartment_id is None:
+                # Удалено начисление: его квартира нигде не записана
+                return None
+            dirty.add(apartment_id)
+        for apartment_id in dirty:
+            table.rebuild(apartment_id, self._apartment_transactions(apartment_id))
+        self._allocations_saved = (data['seq'], data['offset'])
+        return table
+
+    def _save_allocations(self):
+        # Таблица целиком пишется только в контрольных точках (снимок журнала, выход из программы):
+        # при загрузке хвост журнала после неё дораспределяется по квартирам
+        position = (self._seq, self._journal_offset)
+        if self._allocations is None or position == self._allocations_saved:
+            return
+        if self._save('allocations', {'seq': self._seq, 'offset': self._journal_offset, 'apartments': self._allocations.to_dict()}):
+            self._allocations_saved = position
+
+    def checkpoint(self):
+        # Сохранение производных таблиц перед выходом
+        self._catch_up()
+        self._save_allocations()
+
+    def _allocate_ledger_changes(self, changes: List[Tuple]):
+        if self._allocations is None:
+            return
+        dirty = set()
+        for collection, record_id, old, new in changes:
+            if collection != 'transactions':
+                continue
+            if old is None and new is not None:
+                if not self._allocations.add(new):
+                    dirty.add(new.apartment_id)
+            else:
+                for record in (old, new):
+                    if record is not None:
+                        dirty.add(record.apartment_id)
+        for apartment_id in dirty:
+            self._allocations.rebuild(apartment_id, self._apartment_transactions(apartment_id))
+
+    def get_payment_allocations(self, apartment_id: int) -> Dict[int, List]:
+        # id платежа -> [своя категория, [[категория, сумма], ...]]
+        self._catch_up()
+        return self._get_allocations().rows.get(apartment_id, {})
+
+    def get_collections_trend(self, apartment_id: Optional[int] = None) -> List[Dict]:
+        # По месяцам: платежи, начисления, доля собранного и накопленный долг - прямо из куба
+        self._catch_up()
+        cube = self._get_rollup_cube()
+        totals = cube.month_totals() if apartment_id is None else cube.apartment_totals(apartment_id)
+        trend = []
+        outstanding = 0
+        for month, paid, debts in totals:
+            outstanding += debts - paid
+            trend.append({'month': month, 'paid': paid, 'debts': debts, 'rate': paid / debts if debts else None, 'outstanding': outstanding})
+        return trend
+
+    def get_debt_aging(self, today: Optional[datetime] = None) -> Dict[int, Dict[str, int]]:
+        today = today or datetime.now()
+        aging = self._get_aging_index()
+        self._catch_up()
+        return {apt.id: aging.buckets(apt.id, today) for apt in self.get_all_apartments()}
+
+    # --- Поиск ---
+
+    def _get_search_index(self) -> SearchIndex:
+        self._count_cache('search_index', self._search_index is not None)
+        if self._search_index is None:
+            started = time.perf_counter()
+            self._catch_up()
+            index = SearchIndex()
+            for apt in self.get_all_apartments():
+                index.add(('apartment', apt.id), f"{apt.full_name} {apt.phone}")
+            for trans in self._ledger['transactions'].values():
+                if trans.notes:
+                    index.add(('transaction', trans.id), trans.notes)
+            self._search_index = index
+            self._record_timing('build_search_index', started)
+        return self._search_index
+
+    def _index_ledger_changes(self, changes: List[Tuple]):
+        if self._search_index is None:
+            return
+        for collection, record_id, old, new in changes:
+            if collection == 'apartments':
+                self._search_index.add(('apartment', record_id), f"{new.full_name} {new.phone}")
+            if collection != 'transactions':
+                continue
+            if new is None or not new.notes:
+                self._search_index.remove(('transaction', record_id))
+            elif old is None or old.notes != new.notes:
+                self._search_index.add(('transaction', record_id), new.notes)
+
+    def search(self, query: str, limit: int = 50) -> List[Dict]:
+        started = time.perf_counter()
+        index = self._get_search_index()
+        self._catch_up()
+        keys = index.search(query)
+        apartments = {apt.id: apt for apt in self.get_all_apartments()} if any(k[0] == 'apartment' for k in keys) else {}
+        results = []
+        for kind, record_id in sorted(keys, key=lambda k: (k[0] != 'apartment', -k[1])):
+            if kind == 'apartment' and record_id in apartments:
+                apt = apartments[record_id]
+                results.append({'kind': kind, 'id': record_id, 'apartment_id': record_id, 'text': f"{apt.full_name} {apt.phone}".strip()})
+            elif kind == 'transaction' and record_id in self._ledger['transactions']:
+                trans = self._ledger['transactions'][record_id]
+                results.append({'kind': kind, 'id': record_id, 'apartment_id': trans.apartment_id, 'text': trans.notes, 'amount': trans.amount, 'type': trans.type, 'created_at': trans.created_at})
+            if len(results) >= limit:
+                break
+        self._record_timing('search', started)
+        return results
+
+    def _load_records(self, key: str, record_type: type) -> List[Record]:
+        return [record_type.from_dict(data) for data in self._load(key)]
+
+    def _save_records(self, key: str, records: List[Record]) -> bool:
+        return self._save(key, [r.to_dict() for r in records])
+
+    def get_apartment(self, apt_id: int) -> Optional[Apartment]:
+        for apt in self.get_all_apartments():
+            if apt.id == apt_id:
+                return apt
+        return None
+
+    @locked
+    def update_apartment(self, apt_id: int, full_name: str, phone: str) -> bool:
+        self._catch_up()
+        if apt_id not in self._ledger['apartments']:
+            return False
+        return self._append_events([{'op': 'update_apartment', 'id': apt_id, 'full_name': full_name, 'phone': phone}])
+
+    def get_all_apartments(self) -> List[Apartment]:
+        self._catch_up()
+        return self._apartments()
+
+    def _apartments(self) -> List[Apartment]:
+        apartments = self._ledger['apartments']
+        if not apartments:
+            # Миграции до v6 работают, пока квартиры ещё в apartments.json
+            return self._load_records('apartments', Apartment)
+        return sorted(apartments.values(), key=lambda apt: apt.id)
+
+    # --- Пользователи и сессии ---
+
+    def _user_index(self) -> Dict[str, User]:
+        try:
+            stat = self._files['users'].stat()
+            signature = (stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            signature = None
+        if signature != self._users_signature:
+            users = self._load_records('users', User)
+            self._users_by_name = {u.username: u for u in users}
+            self._users_by_id = {u.id: u for u in users}
+            self._users_signature = signature
+        return self._users_by_name
+
+    @locked
+    def add_user(self, username: str, password: str) -> bool:
+        if username in self._user_index():
+            return False
+        users = list(self._users_by_id.values())
+        users.append(User(id=max(self._users_by_id, default=0) + 1, username=username, password_hash=hash_password(password), role='user', created_at=datetime.now().isoformat()))
+        return self._save_records('users', users)
+
+    def authenticate(self, username: str, password: str) -> Optional[User]:
+        # Вычисление ключа - один раз на вход; дальше вызывающий работает с токеном сессии
+        user = self._user_index().get(username)
+        if user is None or not verify_password(password, user.password_hash):
+            return None
+        return user
+
+    def login(self, username: str, password: str) -> Optional[str]:
+        user = self.authenticate(username, password)
+        if user is None:
+            return None
+        now = time.monotonic()
+        # Просроченные сессии вычищаются при входе, а не при каждой проверке
+        self._sessions = {token: entry for token, entry in self._sessions.items() if entry[1] > now}
+        token = secrets.token_urlsafe(32)
+        self._sessions[token] = (user.id, now + SESSION_TTL)
+        return token
+
+    def validate_session(self, token: str) -> Optional[User]:
+        # O(1): словарь сессий и индекс пользователей; срок продлевается при каждой проверке
+        entry = self._sessions.get(token)
+        if entry is None:
+            return None
+        user_id, expires = entry
+        now = time.monotonic()
+        if expires <= now:
+            del self._sessions[token]
+            return None
+        self._user_index()
+        user = self._users_by_id.get(user_id)
+        if user is None:
+            del self._sessions[token]
+            return None
+        self._sessions[token] = (user_id, now + SESSION_TTL)
+        return user
+
+    def logout(self, token: str):
+        self._sessions.pop(token, None)
+
+    @staticmethod
+    def _next_id(records: List[Dict]) -> int:
+        return max((r['id'] for r in records), default=0) + 1
+
+    @staticmethod
+    def _period_name(name: str, year: int, month: int) -> str:
+        return f"{name} {MONTHS_RU[month]} {year}"
+
+    def _next_ids(self) -> Dict[str, int]:
+        # Следующий id из остатка этого узла; шаг 1, пока база не клонирована.
+        # Отсчёт от наибольшего выданного id, а не от существующих записей: id удалённой
+        # записи не переиспользуется, иначе её правка с другого узла попала бы в новую
+        replication = self._get_replication()
+        step, number = replication['step'], replication['number']
+        next_ids = {}
+        for key, issued in self._issued_ids.items():
+            first = issued + 1
+            next_ids[key] = first + (number - first) % step
+        return next_ids
+
+    @property
+    def _id_step(self) -> int:
+        return self._get_replication()['step']
+
+    @locked
+    def add_category(self, name: str, amount: int) -> bool:
+        self._catch_up()
+        now = datetime.now()
+        full_name = self._period_name(name, now.year, now.month)
+        if any(c.name == full_name for c in self._ledger['categories'].values()):
+            return False
+        record = Category(id=self._next_ids()['categories'], name=full_name, amount=amount, created_at=now.isoformat())
+        return self._append_events([{'op': 'add_category', 'record': record.to_dict()}])
+
+    def _append_accrual(self, events: List[Dict], next_ids: Dict[str, int], apartments: List[Apartment], full_name: str, amount: int, user_id: int, created_at: str, **extra) -> Category:
+        # Категория и долги по всем квартирам копятся в events, запись - у вызывающего
+        category = Category(id=next_ids['categories'], name=full_name, amount=amount, created_at=created_at, **extra)
+        next_ids['categories'] += self._id_step
+        events.append({'op': 'add_category', 'record': category.to_dict()})
+        for apt, share in zip(apartments, split_amount(amount, len(apartments))):
+            trans = Transaction(id=next_ids['transactions'], apartment_id=apt.id, category_id=category.id, amount=share, type='debt', user_id=user_id, notes=f"Начисление: {full_name}", created_at=created_at)
+            events.append({'op': 'add_transaction', 'record': trans.to_dict()})
+            next_ids['transactions'] += self._id_step
+        return category
+
+    def _commit_accruals(self, events: List[Dict]) -> bool:
+        # Одна строка журнала - начисление применяется целиком или никак
+        return self._append_events([{'op': 'batch', 'events': events}])
+
+    @locked
+    def add_category_with_accruals(self, name: str, amount: int, user_id: int) -> Optional[Category]:
+        self._catch_up()
+        now = datetime.now()
+        full_name = self._period_name(name, now.year, now.month)
+        if any(c.name == full_name for c in self._ledger['categories'].values()):
+            return None
+        events = []
+        category = self._append_accrual(events, self._next_ids(), self.get_all_apartments(), full_name, amount, user_id, now.isoformat())
+        return category if self._commit_accruals(events) else None
+
+    def get_recurring_charges(self) -> List[Dict]:
+        return self._load('recurring')
+
+    @locked
+    def add_recurring_charge(self, name: str, amount: int, day: int = 1, start: Optional[str] = None) -> bool:
+        templates = self._load('recurring')
+        if any(t['name'] == name for t in templates):
+            return False
+        start = start or datetime.now().strftime('%Y-%m')
+        templates.append({'id': self._next_id(templates), 'name': name, 'amount': amount, 'day': min(max(day, 1), 28), 'start': start, 'created_at': datetime.now().isoformat()})
+        return self._save('recurring', templates)
+
+    @locked
+    def delete_recurring_charge(self, template_id: int) -> bool:
+        templates = self._load('recurring')
+        remaining = [t for t in templates if t['id'] != template_id]
+        if len(remaining) == len(templates):
+            return False
+        return self._save('recurring', remaining)
+
+    @locked
+    def run_recurring_accruals(self, user_id: int, today: Optional[datetime] = None) -> List[Category]:
+        # Догоняющие начисления по всем шаблонам и месяцам одной записью.
+        # Повторный запуск ничего не дублирует: начисленные месяцы записываются в шаблон
+        # (accrued), поэтому удалённое вручную начисление не создаётся снова
+        today = today or datetime.now()
+        templates = self._load('recurring')
+        # Начисления по шаблонам делает только основной узел, иначе каждый клон начислил бы свои
+        if not templates or self._get_replication()['number'] != 0:
+            return []
+        self._catch_up()
+        categories = self._ledger['categories'].values()
+        apartments = self.get_all_apartments()
+        done = {(c.template_id, c.period) for c in categories}
+        done.update((t['id'], period) for t in templates for period in t.get('accrued', ()))
+        names = {c.name for c in categories}
+        next_ids = self._next_ids()
+        events = []
+        created = []
+        for template in templates:
+            year, month = (int(part) for part in template['start'].split('-'))
+            while (year, month) <= (today.year, today.month):
+                period = f"{year:04d}-{month:02d}"
+                due = datetime(year, month, template['day'])
+                if due > today:
+                    break
+                full_name = self._period_name(template['name'], year, month)
+                if (template['id'], period) not in done and full_name not in names:
+                    created.append(self._append_accrual(events, next_ids, apartments, full_name, template['amount'], user_id, due.isoformat(), template_id=template['id'], period=period))
+                    names.add(full_name)
+                year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+        if created and not self._commit_accruals(events):
+            return []
+        # Отметки и для новых начислений, и для существовавших до появления поля accrued
+        marked = False
+        for template in templates:
+            accrued = set(template.get('accrued', ()))
+            periods = accrued | {c.period for c in self._ledger['categories'].values() if c.template_id == template['id']}
+            if periods != accrued:
+                template['accrued'] = sorted(periods)
+                marked = True
+        if marked:
+            self._save('recurring', templates)
+        return created
+
+    # --- Счётчики ---
+
+    def get_tariffs(self) -> Dict[str, Dict]:
+        # {счётчик: {'price': копеек за единицу, 'apartments': {id квартиры: своя цена}}}
+        tariffs = self._load('tariffs')
+        return tariffs if isinstance(tariffs, dict) else {}
+
+    @locked
+    def set_tariff(self, meter: str, price: int, apartment_id: Optional[int] = None) -> bool:
+        tariffs = self.get_tariffs()
+        tariff = tariffs.setdefault(meter, {'price': 0, 'apartments': {}})
+        if apartment_id is None:
+            tariff['price'] = price
+        else:
+            tariff['apartments'][str(apartment_id)] = price
+        return self._save('tariffs', tariffs)
+
+    def get_meters(self) -> List[str]:
+        return sorted(set(self.get_tariffs()) | {r['meter'] for r in self._load('readings')})
+
+    @locked
+    def import_meter_readings(self, path: str) -> Tuple[int, List[str]]:
+        # CSV "квартира;счётчик;период (ГГГГ-ММ);показание"; весь файл - одна запись на диск.
+        # Повторный импорт того же периода заменяет показание
+        by_number = {apt.number: apt.id for apt in self.get_all_apartments()}
+        readings = {(r['apartment_id'], r['meter'], r['period']): r for r in self._load('readings')}
+        now = datetime.now().isoformat()
+        imported = 0
+        errors = []
+        with open(path, 'r', encoding='utf-8-sig', newline='') as f:
+            for line_no, row in enumerate(csv.reader(f, delimiter=';'), 1):
+                if not row or not any(cell.strip() for cell in row):
+                    continue
+                if line_no == 1 and not row[0].strip().isdigit():
+                    continue
+                try:
+                    if len(row) < 4:
+                        raise ValueError("нужно 4 колонки")
+                    number, meter, period, value = (cell.strip() for cell in row[:4])
+                    if int(number) not in by_number:
+                        raise ValueError(f"нет квартиры {number}")
+                    if not re.fullmatch(r'\d{4}-(0[1-9]|1[0-2])', period):
+                        raise ValueError(f"период {period!r} не в формате ГГГГ-ММ")
+                    if not meter:
+                        raise ValueError("не указан счётчик")
+                    apartment_id = by_number[int(number)]
+                    readings[(apartment_id, meter, period)] = {'apartment_id': apartment_id, 'meter': meter, 'period': period, 'value': parse_reading(value), 'created_at': now}
+                    imported += 1
+                except ValueError as e:
+                    errors.append(f"Строка {line_no}: {e}")
+        if imported and not self._save('readings', list(readings.values())):
+            return 0, errors + ["Не удалось сохранить показания"]
+        return imported, errors
+
+    def compute_meter_charges(self, meter: str, period: str) -> Dict[str, List]:
+        # Показание за период и последнее предыдущее по каждой квартире, затем расход и сумма
+        # считаются по колонкам за один проход для всех квартир сразу
+        current = {}
+        previous = {}
+        for r in self._load('readings'):
+            if r['meter'] != meter:
+                continue
+            apartment_id = r['apartment_id']
+            if r['period'] == period:
+                current[apartment_id] = r['value']
+            elif r['period'] < period and r['period'] > previous.get(apartment_id, ('', 0))[0]:
+                previous[apartment_id] = (r['period'], r['value'])
+        tariff = self.get_tariffs().get(meter, {'price': 0, 'apartments': {}})
+        apartment_ids = [apt.id for apt in self.get_all_apartments()]
+        billable = [a for a in apartment_ids if a in current and a in previous]
+        usage = list(map(operator.sub, [current[a] for a in billable], [previous[a][1] for a in billable]))
+        prices = [tariff['apartments'].get(str(a), tariff['price']) for a in billable]
+        # тысячные доли единицы * копейки за единицу -> копейки с округлением половины вверх
+        amounts = [(u * p + 500) // 1000 for u, p in zip(usage, prices)]
+        charges = {'apartments': [], 'usage': [], 'prices': [], 'amounts': [], 'negative': [],
+                   'missing': [a for a in apartment_ids if a not in current or a not in previous]}
+        for apartment_id, used, price, amount in zip(billable, usage, prices, amounts):
+            if used < 0:
+                # Счётчик заменён или ошибка ввода - не начисляем, показываем оператору
+                charges['negative'].append(apartment_id)
+                continue
+            charges['apartments'].append(apartment_id)
+            charges['usage'].append(used)
+            charges['prices'].append(price)
+            charges['amounts'].append(amount)
+        return charges
+
+    @locked
+    def bill_meter_readings(self, meter: str, period: str, user_id: int) -> Optional[Category]:
+        # Категория на месяц и долги по фактическому расходу - одним пакетом в журнале
+        self._catch_up()
+        year, month = (int(part) for part in period.split('-'))
+        full_name = self._period_name(meter, year, month)
+        if any(c.name == full_name for c in self._ledger['categories'].values()):
+            return None
+        charges = self.compute_meter_charges(meter, period)
+        if not charges['apartments']:
+            return None
+        next_ids = self._next_ids()
+        created_at = datetime.now().isoformat()
+        category = Category(id=next_ids['categories'], name=full_name, amount=sum(charges['amounts']), created_at=created_at, period=period)
+        events = [{'op': 'add_category', 'record': category.to_dict()}]
+        trans_id = next_ids['transactions']
+        for apartment_id, used, amount in zip(charges['apartments'], charges['usage'], charges['amounts']):
+            trans = Transaction(id=trans_id, apartment_id=apartment_id, category_id=category.id, amount=amount, type='debt', user_id=user_id,
+                                notes=f"Начисление: {full_name}, расход {format_reading(used)}", created_at=created_at)
+            events.append({'op': 'add_transaction', 'record': trans.to_dict()})
+            trans_id += self._id_step
+        return category if self._commit_accruals(events) else None
+
+    def get_categories(self) -> List[Category]:
+        self._catch_up()
+        return list(self._ledger['categories'].values())
+
+    @locked
+    def delete_category(self, cat_id: int) -> bool:
+        # Категория и её транзакции уходят из состояния, но остаются в журнале
+        self._catch_up()
+        if cat_id not in self._ledger['categories']:
+            return False
+        return self._append_events([{'op': 'delete_category', 'id': cat_id}])
+
+    @locked
+    def update_category(self, cat_id: int, name: str, amount: int) -> bool:
+        self._catch_up()
+        if cat_id not in self._ledger['categories']:
+            return False
+        return self._append_events([{'op': 'update_category', 'id': cat_id, 'amount': amount}])
+
+    @locked
+    def update_category_with_accruals(self, cat_id: int, amount: int) -> bool:
+        # Новая сумма категории и пересчёт равных долей начислений - одно событие и одна команда отмены.
+        # Начисления по счётчику (период без шаблона) делятся по расходу и так не пересчитываются
+        self._catch_up()
+        category = self._ledger['categories'].get(cat_id)
+        if category is None or (category.period and category.template_id is None):
+            return False
+        # Доли раздаются по квартирам так же, как в _append_accrual
+        apartments = self.get_all_apartments()
+        shares = dict(zip((apt.id for apt in apartments), split_amount(amount, len(apartments))))
+        events = [{'op': 'update_category', 'id': cat_id, 'amount': amount}]
+        updated_at = datetime.now().isoformat()
+        for trans in self.get_transactions(category_id=cat_id):
+            if trans.type == 'debt' and 'Начисление:' in trans.notes and trans.apartment_id in shares:
+                events.append({'op': 'update_transaction', 'id': trans.id, 'amount': shares[trans.apartment_id], 'notes': trans.notes, 'updated_at': updated_at})
+        return self._append_events([{'op': 'batch', 'events': events}], label=COMMAND_LABELS['update_category'])
+
+    @locked
+    def add_transaction(self, apartment_id: int, category_id: int, amount: int, trans_type: str, user_id: int, notes: str = "") -> Optional[Transaction]:
+        self._catch_up()
+        record = Transaction(id=self._next_ids()['transactions'], apartment_id=apartment_id, category_id=category_id, amount=amount, type=trans_type, user_id=user_id, notes=notes, created_at=datetime.now().isoformat())
+        return record if self._append_events([{'op': 'add_transaction', 'record': record.to_dict()}]) else None
+
+    def get_transactions(self, apartment_id: Optional[int] = None, category_id: Optional[int] = None) -> List[Transaction]:
+        self._catch_up()
+        if apartment_id is not None:
+            transactions = self._apartment_transactions(apartment_id)
+        else:
+            transactions = list(self._ledger['transactions'].values())
+        if category_id is not None:
+            transactions = [t for t in transactions if t.category_id == category_id]
+        return transactions
+
+    @locked
+    def delete_transaction(self, trans_id: int) -> bool:
+        self._catch_up()
+        if trans_id not in self._ledger['transactions']:
+            return False
+        return self._append_events([{'op': 'delete_transaction', 'id': trans_id}])
+
+    @locked
+    def update_transaction(self, trans_id: int, amount: int, notes: str) -> bool:
+        self._catch_up()
+        if trans_id not in self._ledger['transactions']:
+            return False
+        return self._append_events([{'op': 'update_transaction', 'id': trans_id, 'amount': amount, 'notes': notes, 'updated_at': datetime.now().isoformat()}])
+
+    def get_apartment_balance(self, apartment_id: int) -> Dict:
+        transactions = self.get_transactions(apartment_id=apartment_id)
+        total_paid = sum(t.amount for t in transactions if t.type == 'payment')
+        total_debts = sum(t.amount for t in transactions if t.type == 'debt')
+        balance = total_paid - total_debts
+        return {'apartment_id': apartment_id, 'paid': total_paid, 'debts': total_debts, 'balance': balance}
+
+    def get_categories_with_distribution(self, apartment_id: int) -> List[Dict]:
+        transactions = self.get_transactions(apartment_id=apartment_id)
+        categories = self.get_categories()
+        by_category = {}
+        for trans in transactions:
+            by_category.setdefault(trans.category_id, []).append(trans)
+        return self._category_balances(categories, by_category, self._get_allocations().received.get(apartment_id, {}))
+
+    @staticmethod
+    def _category_balances(categories: List[Category], by_category: Dict[int, List[Transaction]], received: Dict[int, int]) -> List[Dict]:
+        # balance_after - с учётом переносов между категориями из таблицы распределения платежей
+        categories_info = []
+        for cat in categories:
+            cat_id = cat.id
+            cat_transactions = by_category.get(cat_id, [])
+            cat_paid = sum(t.amount for t in cat_transactions if t.type == 'payment')
+            cat_debts = sum(t.amount for t in cat_transactions if t.type == 'debt')
+            cat_balance_before = cat_paid - cat_debts
+            categories_info.append({'id': cat_id, 'name': cat.name, 'paid': cat_paid, 'debts': cat_debts, 'balance_before': cat_balance_before, 'balance_after': cat_balance_before + received.get(cat_id, 0)})
+        return categories_info
+
+    def get_all_distributions(self, as_of: Optional[datetime] = None) -> Dict[int, Dict]:
+        # Один проход по журналу для всех квартир сразу:
+        # {apt_id: {'apartment', 'balance', 'categories', 'transactions'}}
+        # as_of - состояние на момент времени, восстановленное из ближайшего снимка
+        started = time.perf_counter()
+        apartments = self.get_all_apartments()
+        if as_of is None:
+            self._catch_up()
+            ledger = self._ledger
+            allocations = self._get_allocations()
+        else:
+            ledger = self.get_ledger_as_of(as_of)
+            allocations = PaymentAllocations()
+        categories = list(ledger['categories'].values())
+        transactions = ledger['transactions'].values()
+        grouped = {apt.id: {} for apt in apartments}
+        for trans in transactions:
+            by_category = grouped.setdefault(trans.apartment_id, {})
+            by_category.setdefault(trans.category_id, []).append(trans)
+        distributions = {}
+        for apt in apartments:
+            apt_id = apt.id
+            by_category = grouped[apt_id]
+            if as_of is not None:
+                allocations.rebuild(apt_id, [t for cat_transactions in by_category.values() for t in cat_transactions])
+            categories_info = self._category_balances(categories, by_category, allocations.received.get(apt_id, {}))
+            total_paid = sum(c['paid'] for c in categories_info)
+            total_debts = sum(c['debts'] for c in categories_info)
+            distributions[apt_id] = {
+                'apartment': apt,
+                'balance': {'apartment_id': apt_id, 'paid': total_paid, 'debts': total_debts, 'balance': total_paid - total_debts},
+                'categories': categories_info,
+                'transactions': by_category
+            }
+        if as_of is None:
+            self._save_summary(distributions)
+        self._record_timing('distributions' if as_of is None else 'distributions_as_of', started)
+        return distributions
+
+    def get_all_balances(self, as_of: Optional[datetime] = None) -> List[Dict]:
+        return [d['balance'] for d in self.get_all_distributions(as_of).values()]
+
+    def get_statement_snapshot(self) -> Dict:
+        # Неизменяемый срез журнала для генерации выписок в других процессах
+        self._catch_up()
+        categories = self.get_categories()
+        transactions = {}
+        for apt in self.get_all_apartments():
+            apt_transactions = [t.copy() for t in self._apartment_transactions(apt.id)]
+            apt_transactions.sort(key=lambda t: (t.created_at, t.id))
+            transactions[apt.id] = apt_transactions
+        allocations = self._get_allocations()
+        return {
+            'generated_at': datetime.now().isoformat(),
+            'apartments': self.get_all_apartments(),
+            'categories': [c.copy() for c in categories],
+            'transactions': transactions,
+            'received': {apt_id: dict(allocations.received.get(apt_id, {})) for apt_id in transactions}
+        }
+
+
+# --- Выписки по квартирам ---
+
+_statement_snapshot = None
+
+
+def _init_statement_worker(snapshot: Dict):
+    # Срез передаётся в каждый процесс один раз, а не с каждой задачей
+    global _statement_snapshot
+    _statement_snapshot = snapshot
+
+
+def _write_statement(task: Tuple[int, str, str, Optional[str]]) -> str:
+    apartment_id, path, fmt, since = task
+    snapshot = _statement_snapshot
+    apt = next(a for a in snapshot['apartments'] if a.id == apartment_id)
+    categories = snapshot['categories']
+    category_names = {c.id: c.name for c in categories}
+    transactions = snapshot['transactions'].get(apartment_id, [])
+    opening = 0
+    rows = []
+    for trans in transactions:
+        signed = trans.amount if trans.type == 'payment' else -trans.amount
+        if since and trans.created_at < since:
+            opening += signed
+        else:
+            rows.append(trans)
+    by_category = {}
+    for trans in transactions:
+        by_category.setdefault(trans.category_id, []).append(trans)
+    distribution = [c for c in Database._category_balances(categories, by_category, snapshot['received'].get(apartment_id, {})) if c['id'] in by_category]
+    accrued = sum(t.amount for t in rows if t.type == 'debt')
+    paid = sum(t.amount for t in rows if t.type == 'payment')
+    closing = opening + paid - accrued
+    period = f"с {since.split('T')[0]}" if since else "за всё время"
+    generated = snapshot['generated_at'].split('T')[0]
+    # Файл пишется построчно, без сборки документа в памяти
+    with open(path, 'w', encoding='utf-8', newline='\n') as f:
+        if fmt == 'html':
+            esc = html.escape
+            f.write('<!DOCTYPE html>\n<html lang="ru"><head><meta charset="utf-8">\n')
+            f.write(f'<title>Выписка: Кв. {apt.number}</title>\n')
+            f.write('<style>body{font-family:Arial,sans-serif;margin:24px;color:#333}'
+                    'h1{color:#0078D4}table{border-collapse:collapse;margin:12px 0}'
+                    'td,th{border:1px solid #ccc;padding:4px 10px}th{background:#f0f0f0}'
+                    '.num{text-align:right}.debt{color:#C91130}.payment{color:#107C10}</style>\n</head><body>\n')
+            f.write(f'<h1>Выписка по квартире № {apt.number}</h1>\n')
+            f.write(f'<p>ФИО: {esc(apt.full_name) or "—"}<br>Телефон: {esc(apt.phone) or "—"}<br>Период: {period}<br>Сформирована: {generated}</p>\n')
+            f.write(f'<p><b>Входящий остаток:</b> {format_money(opening, signed=True)} руб.</p>\n')
+            f.write('<table><tr><th>Дата</th><th>Категория</th><th>Начислено</th><th>Оплачено</th><th>Остаток</th></tr>\n')
+            running = opening
+            for trans in rows:
+                is_payment = trans.type == 'payment'
+                running += trans.amount if is_payment else -trans.amount
+                f.write(f'<tr class="{trans.type}"><td>{trans.created_at.split("T")[0]}</td><td>{esc(category_names.get(trans.category_id, ""))}</td>'
+                        f'<td class="num">{"" if is_payment else format_money(trans.amount)}</td>'
+                        f'<td class="num">{format_money(trans.amount) if is_payment else ""}</td>'
+                        f'<td class="num">{format_money(running, signed=True)}</td></tr>\n')
+            f.write(f'<tr><th colspan="2">Итого</th><th class="num">{format_money(accrued)}</th><th class="num">{format_money(paid)}</th>'
+                    f'<th class="num">{format_money(closing, signed=True)}</th></tr>\n</table>\n')
+            f.write('<h2>Распределение по категориям</h2>\n<table><tr><th>Категория</th><th>Начислено</th><th>Оплачено</th><th>Остаток</th><th>Статус</th></tr>\n')
+            for cat in distribution:
+                status = "Оплачено" if cat['balance_after'] >= 0 else "Имеется долг"
+                f.write(f'<tr><td>{esc(cat["name"])}</td><td class="num">{format_money(cat["debts"])}</td><td class="num">{format_money(cat["paid"])}</td>'
+                        f'<td class="num">{format_money(cat["balance_after"], signed=True)}</td><td>{status}</td></tr>\n')
+            f.write(f'</table>\n<p><b>Исходящий остаток:</b> {format_money(closing, signed=True)} руб.</p>\n</body></html>\n')
+        else:
+            f.write(f"ВЫПИСКА ПО КВАРТИРЕ № {apt.number}\n")
+            f.write(f"ФИО: {apt.full_name or '—'}\nТелефон: {apt.phone or '—'}\nПериод: {period}\nСформирована: {generated}\n\n")
+            f.write(f"Входящий остаток: {format_money(opening, signed=True)} руб.\n\n")
+            f.write(f"{'Дата':<12}{'Категория':<32}{'Начислено':>12}{'Оплачено':>12}{'Остаток':>12}\n")
+            running = opening
+            for trans in rows:
+                is_payment = trans.type == 'payment'
+                running += trans.amount if is_payment else -trans.amount
+                f.write(f"{trans.created_at.split('T')[0]:<12}{category_names.get(trans.category_id, '')[:31]:<32}"
+                        f"{'' if is_payment else format_money(trans.amount):>12}{format_money(trans.amount) if is_payment else '':>12}"
+                        f"{format_money(running, signed=True):>12}\n")
+            f.write(f"{'Итого':<44}{format_money(accrued):>12}{format_money(paid):>12}{format_money(closing, signed=True):>12}\n\n")
+            f.write("Распределение по категориям:\n")
+            for cat in distribution:
+                status = "Оплачено" if cat['balance_after'] >= 0 else "Имеется долг"
+                f.write(f"  {cat['name'][:40]:<42}{format_money(cat['balance_after'], signed=True):>12}  {status}\n")
+            f.write(f"\nИсходящий остаток: {format_money(closing, signed=True)} руб.\n")
+    return path
+
+
+def generate_statements(db: Database, out_dir: str, fmt: str = 'html', since: Optional[str] = None, workers: Optional[int] = None) -> List[str]:
+    # Все квартиры параллельно в пуле процессов с одним общим срезом журнала
+    snapshot = db.get_statement_snapshot()
+    out_path = Path(out_dir)
+    out_path.mkdir(parents=True, exist_ok=True)
+    extension = 'html' if fmt == 'html' else 'txt'
+    tasks = [(apt.id, str(out_path / f"кв_{apt.number:02d}.{extension}"), fmt, since) for apt in snapshot['apartments']]
+    workers = workers or os.cpu_count() or 1
+    try:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_statement_worker, initargs=(snapshot,)) as pool:
+            return list(pool.map(_write_statement, tasks, chunksize=max(1, len(tasks) // (workers * 4))))
+    except (OSError, RuntimeError):
+        # Нет возможности запустить процессы - генерируем в текущем
+        _init_statement_worker(snapshot)
+        return [_write_statement(task) for task in tasks]
+
+
+# --- Аналитическая выгрузка в SQLite ---
+
+ANALYTICS_SCHEMA = """
+CREATE TABLE export_meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE apartments (id INTEGER PRIMARY KEY, number INTEGER, full_name TEXT, phone TEXT);
+CREATE TABLE categories (id INTEGER PRIMARY KEY, name TEXT, month TEXT, amount_kop INTEGER, amount REAL, created_at TEXT, template_id INTEGER, period TEXT);
+CREATE TABLE transactions (
+    id INTEGER PRIMARY KEY, month TEXT, created_at TEXT, updated_at TEXT,
+    apartment_id INTEGER, apartment_number INTEGER, full_name TEXT,
+    category_id INTEGER, category_name TEXT, type TEXT,
+    amount_kop INTEGER, amount REAL, signed_amount REAL, user_id INTEGER, notes TEXT
+);
+CREATE INDEX idx_transactions_month ON transactions (month);
+CREATE INDEX idx_transactions_apartment ON transactions (apartment_id, month);
+CREATE INDEX idx_transactions_category ON transactions (category_id, month);
+"""
+
+# Версия формата файла выгрузки: при несовпадении файл пересоздаётся целиком
+ANALYTICS_FORMAT = 2
+
+# Сводные таблицы: имя -> колонки группировки (месяц всегда первый)
+ANALYTICS_PIVOTS = {
+    'pivot_month_category': ('category_id', 'category_name'),
+    'pivot_month_apartment': ('apartment_id', 'apartment_number', 'full_name'),
+    'pivot_month_category_apartment': ('category_id', 'category_name', 'apartment_id', 'apartment_number')
+}
+
+
+def _analytics_transaction_row(trans: Transaction, apartments: Dict[int, Apartment], categories: Dict[int, Category]) -> Tuple:
+    apt = apartments.get(trans.apartment_id)
+    cat = categories.get(trans.category_id)
+    sign = 1 if trans.type == 'payment' else -1
+    return (trans.id, trans.created_at[:7], trans.created_at, trans.updated_at,
+            trans.apartment_id, apt.number if apt else None, apt.full_name if apt else None,
+            trans.category_id, cat.name if cat else None, trans.type,
+            trans.amount, trans.amount / 100, sign * trans.amount / 100, trans.user_id, trans.notes)
+
+
+def _analytics_category_row(cat: Category) -> Tuple:
+    return (cat.id, cat.name, cat.created_at[:7], cat.amount, cat.amount / 100, cat.created_at, cat.template_id, cat.period)
+
+
+def _refresh_pivots(conn: sqlite3.Connection, months: Optional[Set[str]]):
+    # months = None - пересчитать всё, иначе только затронутые месяцы.
+    # Суммируются целые копейки; рубли выводятся из итога одним делением
+    where = "" if months is None else f" WHERE month IN ({','.join('?' * len(months))})"
+    params = () if months is None else tuple(months)
+    for table, columns in ANALYTICS_PIVOTS.items():
+        group = ', '.join(('month',) + columns)
+        conn.execute(f"DELETE FROM {table}{where}", params)
+        conn.execute(f"""INSERT INTO {table} ({group}, paid_kop, debts_kop, balance_kop, count)
+            SELECT {group},
+                   SUM(CASE WHEN type = 'payment' THEN amount_kop ELSE 0 END),
+                   SUM(CASE WHEN type = 'debt' THEN amount_kop ELSE 0 END),
+                   SUM(CASE WHEN type = 'payment' THEN amount_kop ELSE -amount_kop END), COUNT(*)
+            FROM transactions{where} GROUP BY {group}""", params)
+        conn.execute(f"UPDATE {table} SET paid = paid_kop / 100.0, debts = debts_kop / 100.0, balance = balance_kop / 100.0{where}", params)
+
+
+def export_analytics(db: Database, path: str, full: bool = False) -> Dict[str, Any]:
+    # Денормализованная копия журнала для внешнего анализа. Повторный вызов дописывает
+    # только изменения после сохранённого seq; всё пишется одной транзакцией
+    started = time.perf_counter()
+    seq, offset = db.get_journal_position()
+    conn = sqlite3.connect(path, isolation_level=None)
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        meta = dict(conn.execute("SELECT key, value FROM export_meta")) if 'export_meta' in tables else {}
+        changed = None
+        if not full and meta.get('schema') == str(SCHEMA_VERSION) and meta.get('format') == str(ANALYTICS_FORMAT):
+            changed = db.changed_ids_since(int(meta['seq']), int(meta['journal_offset']))
+        apartments = {apt.id: apt for apt in db.get_all_apartments()}
+        categories = {cat.id: cat for cat in db.get_categories()}
+        transactions = {t.id: t for t in db.get_transactions()}
+
+        if changed is None:
+            mode = 'full'
+            for table in tables:
+                conn.execute(f"DROP TABLE {table}")
+            for statement in ANALYTICS_SCHEMA.strip().split(';'):
+                if statement.strip():
+                    conn.execute(statement)
+            for table, columns in ANALYTICS_PIVOTS.items():
+                conn.execute(f"CREATE TABLE {table} (month TEXT, {', '.join(columns)}, paid_kop INTEGER, debts_kop INTEGER, balance_kop INTEGER, "
+                             f"paid REAL, debts REAL, balance REAL, count INTEGER)")
+                conn.execute(f"CREATE INDEX idx_{table}_month ON {table} (month)")
+            conn.executemany("INSERT INTO apartments VALUES (?, ?, ?, ?)", [(a.id, a.number, a.full_name, a.phone) for a in apartments.values()])
+            conn.executemany("INSERT INTO categories VALUES (?, ?, ?, ?, ?, ?, ?, ?)", [_analytics_category_row(c) for c in categories.values()])
+            conn.executemany("INSERT INTO transactions VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                             [_analytics_transaction_row(t, apartments, categories) for t in transactions.values()])
+            written = len(transactions)
+            _refresh_pivots(conn, None)
+        else:
+            mode = 'incremental'
+            months = set()
+            # Имя жильца денормализовано в строки транзакций и сводных таблиц
+            for apt_id in changed['apartments']:
+                apt = apartments[apt_id]
+                conn.execute("INSERT OR REPLACE INTO apartments VALUES (?, ?, ?, ?)", (apt.id, apt.number, apt.full_name, apt.phone))
+                conn.execute("UPDATE transactions SET apartment_number = ?, full_name = ? WHERE apartment_id = ?", (apt.number, apt.full_name, apt.id))
+                months.update(m for (m,) in conn.execute("SELECT DISTINCT month FROM transactions WHERE apartment_id = ?", (apt.id,)))
+            for cat_id in changed['deleted_categories']:
+                months.update(m for (m,) in conn.execute("SELECT DISTINCT month FROM transactions WHERE category_id = ?", (cat_id,)))
+                conn.execute("DELETE FROM transactions WHERE category_id = ?", (cat_id,))
+            for cat_id in changed['categories']:
+                if cat_id in categories:
+                    conn.execute("INSERT OR REPLACE INTO categories VALUES (?, ?, ?, ?, ?, ?, ?, ?)", _analytics_category_row(categories[cat_id]))
+                    conn.execute("UPDATE transactions SET category_name = ? WHERE category_id = ?", (categories[cat_id].name, cat_id))
+                else:
+                    conn.execute("DELETE FROM categories WHERE id = ?", (cat_id,))
+            written = 0
+            for trans_id in changed['transactions']:
+                old = conn.execute("SELECT month FROM transactions WHERE id = ?", (trans_id,)).fetchone()
+                if old:
+                    months.add(old[0])
+                if trans_id in transactions:
+                    row = _analytics_transaction_row(transactions[trans_id], apartments, categories)
+                    conn.execute("INSERT OR REPLACE INTO transactions VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", row)
+                    months.add(row[1])
+                    written += 1
+                elif old:
+                    conn.execute("DELETE FROM transactions WHERE id = ?", (trans_id,))
+            if months:
+                _refresh_pivots(conn, months)
+
+        conn.executemany("INSERT OR REPLACE INTO export_meta VALUES (?, ?)", [
+            ('schema', str(SCHEMA_VERSION)), ('format', str(ANALYTICS_FORMAT)), ('seq', str(seq)), ('journal_offset', str(offset)),
+            ('exported_at', datetime.now().isoformat())
+        ])
+        conn.execute("COMMIT")
+    except BaseException:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+    return {'mode': mode, 'seq': seq, 'written': written, 'seconds': time.perf_counter() - started}
+
+
+# --- Нагрузочный тест: параллельные кассиры над одним каталогом данных ---
+
+def _load_test_clerk(task: Tuple[str, int, int, int, int]) -> Dict:
+    data_dir, clerk, operations, category_id, seed = task
+    rng = random.Random(seed)
+    db = Database(data_dir)
+    apartment_count = len(db.get_all_apartments())
+    latencies = {'add': [], 'update': [], 'balance': []}
+    # Ожидаемая сумма по примечанию: каждый кассир правит только свои платежи
+    expected: Dict[str, Tuple[int, int]] = {}
+    failures = 0
+    for n in range(operations):
+        apartment_id = rng.randrange(apartment_count)
+        roll = rng.random()
+        started = time.perf_counter()
+        try:
+            if roll < 0.4 or not expected:
+                op = 'add'
+                notes = f"load-{clerk}-{n}"
+                amount = rng.randint(100, 100000)
+                trans = db.add_transaction(apartment_id, category_id, amount, 'payment', 1, notes)
+                if trans:
+                    expected[notes] = (trans.id, amount)
+                else:
+                    failures += 1
+            elif roll < 0.7:
+                op = 'update'
+                notes = rng.choice(list(expected))
+                trans_id, _ = expected[notes]
+                amount = rng.randint(100, 100000)
+                if db.update_transaction(trans_id, amount, notes):
+                    expected[notes] = (trans_id, amount)
+                else:
+                    failures += 1
+            else:
+                op = 'balance'
+                db.get_apartment_balance(apartment_id)
+        except Exception:
+            failures += 1
+            continue
+        latencies[op].append(time.perf_counter() - started)
+    return {'latencies': latencies, 'expected': expected, 'failures': failures}
+
+
+def _percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+
+
+def run_load_test(data_dir: str, clerks: int = 8, operations: int = 200, processes: bool = False, seed: int = 1) -> Dict:
+    # Пишет в data_dir - запускать на копии данных
+    db = Database(data_dir)
+    # Категория может остаться от прошлого запуска в этом месяце - ищется по полному имени
+    now = datetime.now()
+    full_name = Database._period_name("Нагрузочный тест", now.year, now.month)
+    db.add_category("Нагрузочный тест", 0)
+    category_id = next(c.id for c in db.get_categories() if c.name == full_name)
+    tasks = [(str(data_dir), clerk, operations, category_id, seed + clerk) for clerk in range(clerks)]
+    executor = ProcessPoolExecutor if processes else ThreadPoolExecutor
+    started = time.perf_counter()
+    with executor(max_workers=clerks) as pool:
+        results = list(pool.map(_load_test_clerk, tasks))
+    elapsed = time.perf_counter() - started
+
+    latencies = {'add': [], 'update': [], 'balance': []}
+    expected = {}
+    failures = 0
+    for result in results:
+        for op, values in result['latencies'].items():
+            latencies[op].extend(values)
+        expected.update(result['expected'])
+        failures += result['failures']
+
+    # Проверка свежим экземпляром: всё, что кассиры считали записанным, должно быть на месте
+    check = Database(data_dir)
+    by_notes = {t.notes: t for t in check.get_transactions() if t.notes.startswith('load-')}
+    lost_inserts = sum(1 for notes in expected if notes not in by_notes)
+    lost_updates = sum(1 for notes, (_, amount) in expected.items() if notes in by_notes and by_notes[notes].amount != amount)
+    corruption = check.check_integrity()
+    for path in sorted(Path(data_dir).glob('*.json')):
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                json.load(f)
+        except ValueError:
+            corruption.append(f"{path.name}: повреждённый JSON")
+    total_ops = sum(len(values) for values in latencies.values())
+    return {
+        'mode': 'processes' if processes else 'threads',
+        'clerks': clerks,
+        'operations': total_ops,
+        'seconds': elapsed,
+        'throughput': total_ops / elapsed if elapsed else 0.0,
+        'latency_ms': {op: {'p50': _percentile(values, 0.5) * 1000, 'p99': _percentile(values, 0.99) * 1000, 'count': len(values)} for op, values in latencies.items()},
+        'failures': failures,
+        'lost_inserts': lost_inserts,
+        'lost_updates': lost_updates,
+        'corruption': corruption
+    }
 
-    def get_apartment(self, apt_id: int) -> Optional[Dict]:
-        apartments = self._load('apartments')
-        for apt in apartments:
-            if apt['id'] == apt_id:
-                return apt
-        return None
 
-    def update_apartment(self, apt_id: int, full_name: str, phone: str) -> bool:
-        apartments = self._load('apartments')
-        for apt in apartments:
-            if apt['id'] == apt_id:
-                apt['full_name'] = full_name
-                apt['phone'] = phone
-                return self._save('apartments', apartments)
-        return False
+def load_test_main(argv: List[str]):
+    parser = argparse.ArgumentParser(description="Нагрузочный тест хранилища (пишет в указанный каталог - используйте копию данных)")
+    parser.add_argument('data_dir')
+    parser.add_argument('--clerks', type=int, default=8)
+    parser.add_argument('--ops', type=int, default=200)
+    parser.add_argument('--processes', action='store_true', help="процессы вместо потоков")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args(argv)
+    report = run_load_test(args.data_dir, args.clerks, args.ops, args.processes, args.seed)
+    print(f"Режим: {report['mode']}, кассиров: {report['clerks']}, операций: {report['operations']} за {report['seconds']:.2f} с")
+    print(f"Пропускная способность: {report['throughput']:.1f} оп/с")
+    for op, stats in report['latency_ms'].items():
+        print(f"  {op:8} n={stats['count']:<6} p50={stats['p50']:.2f} мс  p99={stats['p99']:.2f} мс")
+    print(f"Ошибок: {report['failures']}, потерянных вставок: {report['lost_inserts']}, потерянных правок: {report['lost_updates']}")
+    print("Повреждения: " + ("; ".join(report['corruption']) if report['corruption'] else "нет"))
 
-    def get_all_apartments(self) -> List[Dict]:
-        return self._load('apartments')
 
-    def add_user(self, username: str, password: str) -> bool:
-        users = self._load('users')
-        if any(u['username'] == username for u in users):
-            return False
-        users.append({'id': len(users) + 1, 'username': username, 'password': password, 'role': 'user', 'created_at': datetime.now().isoformat()})
-        return self._save('users', users)
+# --- Модель представления: строки деревьев без Tk ---
 
-    def authenticate(self, username: str, password: str) -> Optional[Dict]:
-        users = self._load('users')
-        return next((u for u in users if u['username'] == username and u['password'] == password), None)
+@dataclass(slots=True)
+class TreeRow:
+    key: str
+    parent: str
+    text: str
+    values: Tuple
+    tags: Tuple[str, ...]
+    open: bool = False
+    payload: Optional[Dict] = None
 
-    def add_category(self, name: str, amount: float) -> bool:
-        categories = self._load('categories')
-        now = datetime.now()
-        month_name = MONTHS_RU[now.month]
-        year = now.year
-        full_name = f"{name} {month_name} {year}"
-        if any(c['name'] == full_name for c in categories):
-            return False
-        categories.append({'id': len(categories) + 1, 'name': full_name, 'amount': amount, 'created_at': datetime.now().isoformat()})
-        return self._save('categories', categories)
 
-    def get_categories(self) -> List[Dict]:
-        return self._load('categories')
+def _apartment_tag(balance: Dict) -> str:
+    return 'apartment_ok' if balance['debts'] == 0 or balance['balance'] >= 0 else 'apartment_debt'
 
-    def delete_category(self, cat_id: int) -> bool:
-        categories = self._load('categories')
-        self._save('categories', [c for c in categories if c['id'] != cat_id])
-        self.delete_transactions_by_category(cat_id)
-        return True
 
-    def delete_transactions_by_category(self, cat_id: int):
-        transactions = self._load('transactions')
-        self._save('transactions', [t for t in transactions if t['category_id'] != cat_id])
+def _category_status(balance: int) -> Tuple[str, str]:
+    return ("✅ Оплачено", 'paid') if balance >= 0 else ("⚠️ Имеется долг", 'unpaid')
 
-    def update_category(self, cat_id: int, name: str, amount: float) -> bool:
-        categories = self._load('categories')
-        for cat in categories:
-            if cat['id'] == cat_id:
-                cat['amount'] = amount
-                return self._save('categories', categories)
-        return False
 
-    def add_transaction(self, apartment_id: int, category_id: int, amount: float, trans_type: str, user_id: int, notes: str = "") -> bool:
-        transactions = self._load('transactions')
-        transactions.append({'id': len(transactions) + 1, 'apartment_id': apartment_id, 'category_id': category_id, 'amount': amount, 'type': trans_type, 'user_id': user_id, 'notes': notes, 'created_at': datetime.now().isoformat()})
-        return self._save('transactions', transactions)
+def _transaction_kind(trans: Transaction) -> Tuple[str, str]:
+    return ("💰 Платеж", 'payment') if trans.type == 'payment' else ("💸 Долг", 'debt')
 
-    def get_transactions(self, apartment_id: Optional[int] = None, category_id: Optional[int] = None) -> List[Dict]:
-        transactions = self._load('transactions')
-        if apartment_id is not None:
-            transactions = [t for t in transactions if t['apartment_id'] == apartment_id]
-        if category_id is not None:
-            transactions = [t for t in transactions if t['category_id'] == category_id]
-        return transactions
 
-    def delete_transaction(self, trans_id: int) -> bool:
-        transactions = self._load('transactions')
-        original_count = len(transactions)
-        new_transactions = [t for t in transactions if t['id'] != trans_id]
-        if len(new_transactions) < original_count:
-            return self._save('transactions', new_transactions)
-        return False
+def apartment_header_rows(apt: Apartment, balance: Dict, apt_index: int, aging: Optional[Dict[str, int]] = None) -> List[TreeRow]:
+    rows = []
+    if apt_index > 0:
+        rows.append(TreeRow(f"sep:{apt.id}", '', "─" * 100, ('─' * 15, '─' * 15, '─' * 15, '─' * 15, '─' * 15, '─' * 25, '─' * 15), ('separator',)))
+    apartment_tag = _apartment_tag(balance)
+    status_text = "✅ ОК" if apartment_tag == 'apartment_ok' else "❌ ДОЛЖНА"
+    # Самая старая непогашенная корзина
+    aging_text = ""
+    if aging:
+        overdue = [(label, amount) for label, amount in aging.items() if amount > 0]
+        aging_text = f"{overdue[-1][0]}: {format_money(overdue[-1][1])}" if overdue else "—"
+    rows.append(TreeRow(f"apt:{apt.id}", '', f"Кв. {apt.id + 1}",
+        (format_money(balance['balance'], signed=True), format_money(balance['paid']), format_money(balance['debts']), status_text, aging_text, apt.full_name[:30], apt.phone[:20]),
+        (apartment_tag,), open=True))
+    return rows
 
-    def update_transaction(self, trans_id: int, amount: float, notes: str) -> bool:
-        transactions = self._load('transactions')
-        found = False
-        for trans in transactions:
-            if trans['id'] == trans_id:
-                trans['amount'] = amount
-                trans['notes'] = notes
-                trans['updated_at'] = datetime.now().isoformat()
-                found = True
-                break
-        if found:
-            return self._save('transactions', transactions)
-        return False
 
-    def get_apartment_balance(self, apartment_id: int) -> Dict:
-        transactions = self.get_transactions(apartment_id=apartment_id)
-        valid_categories = {c['id'] for c in self.get_categories()}
-        transactions = [t for t in transactions if t['category_id'] in valid_categories]
-        total_paid = sum(t['amount'] for t in transactions if t['type'] == 'payment')
-        total_debts = sum(t['amount'] for t in transactions if t['type'] == 'debt')
-        balance = total_paid - total_debts
-        return {'apartment_id': apartment_id, 'paid': total_paid, 'debts': total_debts, 'balance': balance}
+def build_apartment_rows(distributions: Dict[int, Dict], aging: Dict[int, Dict[str, int]]) -> List[TreeRow]:
+    rows = []
+    for apt_index, (apt_id, dist) in enumerate(distributions.items()):
+        rows.extend(apartment_header_rows(dist['apartment'], dist['balance'], apt_index, aging.get(apt_id)))
+        by_category = dist['transactions']
+        if not by_category:
+            continue
+        apt_key = f"apt:{apt_id}"
+        for cat_info in dist['categories']:
+            cat_id = cat_info['id']
+            status_text, cat_tag = _category_status(cat_info['balance_after'])
+            cat_key = f"cat:{apt_id}:{cat_id}"
+            rows.append(TreeRow(cat_key, apt_key, f"{cat_info['name']} | {status_text}",
+                (format_money(cat_info['balance_after']), "", "", "", "", ""), (cat_tag, 'category'), open=True))
+            for trans in by_category.get(cat_id, ()):
+                trans_type, tag = _transaction_kind(trans)
+                rows.append(TreeRow(f"tx:{trans.id}", cat_key, f" {trans_type} ({trans.created_at.split('T')[0]})",
+                    (format_money(trans.amount), "", "", "", "", ""), (tag,)))
+    return rows
 
-    def get_categories_with_distribution(self, apartment_id: int) -> List[Dict]:
-        transactions = self.get_transactions(apartment_id=apartment_id)
-        valid_categories = {c['id'] for c in self.get_categories()}
-        transactions = [t for t in transactions if t['category_id'] in valid_categories]
-        categories = self.get_categories()
-        by_category = {}
-        for trans in transactions:
-            cat_id = trans['category_id']
+
+def build_transaction_rows(distributions: Dict[int, Dict]) -> List[TreeRow]:
+    rows = []
+    for apt_index, (apt_id, dist) in enumerate(distributions.items()):
+        if apt_index > 0:
+            rows.append(TreeRow(f"sep:{apt_id}", '', "─" * 80, ('─' * 20, '─' * 15, '─' * 15, '─' * 15, '─' * 15), ('separator',)))
+        apt_key = f"apt:{apt_id}"
+        rows.append(TreeRow(apt_key, '', f"Кв. {apt_id + 1}",
+            ("", "", "", "", format_money(dist['balance']['balance'], signed=True)), (_apartment_tag(dist['balance']),), open=True))
+        by_category = dist['transactions']
+        for cat_info in dist['categories']:
+            cat_id = cat_info['id']
             if cat_id not in by_category:
-                by_category[cat_id] = []
-            by_category[cat_id].append(trans)
-        categories_info = []
-        for cat in categories:
-            cat_id = cat['id']
-            cat_transactions = by_category.get(cat_id, [])
-            cat_paid = sum(t['amount'] for t in cat_transactions if t['type'] == 'payment')
-            cat_debts = sum(t['amount'] for t in cat_transactions if t['type'] == 'debt')
-            cat_balance_before = cat_paid - cat_debts
-            categories_info.append({'id': cat_id, 'name': cat['name'], 'paid': cat_paid, 'debts': cat_debts, 'balance_before': cat_balance_before, 'balance_after': cat_balance_before})
-        total_surplus = sum(cat['balance_before'] for cat in categories_info if cat['balance_before'] > 0)
-        if total_surplus > 0:
-            for i in range(len(categories_info) - 1, -1, -1):
-                if total_surplus <= 0:
-                    break
-                cat_info = categories_info[i]
-                if cat_info['balance_before'] < 0:
-                    debt_amount = abs(cat_info['balance_before'])
-                    to_use = min(debt_amount, total_surplus)
-                    cat_info['balance_after'] = cat_info['balance_before'] + to_use
-                    total_surplus -= to_use
-        return categories_info
+                continue
+            cat_name = cat_info['name']
+            status_text, cat_tag = _category_status(cat_info['balance_before'])
+            cat_key = f"cat:{apt_id}:{cat_id}"
+            rows.append(TreeRow(cat_key, apt_key, "", (f"{cat_name} | {status_text}", "", "", "", ""), (cat_tag,), open=True))
+            for trans in by_category[cat_id]:
+                trans_type, tag = _transaction_kind(trans)
+                date = trans.created_at.split('T')[0] if trans.created_at else '???'
+                rows.append(TreeRow(f"tx:{trans.id}", cat_key, "", (cat_name, trans_type, format_money(trans.amount), date, ""), (tag,),
+                    payload={'type': 'transaction', 'trans_id': trans.id, 'trans_type': trans.type, 'amount': trans.amount}))
+    return rows
 
-    def get_all_balances(self) -> List[Dict]:
-        apartments = self._load('apartments')
-        return [self.get_apartment_balance(apt['id']) for apt in apartments]
+
+class ViewModel:
+    # Строки деревьев считаются один раз на версию данных и переиспользуются всеми вкладками
+    def __init__(self, db: Database):
+        self.db = db
+        self._version = None
+        self._cache: Dict[str, Any] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def _cached(self, name: str, build: Callable[[], Any]) -> Any:
+        # Просрочка зависит от сегодняшней даты, поэтому она входит в версию
+        version = (self.db.get_data_version(), datetime.now().date())
+        if version != self._version:
+            self._version = version
+            self._cache.clear()
+        if name in self._cache:
+            self.hits += 1
+        else:
+            self.misses += 1
+            self._cache[name] = build()
+        return self._cache[name]
+
+    def distributions(self) -> Dict[int, Dict]:
+        return self._cached('distributions', self.db.get_all_distributions)
+
+    def apartment_rows(self) -> List[TreeRow]:
+        return self._cached('apartments', lambda: build_apartment_rows(self.distributions(), self.db.get_debt_aging()))
+
+    def transaction_rows(self) -> List[TreeRow]:
+        return self._cached('transactions', lambda: build_transaction_rows(self.distributions()))
+
+
+def benchmark_view_model(db: Database, repeat: int = 5) -> Dict[str, float]:
+    # Среднее время построения строк без кэша, в секундах; дисплей не нужен
+    timings = {'distributions': 0.0, 'apartment_rows': 0.0, 'transaction_rows': 0.0}
+    for _ in range(repeat):
+        started = time.perf_counter()
+        distributions = db.get_all_distributions()
+        aging = db.get_debt_aging()
+        timings['distributions'] += time.perf_counter() - started
+        started = time.perf_counter()
+        build_apartment_rows(distributions, aging)
+        timings['apartment_rows'] += time.perf_counter() - started
+        started = time.perf_counter()
+        build_transaction_rows(distributions)
+        timings['transaction_rows'] += time.perf_counter() - started
+    return {name: total / repeat for name, total in timings.items()}
+
+
+def render_rows(tree: ttk.Treeview, rows: List[TreeRow], apartment_ids: Optional[Set[int]] = None):
+    # apartment_ids - перерисовать только строки этих квартир, остальные элементы дерева не трогаются
+    if apartment_ids is None or not all(tree.exists(f"apt:{apt_id}") for apt_id in apartment_ids):
+        tree.delete(*tree.get_children())
+        for row in rows:
+            tree.insert(row.parent, 'end', iid=row.key, text=row.text, values=row.values, tags=row.tags, open=row.open)
+        return
+    current = None
+    for row in rows:
+        if not row.parent:
+            if row.key.startswith('apt:'):
+                current = int(row.key[4:])
+                if current in apartment_ids:
+                    tree.delete(*tree.get_children(row.key))
+                    tree.item(row.key, text=row.text, values=row.values, tags=row.tags)
+            continue
+        if current in apartment_ids:
+            tree.insert(row.parent, 'end', iid=row.key, text=row.text, values=row.values, tags=row.tags, open=row.open)
 
 
 class LoginWindow(tk.Tk):
@@ -213,6 +3049,7 @@ class LoginWindow(tk.Tk):
         super().__init__()
         self.db = db
         self.user = None
+        self.session_token = None
         self.title("Управление расходами подъезда - Вход")
         
         width, height = 500, 450
@@ -271,9 +3108,10 @@ class LoginWindow(tk.Tk):
         if not username or not password:
             messagebox.showwarning("Ошибка", "Заполните все поля!")
             return
-        user = self.db.authenticate(username, password)
-        if user:
-            self.user = user
+        token = self.db.login(username, password)
+        if token:
+            self.session_token = token
+            self.user = self.db.validate_session(token)
             self.destroy()
         else:
             messagebox.showerror("Ошибка входа", "Неверные учетные данные!")
@@ -300,18 +3138,21 @@ class LoginWindow(tk.Tk):
 
 
 class MainWindow(tk.Tk):
-    def __init__(self, db, user):
+    def __init__(self, db, user, started_at: Optional[float] = None):
         super().__init__()
         self.db = db
         self.user = user
         # Правильная проверка роли
-        self.is_admin = user.get('role') == 'admin'
+        self.is_admin = user.role == 'admin'
         
         self.selected_category = None
         self.selected_item_id = None
         self.transaction_mapping = {}
         self.selected_apartment_id = None
-        self.title(f"Управление расходами подъезда v{APP_VERSION} - {user['username']}")
+        self.view_model = ViewModel(db)
+        self.started_at = started_at if started_at is not None else time.perf_counter()
+        self.startup_time = None
+        self.title(f"Управление расходами подъезда v{APP_VERSION} - {user.username}")
         self.geometry("1400x750")
         self.resizable(True, True)
         self.state('normal')
@@ -325,43 +3166,52 @@ class MainWindow(tk.Tk):
         self.notebook.add(self.apartments_tab, text="🏠 Квартиры")
         self.create_apartments_tab()
         
-        # Проверяем is_admin правильно
+        # Вкладки строятся при первом открытии
+        self._tab_builders = {}
+        self._built_tabs = set()
+        self.dashboard_tab = tk.Frame(self.notebook, bg='white')
+        self.notebook.add(self.dashboard_tab, text="📈 Динамика")
+        self._tab_builders[str(self.dashboard_tab)] = self.create_dashboard_tab
         if self.is_admin:
             self.transactions_tab = tk.Frame(self.notebook, bg='white')
             self.notebook.add(self.transactions_tab, text="💰 Транзакции")
-            self.create_transactions_tab()
+            self._tab_builders[str(self.transactions_tab)] = self.create_transactions_tab
             
             self.admin_tab = tk.Frame(self.notebook, bg='white')
             self.notebook.add(self.admin_tab, text="⚙️ Администрирование")
-            self.create_admin_tab()
+            self._tab_builders[str(self.admin_tab)] = self.create_admin_tab
         
         self.notebook.bind("<<NotebookTabChanged>>", self.on_tab_changed)
         
-        self.fix_existing_categories()
-        self.update_category_combo()
+        # Первый показ - из сохранённых итогов, полное дерево строится после отрисовки окна
+        self.render_cached_summary()
+        self.after_idle(self.on_first_paint)
         self.after(100, self.refresh_apartments)
+        if self.is_admin:
+            self.after(200, lambda: self.run_recurring_accruals(notify=False))
 
-    def fix_existing_categories(self):
-        categories = self.db.get_categories()
-        now = datetime.now()
-        month_name = MONTHS_RU[now.month]
-        year = now.year
-        needs_update = False
-        for cat in categories:
-            if not any(month in cat['name'] for month in MONTHS_RU.values()):
-                cat['name'] = f"{cat['name']} {month_name} {year}"
-                needs_update = True
-        if needs_update:
-            self.db._save('categories', categories)
+    def on_first_paint(self):
+        self.startup_time = time.perf_counter() - self.started_at
+        self.startup_label.config(text=f"⏱ Запуск: {self.startup_time:.2f} с")
+
+    def ensure_tab_built(self, tab):
+        tab = str(tab)
+        if tab in self._tab_builders and tab not in self._built_tabs:
+            self._built_tabs.add(tab)
+            self._tab_builders[tab]()
 
     def on_tab_changed(self, event):
         selected_tab = self.notebook.select()
         tab_text = self.notebook.tab(selected_tab, "text")
+        self.ensure_tab_built(selected_tab)
         
         if "Квартиры" in tab_text:
             self.refresh_apartments()
+        elif "Динамика" in tab_text:
+            self.draw_dashboard()
         elif self.is_admin and "Администрирование" in tab_text:
             self.refresh_categories()
+            self.refresh_recurring()
             self.refresh_apartments_list()
         elif self.is_admin and "Транзакции" in tab_text:
             self.update_category_combo()
@@ -375,25 +3225,101 @@ class MainWindow(tk.Tk):
         version_label = tk.Label(top_frame, text=f"Версия: {APP_VERSION}", font=("Arial", 8), bg='#0078D4', fg='#FFD700')
         version_label.pack(side=tk.LEFT, padx=10, pady=10)
         role_text = "👑 АДМИНИСТРАТОР" if self.is_admin else "👤 Обычный пользователь"
-        user_label = tk.Label(top_frame, text=f"{role_text} - {self.user['username']}", font=("Arial", 10, "bold"), bg='#0078D4', fg='white')
+        user_label = tk.Label(top_frame, text=f"{role_text} - {self.user.username}", font=("Arial", 10, "bold"), bg='#0078D4', fg='white')
         user_label.pack(side=tk.RIGHT, padx=15, pady=10)
+        self.startup_label = tk.Label(top_frame, text="", font=("Arial", 8), bg='#0078D4', fg='#FFD700')
+        self.startup_label.pack(side=tk.RIGHT, padx=10, pady=10)
+        if self.is_admin:
+            redo_btn = tk.Button(top_frame, text="↪️ Повторить", command=self.redo, bg='#005A9E', fg='white', font=("Arial", 9, "bold"))
+            redo_btn.pack(side=tk.RIGHT, padx=3, pady=10)
+            undo_btn = tk.Button(top_frame, text="↩️ Отменить", command=self.undo, bg='#005A9E', fg='white', font=("Arial", 9, "bold"))
+            undo_btn.pack(side=tk.RIGHT, padx=3, pady=10)
+            self.bind('<Control-z>', lambda e: self.undo())
+            self.bind('<Control-y>', lambda e: self.redo())
+
+    def undo(self):
+        label = self.db.get_undo_label()
+        if label is None:
+            messagebox.showinfo("Отмена", "Нечего отменять.")
+            return
+        command = self.db.undo()
+        if command is None:
+            messagebox.showwarning("⚠️ Отмена", f"Нельзя отменить «{label}»: эти записи уже изменены.")
+            return
+        self.refresh_changed(command['changes'])
+
+    def redo(self):
+        label = self.db.get_redo_label()
+        if label is None:
+            messagebox.showinfo("Повтор", "Нечего повторять.")
+            return
+        command = self.db.redo()
+        if command is None:
+            messagebox.showwarning("⚠️ Повтор", f"Нельзя повторить «{label}»: эти записи уже изменены.")
+            return
+        self.refresh_changed(command['changes'])
+
+    def refresh_changed(self, changes: List[Tuple]):
+        # Перерисовываются только квартиры, которых касались изменения
+        apartment_ids = affected_apartments(changes)
+        render_rows(self.apartments_tree, self.view_model.apartment_rows(), apartment_ids)
+        if hasattr(self, 'transactions_tree'):
+            rows = self.view_model.transaction_rows()
+            render_rows(self.transactions_tree, rows, apartment_ids)
+            self.transaction_mapping = {row.key: row.payload for row in rows if row.payload}
+            self.selected_item_id = None
+        if apartment_ids is None:
+            self.refresh_categories()
+            self.update_category_combo()
+        if "Динамика" in self.notebook.tab(self.notebook.select(), "text"):
+            self.draw_dashboard()
 
     def create_apartments_tab(self):
         btn_frame = tk.Frame(self.apartments_tab, bg='white')
         btn_frame.pack(fill=tk.X, padx=10, pady=10)
         export_btn = tk.Button(btn_frame, text="💾 Экспорт CSV", command=self.export_report, bg='#107C10', fg='white', font=("Arial", 10, "bold"))
         export_btn.pack(side=tk.LEFT, padx=5)
+        aging_btn = tk.Button(btn_frame, text="⏳ Отчет по просрочке", command=self.export_aging_report, bg='#C91130', fg='white', font=("Arial", 10, "bold"))
+        aging_btn.pack(side=tk.LEFT, padx=5)
+        statements_btn = tk.Button(btn_frame, text="🧾 Выписки", command=self.export_statements, bg='#5C2D91', fg='white', font=("Arial", 10, "bold"))
+        statements_btn.pack(side=tk.LEFT, padx=5)
+        analytics_btn = tk.Button(btn_frame, text="📊 Аналитика SQLite", command=self.export_analytics, bg='#5C2D91', fg='white', font=("Arial", 10, "bold"))
+        analytics_btn.pack(side=tk.LEFT, padx=5)
         refresh_btn = tk.Button(btn_frame, text="🔄 Обновить", command=self.refresh_apartments, bg='#0078D4', fg='white', font=("Arial", 10, "bold"))
         refresh_btn.pack(side=tk.LEFT, padx=5)
+        as_of_btn = tk.Button(btn_frame, text="📅 Баланс на дату", command=self.show_balances_as_of, bg='#5C2D91', fg='white', font=("Arial", 10, "bold"))
+        as_of_btn.pack(side=tk.RIGHT, padx=5)
+        self.as_of_entry = tk.Entry(btn_frame, font=("Arial", 10), width=12)
+        self.as_of_entry.insert(0, datetime.now().strftime('%Y-%m-%d'))
+        self.as_of_entry.pack(side=tk.RIGHT, padx=5)
+
+        search_frame = tk.Frame(self.apartments_tab, bg='white')
+        search_frame.pack(fill=tk.X, padx=10)
+        tk.Label(search_frame, text="🔍 Поиск (ФИО, телефон, примечание):", bg='white', font=("Arial", 9)).pack(side=tk.LEFT, padx=5)
+        self.search_var = tk.StringVar()
+        search_entry = tk.Entry(search_frame, textvariable=self.search_var, font=("Arial", 10), width=40)
+        search_entry.pack(side=tk.LEFT, padx=5, fill=tk.X, expand=True)
+        search_entry.bind('<KeyRelease>', lambda e: self.run_search())
+        search_entry.bind('<Escape>', lambda e: (self.search_var.set(''), self.run_search()))
+        
+        self.search_results_tree = ttk.Treeview(self.apartments_tab, columns=('Кв', 'Тип', 'Текст'), height=5, show='headings')
+        self.search_results_tree.column('Кв', anchor=tk.CENTER, width=60, stretch=tk.NO)
+        self.search_results_tree.column('Тип', anchor=tk.CENTER, width=120, stretch=tk.NO)
+        self.search_results_tree.column('Текст', anchor=tk.W, width=600)
+        for col in ('Кв', 'Тип', 'Текст'):
+            self.search_results_tree.heading(col, text=col)
+        self.search_results_tree.bind('<<TreeviewSelect>>', self.on_search_result_select)
+        self.search_results = {}
 
         tree_frame = tk.Frame(self.apartments_tab, bg='white')
         tree_frame.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
+        self.apartments_tree_frame = tree_frame
         scrollbar = ttk.Scrollbar(tree_frame, orient=tk.VERTICAL)
         scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
         hsb = ttk.Scrollbar(tree_frame, orient=tk.HORIZONTAL)
         hsb.pack(side=tk.BOTTOM, fill=tk.X)
 
-        self.apartments_tree = ttk.Treeview(tree_frame, columns=('Баланс', 'Платежи', 'Долги', 'Статус', 'ФИО', 'Телефон'), height=20, yscrollcommand=scrollbar.set, xscrollcommand=hsb.set)
+        self.apartments_tree = ttk.Treeview(tree_frame, columns=('Баланс', 'Платежи', 'Долги', 'Статус', 'Просрочка', 'ФИО', 'Телефон'), height=20, yscrollcommand=scrollbar.set, xscrollcommand=hsb.set)
         scrollbar.config(command=self.apartments_tree.yview)
         hsb.config(command=self.apartments_tree.xview)
 
@@ -402,6 +3328,7 @@ class MainWindow(tk.Tk):
         self.apartments_tree.column('Платежи', anchor=tk.CENTER, width=100)
         self.apartments_tree.column('Долги', anchor=tk.CENTER, width=100)
         self.apartments_tree.column('Статус', anchor=tk.CENTER, width=100)
+        self.apartments_tree.column('Просрочка', anchor=tk.CENTER, width=130)
         self.apartments_tree.column('ФИО', anchor=tk.W, width=150)
         self.apartments_tree.column('Телефон', anchor=tk.CENTER, width=100)
 
@@ -410,6 +3337,7 @@ class MainWindow(tk.Tk):
         self.apartments_tree.heading('Платежи', text='Платежи', anchor=tk.CENTER)
         self.apartments_tree.heading('Долги', text='Долги', anchor=tk.CENTER)
         self.apartments_tree.heading('Статус', text='Статус', anchor=tk.CENTER)
+        self.apartments_tree.heading('Просрочка', text='⏳ Просрочка, дн.', anchor=tk.CENTER)
         self.apartments_tree.heading('ФИО', text='👤 ФИО', anchor=tk.W)
         self.apartments_tree.heading('Телефон', text='📱 Тел', anchor=tk.CENTER)
 
@@ -425,107 +3353,134 @@ class MainWindow(tk.Tk):
         self.apartments_tree.tag_configure('separator', background='#d0d0d0', foreground='#999999')
 
     def refresh_apartments(self):
-        for item in self.apartments_tree.get_children():
-            self.apartments_tree.delete(item)
-        
-        apartments = self.db.get_all_apartments()
-        
-        for apt_index, apt in enumerate(apartments):
-            apt_id = apt['id']
-            balance = self.db.get_apartment_balance(apt_id)
-            apt_num = apt_id + 1
-            
-            if apt_index > 0:
-                separator_line = "─" * 100
-                self.apartments_tree.insert('', 'end',
-                    text=separator_line,
-                    values=('─' * 15, '─' * 15, '─' * 15, '─' * 15, '─' * 25, '─' * 15),
-                    tags=('separator',))
-            
-            if balance['debts'] == 0 or balance['balance'] >= 0:
-                apartment_tag = 'apartment_ok'
-                status_text = "✅ ОК"
-            else:
-                apartment_tag = 'apartment_debt'
-                status_text = "❌ ДОЛЖНА"
-            
-            balance_text = f"+{balance['balance']:.2f}" if balance['balance'] > 0 else f"{balance['balance']:.2f}"
-            full_name = apt.get('full_name', '')[:30]
-            phone = apt.get('phone', '')[:20]
-            
-            apt_parent = self.apartments_tree.insert('', 'end',
-                text=f"Кв. {apt_num}",
-                values=(balance_text, f"{balance['paid']:.2f}", f"{balance['debts']:.2f}", status_text, full_name, phone),
-                tags=(apartment_tag,))
-            
-            self.apartments_tree.item(apt_parent, open=True)
-            
-            transactions = self.db.get_transactions(apartment_id=apt_id)
-            valid_categories = {c['id'] for c in self.db.get_categories()}
-            transactions = [t for t in transactions if t['category_id'] in valid_categories]
-            
-            if transactions:
-                by_category = {}
-                for trans in transactions:
-                    cat_id = trans['category_id']
-                    if cat_id not in by_category:
-                        by_category[cat_id] = []
-                    by_category[cat_id].append(trans)
-                
-                categories_info = self.db.get_categories_with_distribution(apt_id)
-                
-                for cat_info in categories_info:
-                    cat_id = cat_info['id']
-                    cat_name = cat_info['name']
-                    balance_after = cat_info['balance_after']
-                    
-                    if balance_after >= 0:
-                        status_text = "✅ Оплачено"
-                        cat_tag = 'paid'
-                    else:
-                        status_text = "⚠️ Имеется долг"
-                        cat_tag = 'unpaid'
-                    
-                    cat_display_name = f"{cat_name} | {status_text}"
-                    
-                    cat_parent = self.apartments_tree.insert(apt_parent, 'end',
-                        text=cat_display_name,
-                        values=(f"{balance_after:.2f}", "", "", "", "", ""),
-                        tags=(cat_tag, 'category'))
-                    
-                    self.apartments_tree.item(cat_parent, open=True)
-                    
-                    if cat_id in by_category:
-                        for trans in by_category[cat_id]:
-                            trans_type = "💰 Платеж" if trans['type'] == 'payment' else "💸 Долг"
-                            tag = 'payment' if trans['type'] == 'payment' else 'debt'
-                            date = trans['created_at'].split('T')[0]
-                            
-                            self.apartments_tree.insert(cat_parent, 'end',
-                                text=f" {trans_type} ({date})",
-                                values=(f"{trans['amount']:.2f}", "", "", "", "", ""),
-                                tags=(tag,))
-        
+        render_rows(self.apartments_tree, self.view_model.apartment_rows())
         self.apartments_tree.update()
 
+    def run_search(self):
+        query = self.search_var.get().strip()
+        for item in self.search_results_tree.get_children():
+            self.search_results_tree.delete(item)
+        self.search_results.clear()
+        if not query:
+            self.search_results_tree.pack_forget()
+            return
+        for result in self.db.search(query):
+            if result['kind'] == 'apartment':
+                kind_text = "👤 Жилец"
+                text = result['text']
+            else:
+                kind_text = "💰 Платеж" if result['type'] == 'payment' else "💸 Долг"
+                text = f"{result['text']} | {format_money(result['amount'])} | {result['created_at'].split('T')[0]}"
+            item = self.search_results_tree.insert('', 'end', values=(result['apartment_id'] + 1, kind_text, text))
+            self.search_results[item] = result
+        if not self.search_results_tree.winfo_ismapped():
+            self.search_results_tree.pack(fill=tk.X, padx=10, pady=(5, 0), before=self.apartments_tree_frame)
+
+    def on_search_result_select(self, event):
+        selected = self.search_results_tree.selection()
+        if not selected or selected[0] not in self.search_results:
+            return
+        item = f"apt:{self.search_results[selected[0]]['apartment_id']}"
+        if self.apartments_tree.exists(item):
+            self.apartments_tree.selection_set(item)
+            self.apartments_tree.see(item)
+
+    def render_cached_summary(self) -> bool:
+        summary = self.db.get_cached_summary()
+        if not summary:
+            return False
+        rows = []
+        for apt_index, row in enumerate(summary):
+            rows.extend(apartment_header_rows(Apartment.from_dict(row), row, apt_index))
+        render_rows(self.apartments_tree, rows)
+        return True
+
+    def show_balances_as_of(self):
+        try:
+            day = datetime.strptime(self.as_of_entry.get().strip(), '%Y-%m-%d')
+        except ValueError:
+            messagebox.showerror("❌ Ошибка", "Дата должна быть в формате ГГГГ-ММ-ДД!")
+            return
+        as_of = day.replace(hour=23, minute=59, second=59)
+        lines = []
+        for dist in self.db.get_all_distributions(as_of=as_of).values():
+            bal = dist['balance']
+            lines.append(f"Кв. {bal['apartment_id'] + 1}: {format_money(bal['balance'], signed=True)} (платежи {format_money(bal['paid'])}, долги {format_money(bal['debts'])})")
+        messagebox.showinfo(f"📅 Баланс на {day.strftime('%d.%m.%Y')}", "\n".join(lines))
+
+    def export_statements(self):
+        try:
+            out_dir = f"выписки_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+            self.config(cursor="watch")
+            self.update_idletasks()
+            paths = generate_statements(self.db, out_dir)
+            messagebox.showinfo("✅ Успех", f"Выписки сформированы: {len(paths)}\n📁 Папка: {out_dir}")
+        except Exception as e:
+            messagebox.showerror("❌ Ошибка", f"Ошибка при формировании выписок: {e}")
+        finally:
+            self.config(cursor="")
+
+    def export_analytics(self):
+        # Один и тот же файл обновляется инкрементально при каждом нажатии
+        filename = "аналитика.sqlite"
+        try:
+            self.config(cursor="watch")
+            self.update_idletasks()
+            result = export_analytics(self.db, filename)
+            mode = "полная выгрузка" if result['mode'] == 'full' else "обновление"
+            messagebox.showinfo("✅ Успех", f"Аналитика выгружена ({mode}, записей: {result['written']}) за {result['seconds']:.2f} с\n📁 Файл: {filename}")
+        except Exception as e:
+            messagebox.showerror("❌ Ошибка", f"Ошибка при выгрузке аналитики: {e}")
+        finally:
+            self.config(cursor="")
+
+    def export_aging_report(self):
+        try:
+            filename = f"просрочка_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
+            aging = self.db.get_debt_aging()
+            apartments = {apt.id: apt for apt in self.db.get_all_apartments()}
+            labels = [label for _, label in AGING_BUCKETS]
+            with open(filename, 'w', encoding='utf-8-sig', newline='') as f:
+                writer = csv.writer(f, delimiter=';', quoting=csv.QUOTE_MINIMAL)
+                writer.writerow(['Квартира', 'ФИО', 'Телефон'] + [f'{label} дн. (руб.)' for label in labels] + ['Итого долг (руб.)'])
+                for apt_id, buckets in aging.items():
+                    apt = apartments[apt_id]
+                    writer.writerow([f'Кв. {apt_id + 1}', apt.full_name, apt.phone] + [format_money(buckets[label]) for label in labels] + [format_money(sum(buckets.values()))])
+            messagebox.showinfo("✅ Успех", f"Отчет по просрочке сохранен!\n📁 Файл: {filename}")
+        except Exception as e:
+            messagebox.showerror("❌ Ошибка", f"Ошибка при сохранении: {e}")
+
     def export_report(self):
         try:
             filename = f"отчет_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
-            balances = self.db.get_all_balances()
-            apartments = self.db.get_all_apartments()
+            distributions = self.db.get_all_distributions()
             with open(filename, 'w', encoding='utf-8-sig', newline='') as f:
                 writer = csv.writer(f, delimiter=';', quoting=csv.QUOTE_MINIMAL)
                 writer.writerow(['Квартира', 'ФИО', 'Телефон', 'Платежи (руб.)', 'Долги (руб.)', 'Остаток (руб.)', 'Статус'])
-                for bal in balances:
+                for dist in distributions.values():
+                    bal = dist['balance']
+                    apt = dist['apartment']
                     apt_num = bal['apartment_id'] + 1
-                    apt = self.db.get_apartment(bal['apartment_id'])
                     status = 'ОК' if bal['balance'] >= 0 else 'ДОЛЖНА'
-                    writer.writerow([f'Кв. {apt_num}', apt.get('full_name', '') if apt else '', apt.get('phone', '') if apt else '', f'{bal["paid"]:.2f}', f'{bal["debts"]:.2f}', f'{bal["balance"]:.2f}', status])
+                    writer.writerow([f'Кв. {apt_num}', apt.full_name, apt.phone, format_money(bal['paid']), format_money(bal['debts']), format_money(bal['balance']), status])
             messagebox.showinfo("✅ Успех", f"Отчет успешно сохранен!\n📁 Файл: {filename}")
         except Exception as e:
             messagebox.showerror("❌ Ошибка", f"Ошибка при сохранении: {e}")
 
     def create_admin_tab(self):
+        tools_frame = tk.Frame(self.admin_tab, bg='white')
+        tools_frame.pack(fill=tk.X, padx=10, pady=(8, 0))
+        backup_btn = tk.Button(tools_frame, text="💾 Резервная копия", command=self.create_backup, bg='#107C10', fg='white', font=("Arial", 9, "bold"))
+        backup_btn.pack(side=tk.LEFT, padx=3)
+        restore_btn = tk.Button(tools_frame, text="♻️ Восстановить из копии", command=self.restore_backup_window, bg='#FFB900', fg='black', font=("Arial", 9, "bold"))
+        restore_btn.pack(side=tk.LEFT, padx=3)
+        diagnostics_btn = tk.Button(tools_frame, text="🩺 Диагностика", command=self.diagnostics_window, bg='#0078D4', fg='white', font=("Arial", 9, "bold"))
+        diagnostics_btn.pack(side=tk.LEFT, padx=3)
+        meters_btn = tk.Button(tools_frame, text="⚡ Счётчики", command=self.meters_window, bg='#5C2D91', fg='white', font=("Arial", 9, "bold"))
+        meters_btn.pack(side=tk.LEFT, padx=3)
+        sync_btn = tk.Button(tools_frame, text="🔁 Синхронизация", command=self.sync_window, bg='#0078D4', fg='white', font=("Arial", 9, "bold"))
+        sync_btn.pack(side=tk.LEFT, padx=3)
+        
         main_container = tk.Frame(self.admin_tab, bg='white')
         main_container.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
         left_frame = tk.LabelFrame(main_container, text="📦 Управление категориями", font=("Arial", 11, "bold"), bg='white')
@@ -584,6 +3539,34 @@ class MainWindow(tk.Tk):
         self.categories_tree.pack(fill=tk.BOTH, expand=True)
         self.categories_tree.bind('<<TreeviewSelect>>', self.on_category_select)
         
+        recurring_frame = tk.LabelFrame(main_container, text="🔁 Регулярные начисления", font=("Arial", 11, "bold"), bg='white')
+        recurring_frame.pack(side=tk.LEFT, fill=tk.BOTH, expand=True, padx=5, pady=5)
+        
+        tk.Label(recurring_frame, text="Название:", bg='white', font=("Arial", 9)).pack(anchor='w', padx=10, pady=(10, 0))
+        self.rec_name_entry = tk.Entry(recurring_frame, font=("Arial", 9), width=25)
+        self.rec_name_entry.pack(pady=3, padx=10)
+        
+        tk.Label(recurring_frame, text="Сумма (руб.) в месяц на все квартиры:", bg='white', font=("Arial", 9)).pack(anchor='w', pady=(5, 0), padx=10)
+        self.rec_amount_entry = tk.Entry(recurring_frame, font=("Arial", 9), width=25)
+        self.rec_amount_entry.pack(pady=3, padx=10)
+        
+        tk.Label(recurring_frame, text="День месяца (1-28):", bg='white', font=("Arial", 9)).pack(anchor='w', pady=(5, 0), padx=10)
+        self.rec_day_entry = tk.Entry(recurring_frame, font=("Arial", 9), width=25)
+        self.rec_day_entry.insert(0, "1")
+        self.rec_day_entry.pack(pady=3, padx=10)
+        
+        rec_btn_frame = tk.Frame(recurring_frame, bg='white')
+        rec_btn_frame.pack(fill=tk.X, pady=10, padx=10)
+        tk.Button(rec_btn_frame, text="➕ Шаблон", command=self.add_recurring_charge, bg='#107C10', fg='white', font=("Arial", 9, "bold")).pack(side=tk.LEFT, padx=3, fill=tk.X, expand=True)
+        tk.Button(rec_btn_frame, text="🗑️ Удалить", command=self.delete_recurring_charge, bg='#C91130', fg='white', font=("Arial", 9, "bold")).pack(side=tk.LEFT, padx=3, fill=tk.X, expand=True)
+        tk.Button(recurring_frame, text="▶️ Начислить по расписанию", command=self.run_recurring_accruals, bg='#0078D4', fg='white', font=("Arial", 9, "bold")).pack(fill=tk.X, padx=10, pady=3)
+        
+        self.recurring_tree = ttk.Treeview(recurring_frame, columns=('ID', 'Название', 'Сумма', 'День', 'С'), height=10, show='headings')
+        for col, width in (('ID', 30), ('Название', 100), ('Сумма', 70), ('День', 40), ('С', 60)):
+            self.recurring_tree.column(col, anchor=tk.CENTER, width=width)
+            self.recurring_tree.heading(col, text=col, anchor=tk.CENTER)
+        self.recurring_tree.pack(fill=tk.BOTH, expand=True, padx=10, pady=5)
+        
         right_frame = tk.LabelFrame(main_container, text="🏠 Управление квартирами", font=("Arial", 11, "bold"), bg='white')
         right_frame.pack(side=tk.RIGHT, fill=tk.BOTH, expand=True, padx=5, pady=5)
         
@@ -633,18 +3616,310 @@ class MainWindow(tk.Tk):
         self.apartments_info_tree.pack(fill=tk.BOTH, expand=True)
         self.apartments_info_tree.bind('<<TreeviewSelect>>', self.on_apartment_info_select)
 
+    def create_backup(self):
+        try:
+            snapshot_id, stats = self.db.create_backup()
+            messagebox.showinfo("✅ Резервная копия", f"Копия {snapshot_id} создана.\n\nФайлов: {stats['files']}\nПрочитано: {stats['read_bytes'] // 1024} КБ\nНовых блоков: {stats['new_chunks']}\nПереиспользовано блоков: {stats['reused_chunks']}")
+        except Exception as e:
+            messagebox.showerror("❌ Ошибка", f"Не удалось создать копию: {e}")
+
+    def restore_backup_window(self):
+        snapshots = self.db.get_backup_store().list_snapshots()
+        if not snapshots:
+            messagebox.showwarning("Ошибка", "Резервных копий пока нет!")
+            return
+        window = tk.Toplevel(self)
+        window.title("Восстановление из резервной копии")
+        window.geometry("400x400")
+        window.grab_set()
+        tk.Label(window, text="Выберите копию (новые сверху):", font=("Arial", 10, "bold")).pack(anchor='w', padx=10, pady=10)
+        listbox = tk.Listbox(window, font=("Arial", 10))
+        listbox.pack(fill=tk.BOTH, expand=True, padx=10)
+        for snapshot_id in reversed(snapshots):
+            listbox.insert(tk.END, snapshot_id)
+        
+        def restore():
+            selected = listbox.curselection()
+            if not selected:
+                messagebox.showwarning("Ошибка", "Выберите копию!", parent=window)
+                return
+            snapshot_id = listbox.get(selected[0])
+            if not messagebox.askyesno("Подтверждение", f"Заменить текущие данные копией {snapshot_id}?", parent=window):
+                return
+            try:
+                self.db.restore_backup(snapshot_id)
+            except Exception as e:
+                messagebox.showerror("❌ Ошибка", f"Не удалось восстановить: {e}", parent=window)
+                return
+            window.destroy()
+            self.refresh_categories()
+            self.refresh_recurring()
+            self.refresh_apartments_list()
+            self.refresh_apartments()
+            self.refresh_transactions_tree()
+            self.update_category_combo()
+            messagebox.showinfo("✅ Успех", f"Данные восстановлены из копии {snapshot_id}.")
+        
+        tk.Button(window, text="♻️ Восстановить", command=restore, bg='#FFB900', font=("Arial", 10, "bold")).pack(fill=tk.X, padx=10, pady=10)
+
+    def meters_window(self):
+        window = tk.Toplevel(self)
+        window.title("Начисления по счётчикам")
+        window.geometry("620x520")
+        
+        form = tk.Frame(window)
+        form.pack(fill=tk.X, padx=10, pady=10)
+        tk.Label(form, text="Счётчик:", font=("Arial", 9)).grid(row=0, column=0, sticky='w')
+        meter_var = tk.StringVar()
+        meter_combo = ttk.Combobox(form, textvariable=meter_var, values=self.db.get_meters(), width=20)
+        meter_combo.grid(row=0, column=1, sticky='w', padx=5)
+        tk.Label(form, text="Период (ГГГГ-ММ):", font=("Arial", 9)).grid(row=0, column=2, sticky='w')
+        period_entry = tk.Entry(form, width=10)
+        period_entry.insert(0, datetime.now().strftime('%Y-%m'))
+        period_entry.grid(row=0, column=3, sticky='w', padx=5)
+        tk.Label(form, text="Тариф, руб. за ед.:", font=("Arial", 9)).grid(row=1, column=0, sticky='w', pady=5)
+        tariff_entry = tk.Entry(form, width=10)
+        tariff_entry.grid(row=1, column=1, sticky='w', padx=5)
+        
+        tree = ttk.Treeview(window, columns=('Кв', 'Расход', 'Тариф', 'Сумма'), height=14, show='headings')
+        for col in ('Кв', 'Расход', 'Тариф', 'Сумма'):
+            tree.heading(col, text=col)
+            tree.column(col, anchor=tk.CENTER, width=130)
+        tree.pack(fill=tk.BOTH, expand=True, padx=10)
+        status_label = tk.Label(window, text="", font=("Arial", 9), fg='#666666', justify=tk.LEFT)
+        status_label.pack(anchor='w', padx=10, pady=5)
+        
+        def on_meter_selected(event=None):
+            tariff = self.db.get_tariffs().get(meter_var.get().strip())
+            tariff_entry.delete(0, tk.END)
+            if tariff:
+                tariff_entry.insert(0, format_money(tariff['price']))
+            preview()
+        
+        def preview():
+            meter = meter_var.get().strip()
+            period = period_entry.get().strip()
+            tree.delete(*tree.get_children())
+            if not meter or not re.fullmatch(r'\d{4}-\d{2}', period):
+                return None
+            charges = self.db.compute_meter_charges(meter, period)
+            for apt_id, used, price, amount in zip(charges['apartments'], charges['usage'], charges['prices'], charges['amounts']):
+                tree.insert('', 'end', values=(apt_id + 1, format_reading(used), format_money(price), format_money(amount)))
+            notes = [f"Итого: {format_money(sum(charges['amounts']))} руб."]
+            if charges['missing']:
+                notes.append("Нет показаний: кв. " + ", ".join(str(a + 1) for a in charges['missing']))
+            if charges['negative']:
+                notes.append("Отрицательный расход: кв. " + ", ".join(str(a + 1) for a in charges['negative']))
+            status_label.config(text="\n".join(notes))
+            return charges
+        
+        def import_csv():
+            path = filedialog.askopenfilename(parent=window, title="Показания счётчиков", filetypes=[("CSV", "*.csv"), ("Все файлы", "*.*")])
+            if not path:
+                return
+            imported, errors = self.db.import_meter_readings(path)
+            meter_combo['values'] = self.db.get_meters()
+            preview()
+            text = f"Загружено показаний: {imported}"
+            if errors:
+                text += f"\n\nОшибок: {len(errors)}\n" + "\n".join(errors[:15])
+            messagebox.showinfo("📥 Импорт", text, parent=window)
+        
+        def save_tariff():
+            meter = meter_var.get().strip()
+            try:
+                price = parse_money(tariff_entry.get())
+            except ValueError:
+                messagebox.showerror("❌ Ошибка", "Тариф должен быть числом!", parent=window)
+                return
+            if not meter:
+                messagebox.showwarning("Ошибка", "Укажите счётчик!", parent=window)
+                return
+            self.db.set_tariff(meter, price)
+            meter_combo['values'] = self.db.get_meters()
+            preview()
+        
+        def bill():
+            meter = meter_var.get().strip()
+            period = period_entry.get().strip()
+            if not preview():
+                messagebox.showwarning("Ошибка", "Укажите счётчик и период ГГГГ-ММ!", parent=window)
+                return
+            category = self.db.bill_meter_readings(meter, period, self.user.id)
+            if category is None:
+                messagebox.showerror("❌ Ошибка", "Начисление уже есть или нечего начислять!", parent=window)
+                return
+            self.refresh_categories()
+            self.refresh_apartments()
+            self.refresh_transactions_tree()
+            self.update_category_combo()
+            messagebox.showinfo("✅ Успех", f"Категория '{category.name}' создана на {format_money(category.amount)} руб.", parent=window)
+        
+        meter_combo.bind('<<ComboboxSelected>>', on_meter_selected)
+        period_entry.bind('<Return>', lambda e: preview())
+        tk.Button(form, text="💾 Сохранить тариф", command=save_tariff, font=("Arial", 9)).grid(row=1, column=2, sticky='w')
+        btn_frame = tk.Frame(window)
+        btn_frame.pack(fill=tk.X, padx=10, pady=10)
+        tk.Button(btn_frame, text="📥 Загрузить CSV", command=import_csv, bg='#0078D4', fg='white', font=("Arial", 9, "bold")).pack(side=tk.LEFT, padx=3)
+        tk.Button(btn_frame, text="🔄 Пересчитать", command=preview, font=("Arial", 9, "bold")).pack(side=tk.LEFT, padx=3)
+        tk.Button(btn_frame, text="⚡ Начислить", command=bill, bg='#107C10', fg='white', font=("Arial", 9, "bold")).pack(side=tk.LEFT, padx=3)
+
+    def sync_window(self):
+        window = tk.Toplevel(self)
+        window.title("Синхронизация рабочих мест")
+        window.geometry("560x420")
+        info_label = tk.Label(window, text="", font=("Arial", 10), justify=tk.LEFT)
+        info_label.pack(anchor='w', padx=10, pady=10)
+        tk.Label(window, text="Известные узлы:", font=("Arial", 10, "bold")).pack(anchor='w', padx=10)
+        peers_tree = ttk.Treeview(window, columns=('Узел', 'Событий у узла', 'Последний обмен'), height=6, show='headings')
+        for col in ('Узел', 'Событий у узла', 'Последний обмен'):
+            peers_tree.heading(col, text=col)
+            peers_tree.column(col, anchor=tk.CENTER, width=170)
+        peers_tree.pack(fill=tk.X, padx=10)
+        
+        def refresh():
+            info = self.db.get_replication_info()
+            role = "основной" if info['number'] == 0 else f"клон №{info['number']}"
+            info_label.config(text=f"Этот узел: {info['node']} ({role})\nСвоих событий: {info['clock'].get(info['node'], 0)}")
+            peers_tree.delete(*peers_tree.get_children())
+            for node, peer in info['peers'].items():
+                peers_tree.insert('', 'end', values=(node, sum(peer['clock'].values()), peer['synced_at'][:16].replace('T', ' ')))
+        
+        def export_bundle():
+            path = filedialog.asksaveasfilename(parent=window, defaultextension=".sync", filetypes=[("Пакет синхронизации", "*.sync")],
+                                                initialfile=f"gailab_{datetime.now().strftime('%Y%m%d_%H%M')}.sync")
+            if not path:
+                return
+            count = self.db.export_sync_bundle(path)
+            messagebox.showinfo("✅ Выгружено", f"Событий в пакете: {count}\n\nПеренесите файл на другое рабочее место и загрузите его там.", parent=window)
+        
+        def import_bundle():
+            path = filedialog.askopenfilename(parent=window, filetypes=[("Пакет синхронизации", "*.sync")])
+            if not path:
+                return
+            try:
+                result = self.db.import_sync_bundle(path)
+            except (OSError, ValueError, KeyError) as e:
+                messagebox.showerror("❌ Ошибка", f"Не удалось загрузить пакет: {e}", parent=window)
+                return
+            refresh()
+            self.refresh_categories()
+            self.refresh_apartments_list()
+            self.refresh_apartments()
+            self.refresh_transactions_tree()
+            self.update_category_combo()
+            messagebox.showinfo("✅ Загружено", f"От узла {result['from']}:\nприменено событий: {result['applied']}\nуже были: {result['skipped']}", parent=window)
+        
+        def clone():
+            path = filedialog.askdirectory(parent=window, title="Пустая папка для данных второго рабочего места")
+            if not path:
+                return
+            try:
+                node = self.db.clone_replica(path)
+            except (OSError, ValueError) as e:
+                messagebox.showerror("❌ Ошибка", str(e), parent=window)
+                return
+            refresh()
+            messagebox.showinfo("✅ Готово", f"Создан узел {node}.\nСкопируйте эту папку на ноутбук как папку data рядом с программой.", parent=window)
+        
+        btn_frame = tk.Frame(window)
+        btn_frame.pack(fill=tk.X, padx=10, pady=10)
+        tk.Button(btn_frame, text="📤 Выгрузить пакет", command=export_bundle, bg='#107C10', fg='white', font=("Arial", 9, "bold")).pack(side=tk.LEFT, padx=3)
+        tk.Button(btn_frame, text="📥 Загрузить пакет", command=import_bundle, bg='#0078D4', fg='white', font=("Arial", 9, "bold")).pack(side=tk.LEFT, padx=3)
+        tk.Button(btn_frame, text="💻 Создать второе рабочее место", command=clone, bg='#5C2D91', fg='white', font=("Arial", 9, "bold")).pack(side=tk.LEFT, padx=3)
+        refresh()
+
+    def diagnostics_window(self):
+        window = tk.Toplevel(self)
+        window.title("Диагностика хранилища")
+        window.geometry("760x620")
+        
+        def make_tree(title, columns, height):
+            tk.Label(window, text=title, font=("Arial", 10, "bold")).pack(anchor='w', padx=10, pady=(8, 2))
+            tree = ttk.Treeview(window, columns=columns, height=height, show='headings')
+            for col in columns:
+                tree.heading(col, text=col)
+                tree.column(col, anchor=tk.CENTER, width=110)
+            tree.pack(fill=tk.X, padx=10)
+            return tree
+        
+        collections_tree = make_tree("📦 Коллекции", ('Коллекция', 'Записей', 'Размер, КБ', 'Загрузка, мс', 'Запись, мс'), 7)
+        caches_tree = make_tree("🎯 Кэши", ('Кэш', 'Попадания', 'Промахи', 'Доля попаданий'), 4)
+        slowest_tree = make_tree("🐢 Самые медленные недавние операции", ('Операция', 'Длительность, мс', 'Время'), 8)
+        status_label = tk.Label(window, text="", font=("Arial", 9), fg='#666666')
+        status_label.pack(anchor='w', padx=10, pady=5)
+        
+        def fmt_ms(value):
+            return f"{value:.1f}" if value is not None else "—"
+        
+        def refresh():
+            diagnostics = self.db.get_diagnostics()
+            for tree in (collections_tree, caches_tree, slowest_tree):
+                tree.delete(*tree.get_children())
+            for row in diagnostics['collections']:
+                size = f"{row['size'] / 1024:.1f}" if row['size'] is not None else "—"
+                collections_tree.insert('', 'end', values=(row['name'], row['rows'], size, fmt_ms(row['load_ms']), fmt_ms(row['save_ms'])))
+            caches = dict(diagnostics['caches'], view_model=(self.view_model.hits, self.view_model.misses))
+            for name, (hits, misses) in caches.items():
+                rate = f"{hits * 100 / (hits + misses):.0f}%" if hits + misses else "—"
+                caches_tree.insert('', 'end', values=(name, hits, misses, rate))
+            for elapsed, name, when in diagnostics['slowest']:
+                slowest_tree.insert('', 'end', values=(name, fmt_ms(elapsed), when))
+            status_label.config(text=f"Событий после последнего снимка: {diagnostics['events_since_snapshot']}")
+        
+        def prune_snapshots():
+            result = self.db.prune_snapshots()
+            refresh()
+            messagebox.showinfo("✅ Готово", f"Снимок обновлён.\nУдалено старых снимков: {result['removed_snapshots']}\nОсвобождено: {result['freed_bytes'] // 1024} КБ", parent=window)
+        
+        def rebuild():
+            elapsed = self.db.rebuild_indexes()
+            self.refresh_apartments()
+            refresh()
+            messagebox.showinfo("✅ Готово", f"Индексы и итоги перестроены за {elapsed:.2f} с", parent=window)
+        
+        def scan():
+            problems = self.db.check_integrity()
+            refresh()
+            if problems:
+                shown = "\n".join(problems[:20])
+                more = f"\n... и ещё {len(problems) - 20}" if len(problems) > 20 else ""
+                if messagebox.askyesno("⚠️ Найдены проблемы", f"Проблем: {len(problems)}\n\n{shown}{more}\n\nИсправить автоматически?", parent=window):
+                    repaired = self.db.repair_integrity()
+                    self.refresh_apartments()
+                    self.refresh_transactions_tree()
+                    refresh()
+                    remaining = len(self.db.check_integrity())
+                    messagebox.showinfo("🔧 Исправление", f"Исправлено: {sum(repaired.values())}\nОсталось проблем: {remaining}", parent=window)
+            else:
+                messagebox.showinfo("✅ Целостность", "Проблем не найдено", parent=window)
+        
+        btn_frame = tk.Frame(window)
+        btn_frame.pack(fill=tk.X, padx=10, pady=10)
+        tk.Button(btn_frame, text="🔄 Обновить", command=refresh, bg='#0078D4', fg='white', font=("Arial", 9, "bold")).pack(side=tk.LEFT, padx=3)
+        tk.Button(btn_frame, text="📸 Обновить снимок и удалить старые", command=prune_snapshots, bg='#5C2D91', fg='white', font=("Arial", 9, "bold")).pack(side=tk.LEFT, padx=3)
+        tk.Button(btn_frame, text="🔧 Перестроить индексы", command=rebuild, bg='#FFB900', fg='black', font=("Arial", 9, "bold")).pack(side=tk.LEFT, padx=3)
+        tk.Button(btn_frame, text="🩺 Проверить целостность", command=scan, bg='#107C10', fg='white', font=("Arial", 9, "bold")).pack(side=tk.LEFT, padx=3)
+        refresh()
+
     def on_category_select(self, event):
         selected = self.categories_tree.selection()
         if selected:
             item = selected[0]
             values = self.categories_tree.item(item)['values']
-            self.selected_category = {'id': int(values[0]), 'name': values[1], 'amount': float(values[2])}
+            self.selected_category = {'id': int(values[0]), 'name': values[1], 'amount': parse_money(values[2])}
 
     def edit_category_window(self):
         if not self.selected_category:
             messagebox.showwarning("Ошибка", "Выберите категорию для редактирования!")
             return
         
+        category = next((c for c in self.db.get_categories() if c.id == self.selected_category['id']), None)
+        if category and category.period and category.template_id is None:
+            # Начисление по счётчику: долги квартир - по расходу, а не равные доли
+            messagebox.showwarning("Ошибка", "Сумма начисления по счётчику считается по показаниям и не редактируется.\nУдалите категорию и выставьте счёт заново.")
+            return
+        
         edit_window = tk.Toplevel(self)
         edit_window.title("Редактировать категорию")
         edit_window.geometry("650x500")
@@ -671,14 +3946,15 @@ class MainWindow(tk.Tk):
         tk.Label(content_frame, text="Новая сумма на все квартиры (руб.):", bg='white', font=("Arial", 11, "bold"), fg='#333').pack(anchor='w', pady=(0, 8))
         
         amount_entry = tk.Entry(content_frame, font=("Arial", 11), width=60, relief=tk.SOLID, bd=1)
-        amount_entry.insert(0, str(self.selected_category['amount']))
+        amount_entry.insert(0, format_money(self.selected_category['amount']))
         amount_entry.pack(fill=tk.X, pady=(0, 20), ipady=10)
         amount_entry.focus()
         
+        apartments_count = len(self.db.get_all_apartments())
         info_frame = tk.Frame(content_frame, bg='#FFF9E6', relief=tk.SOLID, bd=1)
         info_frame.pack(fill=tk.X, pady=(0, 25))
         
-        info_text = tk.Label(info_frame, text=f"💡 На каждую квартиру: {float(self.selected_category['amount']) / 10:.2f} руб.\n\n⚠️ ВАЖНО: При изменении суммы категории,\nрассчёты обновятся для ВСЕХ квартир!\nВкладки 'Квартиры' и 'Транзакции' обновятся автоматически.", bg='#FFF9E6', font=("Arial", 9, "italic"), fg='#333', justify=tk.LEFT, wraplength=500)
+        info_text = tk.Label(info_frame, text=f"💡 На каждую квартиру: {format_money(split_amount(self.selected_category['amount'], apartments_count)[0])} руб.\n\n⚠️ ВАЖНО: При изменении суммы категории,\nрассчёты обновятся для ВСЕХ квартир!\nВкладки 'Квартиры' и 'Транзакции' обновятся автоматически.", bg='#FFF9E6', font=("Arial", 9, "italic"), fg='#333', justify=tk.LEFT, wraplength=500)
         info_text.pack(padx=10, pady=10)
         
         button_frame = tk.Frame(content_frame, bg='white')
@@ -692,7 +3968,7 @@ class MainWindow(tk.Tk):
                     return
                 
                 try:
-                    new_amount = float(new_amount_str)
+                    new_amount = parse_money(new_amount_str)
                 except ValueError:
                     messagebox.showerror("❌ Ошибка", "Сумма должна быть числом!")
                     return
@@ -703,16 +3979,11 @@ class MainWindow(tk.Tk):
                 
                 cat_id = self.selected_category['id']
                 
-                if self.db.update_category(cat_id, self.selected_category['name'], new_amount):
-                    transactions = self.db.get_transactions(category_id=cat_id)
-                    
-                    for trans in transactions:
-                        if trans['type'] == 'debt' and 'Начисление:' in trans.get('notes', ''):
-                            new_trans_amount = new_amount / 10
-                            self.db.update_transaction(trans['id'], new_trans_amount, trans.get('notes', ''))
+                if self.db.update_category_with_accruals(cat_id, new_amount):
+                    shares = split_amount(new_amount, apartments_count)
                     
                     messagebox.showinfo("✅ УСПЕШНО!",
-                        f"Категория обновлена!\n\nНазвание: {self.selected_category['name']}\nСумма: {new_amount:.2f} руб.\nНа кв-ру: {new_amount/10:.2f} руб.\n\n✓ Платежи сохранены!\n✓ Долги пересчитаны!")
+                        f"Категория обновлена!\n\nНазвание: {self.selected_category['name']}\nСумма: {format_money(new_amount)} руб.\nНа кв-ру: {format_money(shares[0])} руб.\n\n✓ Платежи сохранены!\n✓ Долги пересчитаны!")
                     
                     self.refresh_categories()
                     self.refresh_apartments()
@@ -733,11 +4004,13 @@ class MainWindow(tk.Tk):
         cancel_btn.pack(side=tk.LEFT, padx=5, fill=tk.X, expand=True)
 
     def refresh_categories(self):
+        if not hasattr(self, 'categories_tree'):
+            return
         for item in self.categories_tree.get_children():
             self.categories_tree.delete(item)
         categories = self.db.get_categories()
         for cat in categories:
-            self.categories_tree.insert('', 'end', values=(cat['id'], cat['name'], f"{cat['amount']:.2f}"))
+            self.categories_tree.insert('', 'end', values=(cat.id, cat.name, format_money(cat.amount)))
 
     def delete_category(self):
         if not self.selected_category:
@@ -760,9 +4033,9 @@ class MainWindow(tk.Tk):
             apt = self.db.get_apartment(apt_num - 1)
             if apt:
                 self.apt_full_name_entry.delete(0, tk.END)
-                self.apt_full_name_entry.insert(0, apt.get('full_name', ''))
+                self.apt_full_name_entry.insert(0, apt.full_name)
                 self.apt_phone_entry.delete(0, tk.END)
-                self.apt_phone_entry.insert(0, apt.get('phone', ''))
+                self.apt_phone_entry.insert(0, apt.phone)
                 self.selected_apartment_id = apt_num - 1
 
     def on_apartment_info_select(self, event):
@@ -788,28 +4061,28 @@ class MainWindow(tk.Tk):
             messagebox.showerror("❌ Ошибка", "Не удалось сохранить данные!")
 
     def refresh_apartments_list(self):
+        if not hasattr(self, 'apartments_info_tree'):
+            return
         for item in self.apartments_info_tree.get_children():
             self.apartments_info_tree.delete(item)
         apartments = self.db.get_all_apartments()
         for apt in apartments:
-            apt_num = apt['number']
-            full_name = apt.get('full_name', '')
-            phone = apt.get('phone', '')
+            apt_num = apt.number
+            full_name = apt.full_name
+            phone = apt.phone
             self.apartments_info_tree.insert('', 'end', values=(apt_num, full_name, phone))
 
     def add_category(self):
         name = self.cat_name_entry.get()
         try:
-            amount = float(self.cat_amount_entry.get())
+            amount = parse_money(self.cat_amount_entry.get())
             if not name:
                 messagebox.showwarning("Ошибка", "Введите название!")
                 return
-            if self.db.add_category(name, amount):
-                amount_per_apt = amount / 10
-                new_category = self.db.get_categories()[-1]
-                for apt_id in range(10):
-                    self.db.add_transaction(apartment_id=apt_id, category_id=new_category['id'], amount=amount_per_apt, trans_type='debt', user_id=self.user['id'], notes=f"Начисление: {new_category['name']}")
-                messagebox.showinfo("✅ Успех", f"Категория '{new_category['name']}' добавлена!\n\nОбщая сумма: {amount:.2f} руб.\nНа каждую квартиру: {amount_per_apt:.2f} руб.")
+            new_category = self.db.add_category_with_accruals(name, amount, self.user.id)
+            if new_category:
+                shares = split_amount(amount, len(self.db.get_all_apartments()))
+                messagebox.showinfo("✅ Успех", f"Категория '{new_category.name}' добавлена!\n\nОбщая сумма: {format_money(amount)} руб.\nНа каждую квартиру: {format_money(shares[0])} руб.")
                 self.cat_name_entry.delete(0, tk.END)
                 self.cat_amount_entry.delete(0, tk.END)
                 self.refresh_categories()
@@ -821,12 +4094,150 @@ class MainWindow(tk.Tk):
         except ValueError:
             messagebox.showerror("❌ Ошибка", "Сумма должна быть числом!")
 
+    def refresh_recurring(self):
+        if not hasattr(self, 'recurring_tree'):
+            return
+        for item in self.recurring_tree.get_children():
+            self.recurring_tree.delete(item)
+        for template in self.db.get_recurring_charges():
+            self.recurring_tree.insert('', 'end', values=(template['id'], template['name'], format_money(template['amount']), template['day'], template['start']))
+
+    def add_recurring_charge(self):
+        name = self.rec_name_entry.get().strip()
+        try:
+            amount = parse_money(self.rec_amount_entry.get())
+            day = int(self.rec_day_entry.get() or 1)
+        except ValueError:
+            messagebox.showerror("❌ Ошибка", "Сумма и день должны быть числами!")
+            return
+        if not name or amount <= 0:
+            messagebox.showwarning("Ошибка", "Введите название и сумму больше 0!")
+            return
+        if self.db.add_recurring_charge(name, amount, day):
+            self.rec_name_entry.delete(0, tk.END)
+            self.rec_amount_entry.delete(0, tk.END)
+            self.refresh_recurring()
+            self.run_recurring_accruals()
+        else:
+            messagebox.showerror("❌ Ошибка", "Шаблон с таким названием уже существует!")
+
+    def delete_recurring_charge(self):
+        selected = self.recurring_tree.selection()
+        if not selected:
+            messagebox.showwarning("Ошибка", "Выберите шаблон для удаления!")
+            return
+        template_id = int(self.recurring_tree.item(selected[0])['values'][0])
+        if messagebox.askyesno("Подтверждение", "Удалить шаблон? Уже начисленные категории сохранятся."):
+            self.db.delete_recurring_charge(template_id)
+            self.refresh_recurring()
+
+    def run_recurring_accruals(self, notify: bool = True):
+        created = self.db.run_recurring_accruals(self.user.id)
+        if created:
+            self.refresh_categories()
+            self.refresh_apartments()
+            self.refresh_transactions_tree()
+            self.update_category_combo()
+            if notify:
+                names = "\n".join(c.name for c in created)
+                messagebox.showinfo("✅ Начисления", f"Создано начислений: {len(created)}\n\n{names}")
+        elif notify:
+            messagebox.showinfo("Начисления", "Новых начислений нет.")
+
     def update_category_combo(self):
         categories = self.db.get_categories()
-        cat_list = [f"{c['id']}: {c['name']}" for c in categories]
+        cat_list = [f"{c.id}: {c.name}" for c in categories]
         if hasattr(self, 'cat_combo'):
             self.cat_combo['values'] = cat_list
 
+    def create_dashboard_tab(self):
+        btn_frame = tk.Frame(self.dashboard_tab, bg='white')
+        btn_frame.pack(fill=tk.X, padx=10, pady=10)
+        tk.Label(btn_frame, text="Кв:", bg='white', font=("Arial", 10)).pack(side=tk.LEFT, padx=5)
+        self.dashboard_apt_var = tk.StringVar(value="Все")
+        apt_combo = ttk.Combobox(btn_frame, textvariable=self.dashboard_apt_var, values=["Все"] + [str(i) for i in range(1, 11)], width=6, state='readonly')
+        apt_combo.pack(side=tk.LEFT, padx=5)
+        apt_combo.bind("<<ComboboxSelected>>", lambda e: self.draw_dashboard())
+        refresh_btn = tk.Button(btn_frame, text="🔄 Обновить", command=self.draw_dashboard, bg='#0078D4', fg='white', font=("Arial", 10, "bold"))
+        refresh_btn.pack(side=tk.LEFT, padx=5)
+        self.dashboard_info = tk.Label(btn_frame, text="", bg='white', font=("Arial", 9))
+        self.dashboard_info.pack(side=tk.RIGHT, padx=5)
+        self.rate_canvas = tk.Canvas(self.dashboard_tab, bg='white', highlightthickness=0)
+        self.rate_canvas.pack(fill=tk.BOTH, expand=True, padx=10, pady=5)
+        self.debt_canvas = tk.Canvas(self.dashboard_tab, bg='white', highlightthickness=0)
+        self.debt_canvas.pack(fill=tk.BOTH, expand=True, padx=10, pady=5)
+        self.rate_canvas.bind("<Configure>", lambda e: self.draw_dashboard())
+
+    def draw_dashboard(self):
+        if not hasattr(self, 'rate_canvas'):
+            return
+        apt = self.dashboard_apt_var.get()
+        # В списке номера квартир (с 1), id квартиры на единицу меньше
+        trend = self.db.get_collections_trend(None if apt == "Все" else int(apt) - 1)[-24:]
+        self.draw_rate_chart(self.rate_canvas, trend)
+        self.draw_debt_chart(self.debt_canvas, trend)
+        if trend:
+            last = trend[-1]
+            self.dashboard_info.config(text=f"Долг на конец {last['month']}: {format_money(last['outstanding'])} руб.")
+        else:
+            self.dashboard_info.config(text="Нет данных")
+
+    def draw_rate_chart(self, canvas: tk.Canvas, trend: List[Dict]):
+        # Столбцы: начислено/оплачено за месяц, линия: доля собранного
+        canvas.delete('all')
+        width, height = canvas.winfo_width(), canvas.winfo_height()
+        left, right, top, bottom = 70, 50, 25, 30
+        canvas.create_text(left, 10, text="Начислено / оплачено и доля собранного", anchor='w', font=("Arial", 10, "bold"))
+        if not trend or width <= left + right or height <= top + bottom:
+            return
+        plot_w, plot_h = width - left - right, height - top - bottom
+        peak = max(max(row['paid'], row['debts']) for row in trend) or 1
+        step = plot_w / len(trend)
+        bar = max(step / 3, 1)
+        canvas.create_line(left, top + plot_h, left + plot_w, top + plot_h)
+        canvas.create_text(left - 5, top, text=format_money(peak), anchor='e', font=("Arial", 8))
+        canvas.create_text(left + plot_w + 5, top, text="100%", anchor='w', font=("Arial", 8), fill='#107C10')
+        points = []
+        for i, row in enumerate(trend):
+            x = left + i * step + step / 2
+            debts_h = plot_h * row['debts'] / peak
+            paid_h = plot_h * row['paid'] / peak
+            canvas.create_rectangle(x - bar, top + plot_h - debts_h, x, top + plot_h, fill='#C91130', outline='')
+            canvas.create_rectangle(x, top + plot_h - paid_h, x + bar, top + plot_h, fill='#0078D4', outline='')
+            canvas.create_text(x, top + plot_h + 12, text=row['month'][2:], font=("Arial", 7))
+            if row['rate'] is not None:
+                points.append((x, top + plot_h * (1 - min(row['rate'], 1.0))))
+        if len(points) > 1:
+            canvas.create_line(*[c for point in points for c in point], fill='#107C10', width=2)
+        for x, y in points:
+            canvas.create_oval(x - 3, y - 3, x + 3, y + 3, fill='#107C10', outline='')
+
+    def draw_debt_chart(self, canvas: tk.Canvas, trend: List[Dict]):
+        canvas.delete('all')
+        width, height = canvas.winfo_width(), canvas.winfo_height()
+        left, right, top, bottom = 70, 50, 25, 30
+        canvas.create_text(left, 10, text="Накопленный долг", anchor='w', font=("Arial", 10, "bold"))
+        if not trend or width <= left + right or height <= top + bottom:
+            return
+        plot_w, plot_h = width - left - right, height - top - bottom
+        values = [row['outstanding'] for row in trend]
+        low, high = min(values + [0]), max(values + [0])
+        span = (high - low) or 1
+        step = plot_w / len(trend)
+        zero_y = top + plot_h * (high / span)
+        canvas.create_line(left, zero_y, left + plot_w, zero_y, fill='#888888', dash=(2, 2))
+        canvas.create_text(left - 5, top, text=format_money(high), anchor='e', font=("Arial", 8))
+        canvas.create_text(left - 5, top + plot_h, text=format_money(low), anchor='e', font=("Arial", 8))
+        points = []
+        for i, row in enumerate(trend):
+            x = left + i * step + step / 2
+            points.append((x, top + plot_h * (high - row['outstanding']) / span))
+            canvas.create_text(x, top + plot_h + 12, text=row['month'][2:], font=("Arial", 7))
+        if len(points) > 1:
+            canvas.create_line(*[c for point in points for c in point], fill='#C91130', width=2)
+        for x, y in points:
+            canvas.create_oval(x - 3, y - 3, x + 3, y + 3, fill='#C91130', outline='')
+
     def create_transactions_tab(self):
         btn_frame = tk.Frame(self.transactions_tab, bg='white')
         btn_frame.pack(fill=tk.X, padx=10, pady=10)
@@ -904,90 +4315,12 @@ class MainWindow(tk.Tk):
         self.transactions_tree.tag_configure('separator', background='#d0d0d0', foreground='#999999')
 
     def refresh_transactions_tree(self):
-        for item in self.transactions_tree.get_children():
-            self.transactions_tree.delete(item)
-        self.transaction_mapping.clear()
+        if not hasattr(self, 'transactions_tree'):
+            return
         self.selected_item_id = None
-        
-        for apt_index, apt_id in enumerate(range(10)):
-            all_transactions = self.db.get_transactions(apartment_id=apt_id)
-            balance = self.db.get_apartment_balance(apt_id)
-            apt_num = apt_id + 1
-            
-            if apt_index > 0:
-                separator_line = "─" * 80
-                self.transactions_tree.insert('', 'end',
-                    text=separator_line,
-                    values=('─' * 20, '─' * 15, '─' * 15, '─' * 15, '─' * 15),
-                    tags=('separator',))
-            
-            if balance['debts'] == 0 or balance['balance'] >= 0:
-                apartment_tag = 'apartment_ok'
-            else:
-                apartment_tag = 'apartment_debt'
-            
-            balance_text = f"+{balance['balance']:.2f}" if balance['balance'] > 0 else f"{balance['balance']:.2f}"
-            
-            apt_parent = self.transactions_tree.insert('', 'end',
-                text=f"Кв. {apt_num}",
-                values=("", "", "", "", balance_text),
-                tags=(apartment_tag,))
-            
-            self.transactions_tree.item(apt_parent, open=True)
-            
-            if all_transactions:
-                by_category = {}
-                for trans in all_transactions:
-                    cat_id = trans['category_id']
-                    if cat_id not in by_category:
-                        by_category[cat_id] = []
-                    by_category[cat_id].append(trans)
-                
-                categories = self.db.get_categories()
-                for cat in categories:
-                    cat_id = cat['id']
-                    cat_name = cat['name']
-                    if cat_id in by_category:
-                        cat_transactions = by_category[cat_id]
-                        cat_paid = sum(t['amount'] for t in cat_transactions if t['type'] == 'payment')
-                        cat_debts = sum(t['amount'] for t in cat_transactions if t['type'] == 'debt')
-                        balance_after = cat_paid - cat_debts
-                        
-                        if balance_after >= 0:
-                            status_text = "✅ Оплачено"
-                            cat_tag = 'paid'
-                        else:
-                            status_text = "⚠️ Имеется долг"
-                            cat_tag = 'unpaid'
-                        
-                        cat_parent = self.transactions_tree.insert(apt_parent, 'end',
-                            text="",
-                            values=(f"{cat_name} | {status_text}", "", "", "", ""),
-                            tags=(cat_tag,))
-                        
-                        self.transactions_tree.item(cat_parent, open=True)
-                        
-                        for trans in cat_transactions:
-                            trans_type = "💰 Платеж" if trans['type'] == 'payment' else "💸 Долг"
-                            tag = 'payment' if trans['type'] == 'payment' else 'debt'
-                            date = trans.get('created_at', '???').split('T')[0] if 'created_at' in trans else '???'
-                            
-                            item = self.transactions_tree.insert(cat_parent, 'end',
-                                text="",
-                                values=(f"{cat_name}",
-                                        trans_type,
-                                        f"{trans['amount']:.2f}",
-                                        date,
-                                        ""),
-                                tags=(tag,))
-                            
-                            self.transaction_mapping[item] = {
-                                'type': 'transaction',
-                                'trans_id': trans['id'],
-                                'trans_type': trans['type'],
-                                'amount': trans['amount']
-                            }
-        
+        rows = self.view_model.transaction_rows()
+        render_rows(self.transactions_tree, rows)
+        self.transaction_mapping = {row.key: row.payload for row in rows if row.payload}
         self.transactions_tree.update()
 
     def on_transaction_select(self, event):
@@ -1011,7 +4344,7 @@ class MainWindow(tk.Tk):
             return
         
         transactions = self.db.get_transactions()
-        transaction = next((t for t in transactions if t['id'] == item_data['trans_id']), None)
+        transaction = next((t for t in transactions if t.id == item_data['trans_id']), None)
         
         if not transaction:
             messagebox.showerror("❌ Ошибка", "Транзакция не найдена в БД!")
@@ -1038,7 +4371,7 @@ class MainWindow(tk.Tk):
             bg='white', fg='#333').pack(anchor='w', pady=(0, 8))
         
         amount_entry = tk.Entry(content_frame, font=("Arial", 11), width=40, relief=tk.SOLID, bd=1)
-        amount_entry.insert(0, str(transaction['amount']))
+        amount_entry.insert(0, format_money(transaction.amount))
         amount_entry.pack(fill=tk.X, ipady=10, pady=(0, 20))
         amount_entry.focus()
         amount_entry.select_range(0, tk.END)
@@ -1054,7 +4387,7 @@ class MainWindow(tk.Tk):
                     return
                 
                 try:
-                    new_amount = float(new_amount_str)
+                    new_amount = parse_money(new_amount_str)
                 except ValueError:
                     messagebox.showerror("❌ Ошибка", "Сумма должна быть числом!")
                     return
@@ -1063,13 +4396,13 @@ class MainWindow(tk.Tk):
                     messagebox.showwarning("❌ Ошибка", "Сумма должна быть больше 0!")
                     return
                 
-                old_amount = transaction['amount']
-                trans_id = transaction['id']
+                old_amount = transaction.amount
+                trans_id = transaction.id
                 
-                if self.db.update_transaction(trans_id, new_amount, transaction.get('notes', '')):
-                    updated_trans = next((t for t in self.db.get_transactions() if t['id'] == trans_id), None)
+                if self.db.update_transaction(trans_id, new_amount, transaction.notes):
+                    updated_trans = next((t for t in self.db.get_transactions() if t.id == trans_id), None)
                     
-                    if updated_trans and updated_trans['amount'] == new_amount:
+                    if updated_trans and updated_trans.amount == new_amount:
                         self.refresh_transactions_tree()
                         self.refresh_apartments()
                         self.notebook.select(self.transactions_tab)
@@ -1077,7 +4410,7 @@ class MainWindow(tk.Tk):
                         self.transactions_tree.update()
                         
                         messagebox.showinfo("✅ Успех",
-                            f"✓ Платеж обновлен!\n\n💰 Старая сумма: {old_amount:.2f} руб.\n💰 Новая сумма: {new_amount:.2f} руб.\n✓ Все вкладки обновлены!")
+                            f"✓ Платеж обновлен!\n\n💰 Старая сумма: {format_money(old_amount)} руб.\n💰 Новая сумма: {format_money(new_amount)} руб.\n✓ Все вкладки обновлены!")
                         
                         edit_window.destroy()
                     else:
@@ -1122,7 +4455,7 @@ class MainWindow(tk.Tk):
         try:
             apt_id = int(self.trans_apt_var.get()) - 1
             cat_id = int(self.trans_cat_var.get().split(':')[0])
-            amount = float(self.trans_amount_entry.get())
+            amount = parse_money(self.trans_amount_entry.get())
             
             if not self.trans_apt_var.get() or not self.trans_cat_var.get():
                 messagebox.showwarning("Ошибка", "Выберите квартиру и категорию!")
@@ -1132,7 +4465,14 @@ class MainWindow(tk.Tk):
                 messagebox.showwarning("Ошибка", "Только администратор может добавлять долги!")
                 return
             
-            self.db.add_transaction(apt_id, cat_id, amount, trans_type, self.user['id'], "")
+            if amount <= 0:
+                messagebox.showwarning("❌ Ошибка", "Сумма должна быть больше 0!")
+                return
+            
+            if self.db.add_transaction(apt_id, cat_id, amount, trans_type, self.user.id, "") is None:
+                messagebox.showerror("❌ Ошибка", f"Платеж не записан: {self.db.last_write_error or 'ошибка записи'}")
+                self.update_category_combo()
+                return
             
             messagebox.showinfo("✅ Успех", "Платеж записан!")
             
@@ -1147,14 +4487,28 @@ class MainWindow(tk.Tk):
 
 
 def main():
+    # Во время запуска входит загрузка базы (снимок, хвост журнала, миграции),
+    # ожидание ввода пароля - нет
+    started = time.perf_counter()
     db = Database()
+    load_time = time.perf_counter() - started
     login_window = LoginWindow(db)
     login_window.mainloop()
     
     if login_window.user:
-        main_window = MainWindow(db, login_window.user)
+        main_window = MainWindow(db, login_window.user, started_at=time.perf_counter() - load_time)
         main_window.mainloop()
+        db.logout(login_window.session_token)
+        db.checkpoint()
+        # Копия после каждого сеанса: неизменённые блоки не записываются повторно
+        try:
+            db.create_backup()
+        except OSError:
+            pass
 
 
 if __name__ == "__main__":
-    main()
+    if sys.argv[1:2] == ['--load-test']:
+        load_test_main(sys.argv[2:])
+    else:
+        main()
@@ -0,0 +1,26 @@
+import shutil
+import sys
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+import GaiLab  # noqa: E402
+
+# Файлы, которые программа создаёт сама при работе - в копию исходных данных не берутся
+GENERATED = ('data.lock', 'summary.json', 'replication.json', 'allocations.json', 'journal.jsonl', 'commands.jsonl', 'snapshots', '*.tmp')
+
+
+@pytest.fixture
+def data_dir(tmp_path):
+    # Копия исходных данных из репозитория: тесты никогда не трогают GB_Haus/data
+    target = tmp_path / 'data'
+    shutil.copytree(ROOT / 'data', target, ignore=shutil.ignore_patterns(*GENERATED))
+    return target
+
+
+@pytest.fixture
+def db(data_dir):
+    return GaiLab.Database(str(data_dir))
@@ -0,0 +1,75 @@
+import GaiLab
+from GaiLab import PaymentAllocations, Transaction
+
+
+def trans(trans_id, category_id, amount, trans_type, created_at, apartment_id=0):
+    return Transaction(id=trans_id, apartment_id=apartment_id, category_id=category_id, amount=amount, type=trans_type,
+                       user_id=1, notes="", created_at=created_at)
+
+
+def balances(db):
+    return {apt_id: {c['id']: c['balance_after'] for c in d['categories']} for apt_id, d in db.get_all_distributions().items()}
+
+
+def test_surplus_goes_to_other_debts_then_waits_for_accruals():
+    table = PaymentAllocations()
+    assert table.add(trans(1, 1, 6000, 'debt', "2025-11-01T10:00:00"))
+    assert table.add(trans(2, 2, 5000, 'debt', "2025-11-01T10:00:01"))
+    assert table.add(trans(3, 1, 8000, 'payment', "2025-11-02T10:00:00"))
+    assert table.rows[0][3] == [1, [[1, 6000], [2, 2000]]]
+    assert table.due[0] == {1: 0, 2: 3000}
+    assert table.received[0] == {2: 2000, 1: -2000}
+
+    # Излишек ждёт следующего начисления
+    assert table.add(trans(4, 3, 9000, 'payment', "2025-11-03T10:00:00"))
+    assert table.add(trans(5, 4, 4000, 'debt', "2025-11-04T10:00:00"))
+    assert table.rows[0][4] == [3, [[2, 3000], [4, 4000]]]
+    assert table.credit[0] == {4: 2000}
+
+
+def test_backdated_record_needs_rebuild_and_matches_full_order():
+    records = [trans(1, 1, 6000, 'debt', "2025-11-01T10:00:00"),
+               trans(2, 1, 6000, 'payment', "2025-11-05T10:00:00"),
+               trans(3, 2, 5000, 'debt', "2025-11-03T10:00:00")]
+    table = PaymentAllocations()
+    assert table.add(records[0])
+    assert table.add(records[1])
+    # Начисление задним числом: порядок распределения изменился, add отказывается
+    assert not table.add(records[2])
+    table.rebuild(0, records)
+
+    expected = PaymentAllocations()
+    for record in sorted(records, key=lambda t: t.created_at):
+        assert expected.add(record)
+    assert table.to_dict() == expected.to_dict()
+    assert PaymentAllocations.from_dict(table.to_dict()).to_dict() == table.to_dict()
+
+
+def test_incremental_table_matches_full_rebuild(db):
+    before = balances(db)
+    assert db.add_transaction(0, 1, 8000, 'payment', 1)
+    assert db.add_transaction(1, 2, 2000, 'payment', 1)
+    payment = db.add_transaction(2, 1, 12000, 'payment', 1)
+    assert db.update_transaction(payment.id, 3000, "")
+    assert balances(db) != before
+    incremental = balances(db)
+    db.rebuild_indexes()
+    assert balances(db) == incremental
+
+
+def test_reload_after_category_deletion_in_another_process(data_dir):
+    db = GaiLab.Database(str(data_dir))
+    assert db.add_category("Пустая", 0)
+    empty = next(c for c in db.get_categories() if c.name.startswith("Пустая"))
+    # Переплата в категорию без долгов гасит начисления квартиры по другим категориям
+    assert db.add_transaction(1, empty.id, 11000, 'payment', 1)
+    assert balances(db)[1][1] == 0 and balances(db)[1][2] == 0
+    db.checkpoint()
+
+    assert GaiLab.Database(str(data_dir)).delete_category(empty.id)
+
+    reloaded = GaiLab.Database(str(data_dir))
+    after_reload = balances(reloaded)
+    assert after_reload[1][1] == -6000 and after_reload[1][2] == -5000
+    reloaded.rebuild_indexes()
+    assert balances(reloaded) == after_reload
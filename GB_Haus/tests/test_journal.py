@@ -0,0 +1,21 @@
+from datetime import datetime
+
+import GaiLab
+
+
+def test_automatic_snapshots_are_pruned(db, monkeypatch):
+    monkeypatch.setattr(GaiLab, 'SNAPSHOT_INTERVAL', 5)
+    before_payments = db.get_all_balances(datetime(2025, 11, 30))
+    for i in range(60):
+        assert db.add_transaction(i % 10, 1, 100, 'payment', 1)
+
+    # Все снимки сделаны сегодня: остаются только последние
+    paths = db._snapshot_paths()
+    assert len(paths) == GaiLab.SNAPSHOT_KEEP_LAST
+    assert paths[-1] == db._latest_snapshot_path()
+    assert db.get_journal_position()[0] - db._load_snapshot(paths[-1])['seq'] < GaiLab.SNAPSHOT_INTERVAL
+
+    # Состояние и запросы на дату по-прежнему восстанавливаются
+    reopened = GaiLab.Database(str(db.data_dir))
+    assert sorted(reopened.get_transactions(), key=lambda t: t.id) == sorted(db.get_transactions(), key=lambda t: t.id)
+    assert reopened.get_all_balances(datetime(2025, 11, 30)) == before_payments
@@ -0,0 +1,87 @@
+import json
+
+import pytest
+
+import GaiLab
+from GaiLab import parse_money, format_money, split_amount
+
+
+@pytest.mark.parametrize('value, expected', [
+    ("100", 10000),
+    ("0.01", 1),
+    ("12,5", 1250),
+    (" 7.05 ", 705),
+    (600.0, 60000),
+    (0.1 + 0.2, 30),
+    (100.00999999999999, 10001),
+    ("0.005", 1),
+    ("-3.10", -310),
+])
+def test_parse_money(value, expected):
+    assert parse_money(value) == expected
+
+
+@pytest.mark.parametrize('value', ["", "abc", "1.2.3", "nan", "inf"])
+def test_parse_money_rejects_garbage(value):
+    with pytest.raises(ValueError):
+        parse_money(value)
+
+
+def test_format_money_round_trip():
+    assert format_money(10001) == "100.01"
+    assert format_money(-5) == "-0.05"
+    assert format_money(250, signed=True) == "+2.50"
+    assert parse_money(format_money(123456)) == 123456
+
+
+@pytest.mark.parametrize('total, parts', [(60000, 10), (10000, 3), (1, 10), (0, 4), (99999, 7)])
+def test_split_amount_keeps_total(total, parts):
+    shares = split_amount(total, parts)
+    assert len(shares) == parts
+    assert sum(shares) == total
+    assert max(shares) - min(shares) <= 1
+    # Лишние копейки - первым квартирам
+    assert shares == sorted(shares, reverse=True)
+
+
+def test_migrations_bring_baseline_to_current_schema(data_dir):
+    source_categories = json.loads((data_dir / 'categories.json').read_text(encoding='utf-8'))
+    source_transactions = json.loads((data_dir / 'transactions.json').read_text(encoding='utf-8'))
+    db = GaiLab.Database(str(data_dir))
+
+    assert db.get_schema_version() == GaiLab.SCHEMA_VERSION
+    categories = {c.id: c for c in db.get_categories()}
+    transactions = {t.id: t for t in db.get_transactions()}
+    # v2: float-рубли переведены в целые копейки без потерь
+    assert {c['id']: parse_money(c['amount']) for c in source_categories} == {i: c.amount for i, c in categories.items()}
+    assert {t['id']: parse_money(t['amount']) for t in source_transactions} == {i: t.amount for i, t in transactions.items()}
+    assert all(isinstance(t.amount, int) for t in transactions.values())
+    # v5: открытый пароль заменён хешем, вход по-прежнему работает
+    users = json.loads((data_dir / 'users.json').read_text(encoding='utf-8'))
+    assert all('password' not in u and 'password_hash' in u for u in users)
+    assert db.authenticate('admin', 'admin')
+    # Повторное открытие не запускает миграции заново
+    assert {c.id: c for c in GaiLab.Database(str(data_dir)).get_categories()} == categories
+
+
+def test_migration_v2_rounds_float_noise(data_dir):
+    records = [{"id": 1, "apartment_id": 0, "category_id": 1, "amount": 100.00999999999999, "type": "payment",
+                "user_id": 1, "notes": "", "created_at": "2025-11-20T10:00:00"},
+               {"id": 2, "apartment_id": 1, "category_id": 1, "amount": 0.30000000000000004, "type": "payment",
+                "user_id": 1, "notes": "", "created_at": "2025-11-20T10:00:00"}]
+    (data_dir / 'transactions.json').write_text(json.dumps(records), encoding='utf-8')
+    db = GaiLab.Database(str(data_dir))
+    assert {t.id: t.amount for t in db.get_transactions()} == {1: 10001, 2: 30}
+
+
+def test_migration_v4_keeps_negative_amounts(data_dir):
+    # v4 удаляет только транзакции без категории; отрицательные суммы оставляются оператору
+    records = json.loads((data_dir / 'transactions.json').read_text(encoding='utf-8'))
+    records[0]['amount'] = -records[0]['amount']
+    records.append(dict(records[1], id=999, category_id=404))
+    (data_dir / 'transactions.json').write_text(json.dumps(records), encoding='utf-8')
+    db = GaiLab.Database(str(data_dir))
+    transactions = {t.id: t for t in db.get_transactions()}
+    assert 999 not in transactions
+    assert transactions[records[0]['id']].amount == parse_money(records[0]['amount'])
+    assert any(problem['kind'] == 'bad_amount' for problem in db.scan_integrity())
@@ -0,0 +1,104 @@
+import GaiLab
+
+
+def ledger_state(db):
+    # Сравнение по содержимому записей: поле version в равенстве не участвует
+    return (sorted(db.get_categories(), key=lambda c: c.id),
+            sorted(db.get_transactions(), key=lambda t: t.id),
+            sorted(db.get_all_apartments(), key=lambda a: a.id))
+
+
+def test_conflicting_edits_converge_in_any_import_order(db, tmp_path):
+    main = db
+    clones = {}
+    for name in ('other', 'first', 'second'):
+        main.clone_replica(str(tmp_path / name))
+        clones[name] = GaiLab.Database(str(tmp_path / name))
+    other = clones['other']
+    accrual = main.get_transactions(category_id=1)[1]
+
+    # Обе стороны правят одни и те же записи, не видя друг друга
+    assert main.update_category(1, "Свет ноябрь 2025", 70000)
+    assert main.delete_transaction(accrual.id)
+    assert main.update_apartment(3, "Иванов", "111")
+    assert main.delete_category(2)
+    assert main.add_transaction(4, 1, 1500, 'payment', 1)
+
+    assert other.update_category(1, "Свет ноябрь 2025", 65000)
+    assert other.update_transaction(accrual.id, 9900, "правка на клоне")
+    assert other.update_apartment(3, "Петров", "222")
+    assert other.add_transaction(5, 2, 2500, 'payment', 1)
+    assert other.add_transaction(5, 1, 700, 'payment', 1)
+
+    bundle_main = str(tmp_path / 'main.jsonl')
+    bundle_other = str(tmp_path / 'other.jsonl')
+    assert main.export_sync_bundle(bundle_main) == 5
+    assert other.export_sync_bundle(bundle_other) == 5
+
+    main.import_sync_bundle(bundle_other)
+    other.import_sync_bundle(bundle_main)
+    clones['first'].import_sync_bundle(bundle_main)
+    clones['first'].import_sync_bundle(bundle_other)
+    clones['second'].import_sync_bundle(bundle_other)
+    clones['second'].import_sync_bundle(bundle_main)
+
+    expected = ledger_state(main)
+    for name, replica in clones.items():
+        assert ledger_state(replica) == expected, name
+
+    categories, transactions, apartments = expected
+    # Удаление побеждает правку, платёж в удалённую категорию отброшен
+    assert accrual.id not in {t.id for t in transactions}
+    assert 2 not in {c.id for c in categories}
+    assert all(t.category_id != 2 for t in transactions)
+    # Новые записи обоих узлов сохранились, id не пересеклись
+    assert {(t.apartment_id, t.amount) for t in transactions if t.type == 'payment'} >= {(4, 1500), (5, 700)}
+    assert len({t.id for t in transactions}) == len(transactions)
+    # Из двух правок одной записи везде осталась одна и та же
+    assert next(c for c in categories if c.id == 1).amount in (70000, 65000)
+    assert next(a for a in apartments if a.id == 3).full_name in ("Иванов", "Петров")
+
+
+def test_repeated_import_is_idempotent(db, tmp_path):
+    db.clone_replica(str(tmp_path / 'other'))
+    other = GaiLab.Database(str(tmp_path / 'other'))
+    assert db.add_transaction(1, 1, 1000, 'payment', 1)
+    bundle = str(tmp_path / 'main.jsonl')
+    db.export_sync_bundle(bundle)
+
+    assert other.import_sync_bundle(bundle)['applied'] == 1
+    assert other.import_sync_bundle(bundle) == {'from': db.get_replication_info()['node'], 'applied': 0, 'skipped': 1}
+    assert ledger_state(other) == ledger_state(db)
+    # После перезапуска состояние восстанавливается из журнала таким же
+    assert ledger_state(GaiLab.Database(str(tmp_path / 'other'))) == ledger_state(db)
+
+
+def test_deleted_id_is_not_reused_by_the_next_record(db, tmp_path):
+    db.clone_replica(str(tmp_path / 'other'))
+    other = GaiLab.Database(str(tmp_path / 'other'))
+    old = db.add_transaction(2, 1, 3000, 'payment', 1)
+    bundle_main = str(tmp_path / 'main.jsonl')
+    bundle_other = str(tmp_path / 'other.jsonl')
+    db.export_sync_bundle(bundle_main)
+    other.import_sync_bundle(bundle_main)
+
+    # Удаляется запись с наибольшим id, следом добавляется новая; другой узел правит старую
+    assert db.delete_transaction(old.id)
+    new = db.add_transaction(2, 1, 5000, 'payment', 1, "новый")
+    assert new.id != old.id
+    assert other.update_transaction(old.id, 7777, "правка на клоне")
+    db.export_sync_bundle(bundle_main)
+    other.export_sync_bundle(bundle_other)
+    db.import_sync_bundle(bundle_other)
+    other.import_sync_bundle(bundle_main)
+
+    assert ledger_state(other) == ledger_state(db)
+    transactions = {t.id: t for t in db.get_transactions()}
+    assert old.id not in transactions
+    assert (transactions[new.id].amount, transactions[new.id].notes) == (5000, "новый")
+
+    # Наибольший выданный id переживает снимок и перезапуск
+    db.prune_snapshots()
+    assert db.delete_transaction(new.id)
+    reopened = GaiLab.Database(str(db.data_dir))
+    assert reopened.add_transaction(2, 1, 100, 'payment', 1).id not in (old.id, new.id)
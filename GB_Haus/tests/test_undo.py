@@ -0,0 +1,76 @@
+import json
+
+import GaiLab
+from GaiLab import split_amount
+
+
+def state(db):
+    return sorted(db.get_categories(), key=lambda c: c.id), sorted(db.get_transactions(), key=lambda t: t.id)
+
+
+def test_category_edit_keeps_shares_by_apartment_position(data_dir):
+    # id квартир не совпадают с позициями 0..n-1
+    apartments = [{"id": i * 3 + 1, "number": i + 1, "full_name": "", "phone": ""} for i in range(10)]
+    (data_dir / 'apartments.json').write_text(json.dumps(apartments), encoding='utf-8')
+    (data_dir / 'transactions.json').write_text('[]', encoding='utf-8')
+    db = GaiLab.Database(str(data_dir))
+    category = db.add_category_with_accruals("Ремонт", 50003, 1)
+    created = {t.apartment_id: t.amount for t in db.get_transactions(category_id=category.id)}
+
+    assert db.update_category_with_accruals(category.id, 100001)
+    updated = {t.apartment_id: t.amount for t in db.get_transactions(category_id=category.id)}
+    expected = dict(zip((a['id'] for a in apartments), split_amount(100001, 10)))
+    assert updated == expected
+    assert created == dict(zip((a['id'] for a in apartments), split_amount(50003, 10)))
+
+    # Категория и все доли - одна команда отмены
+    assert db.get_undo_label() == GaiLab.COMMAND_LABELS['update_category']
+    assert db.undo()
+    assert {t.apartment_id: t.amount for t in db.get_transactions(category_id=category.id)} == created
+    assert next(c for c in db.get_categories() if c.id == category.id).amount == 50003
+
+
+def test_delete_category_undo_and_redo(db):
+    before = state(db)
+    assert db.delete_category(1)
+    deleted = state(db)
+    assert all(t.category_id != 1 for t in deleted[1])
+
+    assert db.undo()
+    assert state(db) == before
+    assert db.redo()
+    assert state(db) == deleted
+    assert db.undo()
+    assert state(db) == before
+
+
+def test_undo_refuses_when_record_changed_since(db, tmp_path):
+    db.clone_replica(str(tmp_path / 'other'))
+    other = GaiLab.Database(str(tmp_path / 'other'))
+    trans = db.get_transactions(category_id=1)[0]
+    assert db.update_transaction(trans.id, 1234, "моя правка")
+    # Ту же запись позже правят на другом узле; правка приходит синхронизацией, а не командой
+    assert other.update_transaction(trans.id, 4321, "чужая правка")
+    bundle = str(tmp_path / 'other.jsonl')
+    other.export_sync_bundle(bundle)
+    db.import_sync_bundle(bundle)
+
+    assert db.get_undo_label() == GaiLab.COMMAND_LABELS['update_transaction']
+    assert db.undo() is None
+    current = next(t for t in db.get_transactions() if t.id == trans.id)
+    assert (current.amount, current.notes) == (4321, "чужая правка")
+
+
+def test_command_log_is_replayed_by_another_process(db, data_dir):
+    trans = db.get_transactions(category_id=2)[0]
+    assert db.delete_transaction(trans.id)
+    assert db.add_transaction(3, 1, 500, 'payment', 1)
+    assert db.undo()
+
+    other = GaiLab.Database(str(data_dir))
+    assert other.get_undo_label() == GaiLab.COMMAND_LABELS['delete_transaction']
+    assert other.get_redo_label() == GaiLab.COMMAND_LABELS['add_transaction']
+    assert other.undo()
+    assert trans.id in {t.id for t in other.get_transactions()}
+    # Первый процесс видит отмену, сделанную вторым
+    assert db.get_undo_label() is None